@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Compares the float and the exact integer paths for split amounts.
+
+Each stage is timed on its own: parsing "num/denom" strings, summing the
+parsed amounts, and bucketing the splits of an account into monthly
+periods. Fractions made per split are shown for reference.
+
+Usage: bench_amounts.py [number of splits]
+"""
+import os
+import sys
+import random
+import time
+from datetime import datetime, timedelta
+from fractions import Fraction
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gncreports
+
+def mkamounts(n, seed=1):
+    rand = random.Random(seed)
+    return ['%d/100' % rand.randint(-500000, 500000) for i in xrange(n)]
+
+def parse_float(texts):
+    values = []
+    for text in texts:
+        a, b = text.split('/')
+        values.append(float(a)/float(b))
+    return values
+
+def parse_integer(texts):
+    return [gncreports.parse_amount(text) for text in texts]
+
+def sum_float(values):
+    total = 0
+    for value in values:
+        total += value
+    return total
+
+def sum_fraction(amounts):
+    total = 0
+    for num, denom in amounts:
+        total += Fraction(num, denom)
+    return total
+
+def sum_integer(amounts):
+    scale = gncreports.common_denom([denom for num, denom in amounts])
+    total = 0
+    for num, denom in amounts:
+        total += num * (scale // denom)
+    return Fraction(total, scale)
+
+def mkaccount(amounts, seed=1):
+    """Returns an account holding a split for each amount, posted over
+    five years."""
+    rand = random.Random(seed)
+    act = gncreports.Account(gncreports.Book())
+    act.id, act.type = 'bench', 'EXPENSE'
+    for num, denom in amounts:
+        trn = gncreports.Transaction()
+        trn.date_posted = (datetime(2007, 1, 1) +
+                           timedelta(rand.randint(0, 5 * 365 - 1)))
+        split = gncreports.Split()
+        split.value_num, split.value_denom = num, denom
+        split.transaction = trn
+        act.splits.append(split)
+    return act
+
+def periods_float(act, periods):
+    """period_balances() with float values, for reference."""
+    bounds, spans = gncreports._segments(periods)
+    nsegs = len(bounds) - 1
+    sums = [0] * nsegs
+    for split in act.splits:
+        i = gncreports.bisect_right(bounds, split.date().toordinal()) - 1
+        if 0 <= i < nsegs:
+            sums[i] += float(split.value_num)/float(split.value_denom)
+    return [sum(sums[lo:hi]) for lo, hi in spans]
+
+def periods_integer(act, periods):
+    return gncreports.period_balances([act], periods)[act.id]
+
+def timeit(func, *args):
+    best = None
+    for i in range(3):
+        t = time.time()
+        result = func(*args)
+        t = time.time() - t
+        best = best is None and t or min(best, t)
+    return best, result
+
+def report(stage, rows):
+    print stage
+    for name, (t, result) in rows:
+        print '  %-10s %8.3fs' % (name, t)
+
+def main():
+    n = len(sys.argv) > 1 and int(sys.argv[1]) or 200000
+    texts = mkamounts(n)
+    values = parse_float(texts)
+    amounts = parse_integer(texts)
+    print '%d splits' % n
+
+    report('parse', [('float', timeit(parse_float, texts)),
+                     ('integer', timeit(parse_integer, texts))])
+    rows = [('float', timeit(sum_float, values)),
+            ('fraction', timeit(sum_fraction, amounts)),
+            ('integer', timeit(sum_integer, amounts))]
+    report('sum', rows)
+    print '  float %.10f, exact %s' % (rows[0][1][1], rows[2][1][1])
+
+    act = mkaccount(amounts)
+    periods = []
+    for year in range(2007, 2012):
+        periods.extend(gncreports.monthly_periods(year))
+    report('%d monthly periods' % len(periods),
+           [('float', timeit(periods_float, act, periods)),
+            ('integer', timeit(periods_integer, act, periods))])
+
+if __name__ == '__main__':
+    main()
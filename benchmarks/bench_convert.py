@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Times the steps of converting transaction elements: decoding timestamps,
+looking up qualified tags, and converting whole transactions with and
+without skipping the fields the reports do not use.
+
+Usage: bench_convert.py [transactions]
+"""
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gncreports
+from gncreports import etree
+from synthbook import write_book
+
+def timeit(func, *args):
+    t = time.time()
+    func(*args)
+    return time.time() - t
+
+def old_nstag(tag):
+    prefix, name = tag.split(':')
+    return '{http://www.gnucash.org/XML/%s}%s' % (prefix, name)
+
+def strptime_dates(texts):
+    for text in texts:
+        datetime.strptime(text[:19], '%Y-%m-%d %H:%M:%S')
+
+def decode_dates(texts):
+    for text in texts:
+        gncreports.parse_timestamp(text)
+
+def split_tags(elms):
+    for elm in elms:
+        elm.findtext(old_nstag('split:id'))
+        elm.findtext(old_nstag('split:value'))
+        elm.findtext(old_nstag('split:quantity'))
+        elm.findtext(old_nstag('split:account'))
+
+def qualified_tags(elms):
+    for elm in elms:
+        elm.findtext(gncreports._SPLIT_ID)
+        elm.findtext(gncreports._SPLIT_VALUE)
+        elm.findtext(gncreports._SPLIT_QUANTITY)
+        elm.findtext(gncreports._SPLIT_ACCOUNT)
+
+def convert(elms, skip=()):
+    for elm in elms:
+        gncreports.Transaction(elm, skip)
+
+def main():
+    n = len(sys.argv) > 1 and int(sys.argv[1]) or 50000
+    fd, filename = tempfile.mkstemp('.gnucash')
+    os.close(fd)
+    write_book(filename, n)
+    tree = etree.parse(gncreports.gzip.GzipFile(filename))
+    os.remove(filename)
+    trnelms = tree.findall('.//' + gncreports.nstag('gnc:transaction'))
+    splitelms = tree.findall('.//' + gncreports.nstag('trn:split'))
+    texts = [elm.findtext(gncreports._TRN_DATE_POSTED) for elm in trnelms]
+    skip = ('currency', 'date_entered', 'description')
+
+    print '%d transactions, %d splits' % (len(trnelms), len(splitelms))
+    for name, old, new, args in [
+            ('timestamps', strptime_dates, decode_dates, (texts,)),
+            ('split tags', split_tags, qualified_tags, (splitelms,))]:
+        before, after = timeit(old, *args), timeit(new, *args)
+        print '%-12s %8.3fs %8.3fs %7.2fx' % (name, before, after,
+                                              before / after)
+    full, skipped = timeit(convert, trnelms), timeit(convert, trnelms, skip)
+    print '%-12s %8.3fs %8.3fs %7.2fx' % ('convert', full, skipped,
+                                          full / skipped)
+
+if __name__ == '__main__':
+    main()
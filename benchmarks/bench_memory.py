@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Reports the memory held per split and per transaction of a synthetic
+book.
+
+The size of an object is its own size plus the sizes of the values only it
+refers to; model objects it links to and objects shared by many of them,
+such as cached denominators, commodities and tzinfos, are not counted. To
+compare with another revision, pass the directory of its gncreports.py.
+
+Usage: bench_memory.py [transactions [path]]
+"""
+import os
+import gc
+import sys
+import resource
+import tempfile
+
+from synthbook import write_book
+
+def sizeof(obj, shared):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+        values = obj.__dict__.values()
+    else:
+        values = [getattr(obj, name, None) for cls in type(obj).__mro__
+                  for name in getattr(cls, '__slots__', ())]
+    for value in values:
+        if id(value) in shared:
+            continue
+        if isinstance(value, (tuple, list)):
+            size += sys.getsizeof(value)
+            size += sum([sys.getsizeof(v) for v in value
+                         if id(v) not in shared])
+        elif hasattr(value, '__dict__') or hasattr(value, '__slots__'):
+            size += sizeof(value, shared)
+        else:
+            size += sys.getsizeof(value)
+    return size
+
+def average(objs, shared, sample=10000):
+    step = max(1, len(objs) // sample)
+    objs = objs[::step]
+    return sum([sizeof(obj, shared) for obj in objs]) / float(len(objs))
+
+def main():
+    n = len(sys.argv) > 1 and int(sys.argv[1]) or 500000
+    path = len(sys.argv) > 2 and sys.argv[2] or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir)
+    sys.path.insert(0, path)
+    import gncreports
+
+    fd, filename = tempfile.mkstemp('.gnucash')
+    os.close(fd)
+    write_book(filename, n)
+    book = gncreports.gncopen(filename)
+    os.remove(filename)
+    gc.collect()
+
+    splits = [split for trn in book.transactions for split in trn.splits]
+    shared = set([id(obj) for obj in splits + book.transactions +
+                  book.accounts + [None]])
+    shared.update([id(denom) for denom in
+                   getattr(gncreports, '_denoms', {}).values()])
+    for trn in book.transactions[:1]:
+        shared.add(id(trn.date_posted.tzinfo))
+        shared.add(id(trn.currency))
+
+    print 'gncreports from %s' % os.path.abspath(path)
+    print '%d transactions, %d splits' % (len(book.transactions), len(splits))
+    print '%8.0f bytes per split' % average(splits, shared)
+    print '%8.0f bytes per transaction, besides its splits' % average(
+        book.transactions, shared)
+    print '%8.0f MB peak resident' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+if __name__ == '__main__':
+    main()
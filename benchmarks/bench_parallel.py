@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Compares the serial load with the parallel load of gncopen() on books of
+several sizes.
+
+Usage: bench_parallel.py [processes [transactions ...]]
+"""
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gncreports
+from synthbook import write_book
+
+def timeit(func, *args):
+    t = time.time()
+    result = func(*args)
+    return time.time() - t, result
+
+def main():
+    processes = (len(sys.argv) > 1 and int(sys.argv[1]) or
+                 multiprocessing.cpu_count())
+    sizes = [int(n) for n in sys.argv[2:]] or [10000, 50000, 200000]
+    tmpdir = tempfile.mkdtemp()
+    print '%d processes on %d cpus' % (processes, multiprocessing.cpu_count())
+    print '%12s %10s %10s %8s' % ('transactions', 'serial', 'parallel',
+                                  'speedup')
+    for n in sizes:
+        filename = os.path.join(tmpdir, 'book-%d.gnucash' % n)
+        write_book(filename, n)
+        serial, book = timeit(gncreports.gncopen, filename)
+        parallel, pbook = timeit(gncreports.gncopen, filename, processes)
+        if book.pack() != pbook.pack():
+            sys.exit('the parallel load differs from the serial load')
+        print '%12d %9.2fs %9.2fs %7.2fx' % (n, serial, parallel,
+                                           serial / parallel)
+        os.remove(filename)
+    os.rmdir(tmpdir)
+
+if __name__ == '__main__':
+    main()
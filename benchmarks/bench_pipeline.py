@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Times each stage of the report pipeline on synthetic books of several
+sizes, and the peak resident memory after it.
+
+The stages are decompressing the file, parsing the XML, building the model
+objects, linking them into the book, aggregating the statements of the
+reports page and rendering them as HTML. Parsing, building and linking run
+interleaved in one streaming pass as in Book.load(), and are told apart by
+timing the build and link of each element.
+
+Each size runs in a fresh process, so the memory figures do not carry over.
+The books are kept in a directory and written only once.
+
+Usage: bench_pipeline.py [options] [transactions ...]
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import resource
+import subprocess
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gncreports
+import gncrender
+from gncreports import etree, nstag
+from synthbook import write_book
+
+stages = ['decompress', 'parse', 'build', 'link', 'aggregate', 'render']
+
+def maxrss():
+    """Returns the peak resident memory of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+def load(book, source):
+    """Loads a book like Book.load() and returns the seconds spent building
+    and linking the model objects."""
+    booktag = nstag('gnc:book')
+    acttag = nstag('gnc:account')
+    trntag = nstag('gnc:transaction')
+    build = link = 0.0
+    depth = 0
+    bookelm = None
+    for event, elm in etree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and bookelm is None and elm.tag == booktag:
+                bookelm = elm
+            continue
+        depth -= 1
+        if bookelm is None:
+            continue
+        if elm is bookelm:
+            break
+        if depth == 2:
+            if elm.tag == trntag:
+                t = time.time()
+                trn = gncreports.Transaction(elm)
+                build += time.time() - t
+                t = time.time()
+                book._addtransaction(trn)
+                link += time.time() - t
+            elif elm.tag == acttag:
+                t = time.time()
+                act = gncreports.Account(book, elm)
+                build += time.time() - t
+                t = time.time()
+                book._addaccount(act)
+                link += time.time() - t
+            elif elm.tag == nstag('gnc:pricedb'):
+                book._loadpricedb(elm)
+            elif elm.tag == nstag('gnc:commodity'):
+                book._loadcommodity(elm)
+            bookelm.clear()
+    return build, link
+
+def measure(filename):
+    """Returns the seconds and the peak memory after each stage."""
+    results = {}
+    t = time.time()
+    data = gzip.GzipFile(filename).read()
+    results['decompress'] = [time.time() - t, maxrss()]
+
+    book = gncreports.Book()
+    t = time.time()
+    build, link = load(book, StringIO(data))
+    total = time.time() - t
+    del data
+    results['parse'] = [total - build - link, None]
+    results['build'] = [build, None]
+    results['link'] = [link, maxrss()]
+
+    t = time.time()
+    stms = [book.balance_sheet()]
+    stms.extend([stm for year, stm in book.monthly_income_stms()])
+    results['aggregate'] = [time.time() - t, maxrss()]
+
+    t = time.time()
+    out = NullWriter()
+    for stm in stms:
+        gncrender.write(stm, out)
+    results['render'] = [time.time() - t, maxrss()]
+    return results
+
+def bookfile(directory, n, options):
+    filename = os.path.join(directory, 'book-%d-%d-%d-%d-%d-%d.gnucash' % (
+        n, options.accounts, options.depth, options.splits, options.years,
+        options.commodities))
+    if not os.path.exists(filename):
+        write_book(filename, n, options.accounts, options.years,
+                   depth=options.depth, splits=options.splits,
+                   commodities=options.commodities)
+    return filename
+
+def report(results, baseline=None):
+    print '%12s %-10s %9s %9s %8s' % ('transactions', 'stage', 'seconds',
+                                      'peak MB', 'vs base')
+    for n in sorted(results, key=int):
+        for stage in stages:
+            seconds, rss = results[n][stage]
+            line = '%12s %-10s %9.3f %9s' % (n, stage, seconds,
+                                             rss and '%.0f' % rss or '')
+            base = baseline and baseline.get(n, {}).get(stage)
+            if base and base[0] > 0:
+                line += ' %7.2fx' % (seconds / base[0])
+            print line
+
+def main():
+    from optparse import OptionParser, SUPPRESS_HELP
+
+    parser = OptionParser(usage='Usage: %prog [options] [transactions ...]')
+    parser.add_option('--dir', default='/tmp/gncbench',
+                      help='keep the books in DIR [%default]')
+    parser.add_option('--accounts', type='int', default=5)
+    parser.add_option('--depth', type='int', default=2)
+    parser.add_option('--splits', type='int', default=2)
+    parser.add_option('--years', type='int', default=10)
+    parser.add_option('--commodities', type='int', default=2)
+    parser.add_option('--save', metavar='FILE',
+                      help='save the results as JSON to FILE')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='compare with the results saved in FILE')
+    parser.add_option('--one', help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.one:
+        print json.dumps(measure(options.one))
+        return
+
+    sizes = [int(n) for n in args] or [1000, 10000, 100000, 1000000]
+    if not os.path.isdir(options.dir):
+        os.makedirs(options.dir)
+    results = {}
+    for n in sizes:
+        filename = bookfile(options.dir, n, options)
+        output = subprocess.check_output([sys.executable,
+                                          os.path.abspath(__file__),
+                                          '--one', filename])
+        results[str(n)] = json.loads(output)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'options': options.__dict__, 'results': results}, f,
+                      indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Compares rendering the reports page into one string with streaming it
+through the renderers, on a multi-year synthetic book.
+
+The time to the first byte is when the first chunk could be sent, and the
+largest buffer is the longest string held at once.
+
+Usage: bench_render.py [transactions [years]]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gncreports
+import gncrender
+from synthbook import write_book
+
+def page(book):
+    """Yields the statements of the reports page as the handler makes
+    them."""
+    yield book.balance_sheet()
+    for year, stm in book.monthly_income_stms():
+        yield stm
+
+def joined(book):
+    t = time.time()
+    html = ''.join([stm.tohtml() for stm in page(book)])
+    return time.time() - t, time.time() - t, len(html)
+
+def streamed(book):
+    t = time.time()
+    first = None
+    largest = 0
+    for stm in page(book):
+        for chunk in gncrender.render(stm):
+            if first is None:
+                first = time.time() - t
+            largest = max(largest, len(chunk))
+    return first, time.time() - t, largest
+
+def main():
+    n = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    years = len(sys.argv) > 2 and int(sys.argv[2]) or 20
+    fd, filename = tempfile.mkstemp('.gnucash')
+    os.close(fd)
+    write_book(filename, n, accounts=20, years=years)
+    book = gncreports.gncopen(filename)
+    os.remove(filename)
+
+    print '%d transactions over %d years' % (n, years)
+    print '%-8s %10s %10s %14s' % ('', 'first', 'total', 'largest')
+    for name, func in [('joined', joined), ('streamed', streamed)]:
+        book.invalidate()
+        first, total, largest = func(book)
+        print '%-8s %9.3fs %9.3fs %8d bytes' % (name, first, total, largest)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""Writes synthetic GnuCash books for the benchmarks.
+
+The books are made from a seeded random generator, so the same options
+always give the same file.
+
+Usage: synthbook.py [options] <filename>
+"""
+import os
+import sys
+import gzip
+import random
+import tempfile
+from datetime import date, timedelta
+
+namespaces = ['gnc', 'act', 'book', 'cd', 'cmdty', 'price', 'slot', 'split',
+              'trn', 'ts']
+
+types = [('ASSET', 'Assets'), ('LIABILITY', 'Liabilities'),
+         ('EQUITY', 'Equity'), ('INCOME', 'Income'), ('EXPENSE', 'Expenses')]
+
+currencies = ['EUR', 'GBP', 'JPY', 'CHF', 'CAD', 'AUD', 'SEK', 'NOK', 'DKK',
+              'NZD', 'KRW', 'CNY', 'INR', 'BRL', 'MXN', 'ZAR']
+
+def write_book(filename, transactions=1000, accounts=5, years=5, seed=1,
+               first=2007, depth=1, splits=2, commodities=0, compress=True):
+    """Writes a gzipped book with the given number of transactions posted
+    over a number of years from the first one.
+
+    Each top level account has a tree of accounts below it, depth levels
+    deep with accounts children per account, and the transactions post
+    to the leaves. A transaction has one asset split against splits - 1
+    splits of another type. With commodities, that many foreign currencies
+    get an asset account each, monthly prices in the price database, and a
+    tenth of the transactions. Without compress, the XML is not gzipped.
+    """
+    rand = random.Random(seed)
+    guid = lambda: '%032x' % rand.getrandbits(128)
+    if compress:
+        out = gzip.GzipFile(filename, 'wb')
+    else:
+        out = open(filename, 'wb')
+    w = out.write
+
+    w('<?xml version="1.0" encoding="utf-8" ?>\n<gnc-v2\n')
+    for ns in namespaces:
+        w('     xmlns:%s="http://www.gnucash.org/XML/%s"\n' % (ns, ns))
+    w('>\n<gnc:count-data cd:type="book">1</gnc:count-data>\n')
+    w('<gnc:book version="2.0.0">\n')
+    w('<book:id type="guid">%s</book:id>\n' % guid())
+    foreign = currencies[:commodities]
+    for cmdty in ['USD'] + foreign:
+        w('<gnc:commodity version="2.0.0">\n'
+          '  <cmdty:space>ISO4217</cmdty:space>\n'
+          '  <cmdty:id>%s</cmdty:id>\n'
+          '  <cmdty:quote_source>currency</cmdty:quote_source>\n'
+          '</gnc:commodity>\n' % cmdty)
+
+    # A random walk of monthly prices of each foreign currency in dollars.
+    rates = {}
+    if foreign:
+        w('<gnc:pricedb version="1">\n')
+    for cmdty in foreign:
+        rate = rand.randint(5000, 20000)
+        for month in range(years * 12 + 1):
+            when = date(first + month // 12, month % 12 + 1, 1)
+            rates[(cmdty, when)] = rate
+            w('<price>\n'
+              '  <price:id type="guid">%s</price:id>\n'
+              '  <price:commodity>\n'
+              '    <cmdty:space>ISO4217</cmdty:space>\n'
+              '    <cmdty:id>%s</cmdty:id>\n'
+              '  </price:commodity>\n'
+              '  <price:currency>\n'
+              '    <cmdty:space>ISO4217</cmdty:space>\n'
+              '    <cmdty:id>USD</cmdty:id>\n'
+              '  </price:currency>\n'
+              '  <price:time>\n'
+              '    <ts:date>%s 00:00:00 -0500</ts:date>\n'
+              '  </price:time>\n'
+              '  <price:source>user:price</price:source>\n'
+              '  <price:type>last</price:type>\n'
+              '  <price:value>%d/10000</price:value>\n'
+              '</price>\n' % (guid(), cmdty, when, rate))
+            rate = max(100, rate + rand.randint(-500, 500))
+    if foreign:
+        w('</gnc:pricedb>\n')
+
+    def account(name, type, parent=None, cmdty='USD'):
+        id = guid()
+        w('<gnc:account version="2.0.0">\n'
+          '  <act:name>%s</act:name>\n'
+          '  <act:id type="guid">%s</act:id>\n'
+          '  <act:type>%s</act:type>\n' % (name, id, type))
+        if parent is not None:
+            w('  <act:commodity>\n'
+              '    <cmdty:space>ISO4217</cmdty:space>\n'
+              '    <cmdty:id>%s</cmdty:id>\n'
+              '  </act:commodity>\n'
+              '  <act:commodity-scu>100</act:commodity-scu>\n'
+              '  <act:parent type="guid">%s</act:parent>\n' % (cmdty, parent))
+        w('</gnc:account>\n')
+        return id
+
+    def subtree(name, type, parent, level):
+        if level == depth:
+            return [account(name, type, parent)]
+        id = account(name, type, parent)
+        ids = []
+        for i in range(accounts):
+            ids.extend(subtree('%s.%d' % (name, i), type, id, level + 1))
+        return ids
+
+    root = account('Root Account', 'ROOT')
+    leaves = {}
+    tops = {}
+    for type, name in types:
+        top = tops[type] = account(name, type, root)
+        leaves[type] = []
+        for i in range(accounts):
+            leaves[type].extend(subtree('%s %d' % (name, i), type, top, 1))
+    cash = dict((cmdty, account('Cash %s' % cmdty, 'BANK', tops['ASSET'],
+                                cmdty))
+                for cmdty in foreign)
+
+    start = date(first, 1, 1)
+    days = (date(first + years, 1, 1) - start).days
+    for i in xrange(transactions):
+        posted = start + timedelta(rand.randint(0, days - 1))
+        type = rand.choice(['INCOME', 'EXPENSE', 'EXPENSE', 'LIABILITY'])
+        amounts = [rand.randint(1, 100000) for j in range(splits - 1)]
+        asset = rand.choice(leaves['ASSET'])
+        others = [rand.choice(leaves[type]) for amount in amounts]
+        quantity = None
+        if foreign and rand.random() < 0.1:
+            cmdty = rand.choice(foreign)
+            asset = cash[cmdty]
+            rate = rates[(cmdty, date(posted.year, posted.month, 1))]
+            quantity = sum(amounts) * 10000 // rate
+        total = sum(amounts)
+        if type == 'INCOME':
+            rows = [(asset, total, quantity)]
+            rows.extend([(other, -amount, None)
+                         for other, amount in zip(others, amounts)])
+        else:
+            rows = [(other, amount, None)
+                    for other, amount in zip(others, amounts)]
+            rows.append((asset, -total, quantity and -quantity))
+        w('<gnc:transaction version="2.0.0">\n'
+          '  <trn:id type="guid">%s</trn:id>\n'
+          '  <trn:currency>\n'
+          '    <cmdty:space>ISO4217</cmdty:space>\n'
+          '    <cmdty:id>USD</cmdty:id>\n'
+          '  </trn:currency>\n'
+          '  <trn:date-posted>\n'
+          '    <ts:date>%s 00:00:00 -0500</ts:date>\n'
+          '  </trn:date-posted>\n'
+          '  <trn:date-entered>\n'
+          '    <ts:date>%s 12:34:56 -0500</ts:date>\n'
+          '  </trn:date-entered>\n'
+          '  <trn:description>Transaction %d</trn:description>\n'
+          '  <trn:splits>\n' % (guid(), posted, posted, i))
+        for act, value, quantity in rows:
+            if quantity is None:
+                quantity = value
+            w('    <trn:split>\n'
+              '      <split:id type="guid">%s</split:id>\n'
+              '      <split:reconciled-state>n</split:reconciled-state>\n'
+              '      <split:value>%d/100</split:value>\n'
+              '      <split:quantity>%d/100</split:quantity>\n'
+              '      <split:account type="guid">%s</split:account>\n'
+              '    </trn:split>\n' % (guid(), value, quantity, act))
+        w('  </trn:splits>\n</gnc:transaction>\n')
+
+    w('</gnc:book>\n</gnc-v2>\n')
+    out.close()
+
+def write_sqlite(filename, *args, **kwargs):
+    """Writes the book of write_book() as a SQLite database."""
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+    import gncreports
+    import gncsqlite
+
+    fd, xmlname = tempfile.mkstemp(suffix='.gnucash')
+    os.close(fd)
+    try:
+        write_book(xmlname, *args, **kwargs)
+        gncsqlite.save(gncreports.gncopen(xmlname), filename)
+    finally:
+        os.remove(xmlname)
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='Usage: %prog [options] <filename>')
+    parser.add_option('-n', '--transactions', type='int', default=1000)
+    parser.add_option('--accounts', type='int', default=5,
+                      help='children of each account [%default]')
+    parser.add_option('--depth', type='int', default=1,
+                      help='levels below the top level accounts [%default]')
+    parser.add_option('--splits', type='int', default=2,
+                      help='splits per transaction [%default]')
+    parser.add_option('--years', type='int', default=5)
+    parser.add_option('--first', type='int', default=2007,
+                      help='the first year [%default]')
+    parser.add_option('--commodities', type='int', default=0,
+                      help='foreign currencies, at most %d' % len(currencies))
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--format', default='gzip',
+                      choices=['gzip', 'xml', 'sqlite'],
+                      help='write gzip or plain xml or sqlite [%default]')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('no filename')
+    write = write_book
+    kwargs = {}
+    if options.format == 'sqlite':
+        write = write_sqlite
+    elif options.format == 'xml':
+        kwargs['compress'] = False
+    write(args[0], options.transactions, options.accounts, options.years,
+          options.seed, options.first, options.depth, options.splits,
+          options.commodities, **kwargs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Makes many reports over many books in one run.
+
+A batch is described by a JSON spec of books and the reports to make from
+each of them:
+
+    {"books": [
+        {"file": "home.gnucash",
+         "currency": "USD",
+         "reports": [
+            {"report": "income", "year": 2012, "month": 3},
+            {"report": "monthly", "year": 2012, "format": "html"},
+            {"report": "balance", "view": "monthly", "depth": 2},
+            {"report": "ledger", "account": "Assets:Checking",
+             "start": "2012-01-01", "end": "2012-12-31",
+             "output": "checking-2012.csv"}]}]}
+
+The reports are:
+
+  income    an income statement over a month, or else a year, or else from
+            start to end
+  monthly   a monthly income statement of a year, the last one by default
+  balance   a balance sheet by view, annual by default
+  ledger    the ledger of an account from start to end
+
+A report is written as csv, html or json by its format, csv by default, to
+its output file, or else to a file named after the book and the report,
+with the depth and currency given on the report, in the output directory.
+Depth and currency may be given on the report or on its book.
+
+Each book is loaded once and all its reports are made from that load, and
+the books are made in a pool of worker processes.
+
+Usage: gncbatch.py [options] <spec>
+"""
+import os
+import sys
+import json
+import time
+import traceback
+from datetime import date
+
+import gncprofile
+import gncreports
+import gncrender
+
+def parse_date(text):
+    """Returns the date of a YYYY-MM-DD string."""
+    return date(*[int(part) for part in text.split('-')])
+
+def make_report(book, spec, defaults):
+    """Returns the statement described by a report spec."""
+    kind = spec['report']
+    depth = spec.get('depth', defaults.get('depth'))
+    currency = spec.get('currency', defaults.get('currency'))
+    start = date.min
+    end = date.max
+    if 'start' in spec:
+        start = parse_date(spec['start'])
+    if 'end' in spec:
+        end = parse_date(spec['end'])
+    if kind == 'income':
+        if 'month' in spec:
+            start = gncreports.first_date_of_month(spec['year'],
+                                                   spec['month'])
+            end = gncreports.last_date_of_month(spec['year'], spec['month'])
+        elif 'year' in spec:
+            start = date(spec['year'], 1, 1)
+            end = date(spec['year'], 12, 31)
+        return book.income_stm(start, end, depth, currency)
+    elif kind == 'monthly':
+        return book.monthly_income_stm(spec.get('year', date.max.year),
+                                       depth, currency)
+    elif kind == 'balance':
+        return book.balance_sheet(spec.get('view', 'annual'), depth,
+                                  currency=currency)
+    elif kind == 'ledger':
+        ledger = book.account_ledger(spec['account'], start, end)
+        if ledger is None:
+            raise ValueError("no account '%s'" % spec['account'])
+        return ledger
+    raise ValueError("unknown report '%s'" % kind)
+
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode(sys.getfilesystemencoding() or 'utf-8')
+    return unicode(value)
+
+def output_name(bookspec, spec, outdir):
+    """Returns the file to write a report to, in the filesystem encoding."""
+    if 'output' in spec:
+        name = _unicode(spec['output'])
+    else:
+        parts = [os.path.splitext(os.path.basename(
+                     _unicode(bookspec['file'])))[0],
+                 _unicode(spec['report'])]
+        for key in ('account', 'view', 'year', 'month', 'start', 'end',
+                    'currency'):
+            if key in spec:
+                parts.append(_unicode(spec[key]).replace(u':', u'_'))
+        if spec.get('depth') is not None:
+            parts.append(u'depth%d' % spec['depth'])
+        name = u'%s.%s' % (u'-'.join(parts), spec.get('format', 'csv'))
+    return os.path.join(_unicode(outdir), name).encode(
+        sys.getfilesystemencoding() or 'utf-8')
+
+def run_book(args):
+    """Loads a book and writes all its reports.
+
+    Returns a dict of the book, the seconds spent loading it, the file and
+    seconds of each report, the stages profiled and the error, if any.
+    """
+    bookspec, outdir, cachedir = args
+    filename = bookspec['file']
+    if isinstance(filename, unicode):
+        filename = filename.encode(sys.getfilesystemencoding() or 'utf-8')
+    result = {'file': filename, 'reports': [], 'error': None}
+    profiler = gncprofile.start()
+    try:
+        reports = bookspec.get('reports', [])
+        outputs = [output_name(bookspec, spec, outdir) for spec in reports]
+        for i, output in enumerate(outputs):
+            if output in outputs[:i]:
+                raise ValueError("two reports write '%s'" % output)
+        t = time.time()
+        if cachedir:
+            import gnccache
+            cache = gnccache.BookCache(gnccache.DirectoryStore(cachedir))
+            book = cache.open(filename)
+        else:
+            book = gncreports.gncopen(filename)
+        result['load'] = time.time() - t
+        for spec, output in zip(reports, outputs):
+            t = time.time()
+            stm = make_report(book, spec, bookspec)
+            with open(output, 'wb') as f:
+                gncrender.write(stm, f, spec.get('format', 'csv'))
+            result['reports'].append((output, time.time() - t))
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        gncprofile.stop()
+    result['profile'] = profiler.todict()
+    return result
+
+def run(spec, outdir='.', processes=None, cachedir=None):
+    """Makes the reports of the books of a spec, the books in a pool of
+    processes, and yields the result of each book as it is done, see
+    run_book()."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = [(bookspec, outdir, cachedir) for bookspec in spec['books']]
+    if processes == 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield run_book(job)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(run_book, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def summary(results, seconds):
+    """Returns the timing summary of a batch."""
+    s = ['%-40s %9s %9s %8s' % ('book', 'load', 'reports', 'count')]
+    nreports = 0
+    for result in sorted(results, key=lambda r: r['file']):
+        reports = sum([t for output, t in result['reports']])
+        nreports += len(result['reports'])
+        s.append('%-40s %9.3f %9.3f %8d%s' % (
+            result['file'], result.get('load', 0.0), reports,
+            len(result['reports']), result['error'] and '  FAILED' or ''))
+    s.append('%d books, %d reports in %.3fs' % (len(results), nreports,
+                                                seconds))
+    return '\n'.join(s)
+
+def batch(filename, outdir='.', processes=None, cachedir=None):
+    """Makes the reports of a spec file, writes the errors and the timing
+    summary to stderr and returns whether all the books were made."""
+    with open(filename) as f:
+        spec = json.load(f)
+    t = time.time()
+    results = []
+    for result in run(spec, outdir, processes, cachedir):
+        if result['error']:
+            sys.stderr.write("cannot make the reports of '%s'\n%s" % (
+                result['file'], result['error']))
+        results.append(result)
+    sys.stderr.write(summary(results, time.time() - t) + '\n')
+    return not [result for result in results if result['error']]
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='Usage: %prog [options] <spec>')
+    parser.add_option('-o', '--outdir', default='.', metavar='DIR',
+                      help='write the reports to DIR [%default]')
+    parser.add_option('--processes', type='int', metavar='N',
+                      help='make the books in N worker processes')
+    parser.add_option('--cache', metavar='DIR',
+                      help='keep snapshots of parsed books in DIR')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('no spec')
+    if not batch(args[0], options.outdir, options.processes, options.cache):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""A cache of parsed GnuCash books.
+
+Books are keyed by the SHA-1 hash of the compressed file and kept as
+compact binary snapshots, so opening a file seen before skips the XML
+parsing altogether.
+"""
+import os
+import zlib
+import hashlib
+import cPickle
+from cStringIO import StringIO
+
+import gncreports
+
+# Bumped whenever the layout of Book.pack() changes.
+SNAPSHOT_VERSION = 4
+_magic = 'GNCSNAP%d\n' % SNAPSHOT_VERSION
+
+def dumps(book):
+    """Returns the snapshot of a book."""
+    return _magic + zlib.compress(cPickle.dumps(book.pack(), 2), 1)
+
+def loads(snapshot):
+    """Returns the book of a snapshot, or None if it is out of date."""
+    if not snapshot.startswith(_magic):
+        return None
+    book = gncreports.Book()
+    book.unpack(cPickle.loads(zlib.decompress(snapshot[len(_magic):])))
+    return book
+
+class DirectoryStore(object):
+    """Keeps snapshots as files in a local directory.
+
+    Reading a snapshot marks it as recently used, and the least recently
+    used ones are removed once the directory grows past maxsize bytes.
+    """
+    suffix = '.snap'
+
+    def __init__(self, path, maxsize=256 * 1024 * 1024):
+        self.path = path
+        self.maxsize = maxsize
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        filename = self._filename(key)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        os.rename(tmpname, filename)
+        self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def keys(self):
+        return [name[:-len(self.suffix)] for name in os.listdir(self.path)
+                if name.endswith(self.suffix)]
+
+    def clear(self):
+        for key in self.keys():
+            self.delete(key)
+
+    def size(self):
+        return sum([size for mtime, size, key in self._entries()])
+
+    def _entries(self):
+        entries = []
+        for key in self.keys():
+            try:
+                st = os.stat(self._filename(key))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, key))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used snapshots above maxsize."""
+        entries = sorted(self._entries())
+        total = sum([size for mtime, size, key in entries])
+        while entries and total > self.maxsize:
+            mtime, size, key = entries.pop(0)
+            self.delete(key)
+            total -= size
+
+class BookCache(object):
+    """A cache of parsed books on top of a snapshot store."""
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data):
+        """Returns the cache key of the contents of a GnuCash file."""
+        return hashlib.sha1(data).hexdigest()
+
+    def open(self, source):
+        """Open a GnuCash file like gncreports.gncopen(), parsing it only if
+        the same contents were not seen before."""
+        data = _read(source)
+        key = self.key(data)
+        snapshot = self.store.get(key)
+        book = None
+        if snapshot is not None:
+            book = loads(snapshot)
+        if book is not None:
+            self.hits += 1
+            return book
+        self.misses += 1
+        book = gncreports.gncopen(StringIO(data))
+        if not hasattr(book, 'close'):
+            self.store.put(key, dumps(book))
+            return book
+        # A SQLite book is read from a temporary copy, which is removed
+        # once the snapshot is taken, and the book of the snapshot is
+        # returned as on a hit.
+        try:
+            snapshot = dumps(book)
+        finally:
+            book.close()
+        self.store.put(key, snapshot)
+        return loads(snapshot)
+
+    def invalidate(self, source=None, key=None):
+        """Drops the snapshot of a GnuCash file or of a cache key."""
+        if key is None:
+            key = self.key(_read(source))
+        self.store.delete(key)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.store.keys())}
+
+def _read(source):
+    if type(source) is str:
+        with open(source, 'rb') as f:
+            return f.read()
+    return source.read()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Exports the accounts, transactions and splits of a book to a columnar
+file for analytics tools.
+
+The file is an 8-byte magic string, the length of a JSON header as a
+little-endian unsigned 64-bit integer, the header, and then the columns,
+each a run of little-endian values starting at a multiple of 8 bytes. The
+header gives the type, offset and length of each column, so the columns
+can be memory-mapped and read in place:
+
+  act_id, act_name, act_commodity      strings of the accounts
+  act_type                             int8 index into the header's types
+  act_parent                           int32 row of the parent, or -1
+  trn_id, trn_description              strings of the transactions
+  trn_date                             int32 days since 1970-01-01
+  trn_time                             int64 seconds since the epoch
+  split_transaction                    int32 row of the transaction
+  split_account                        int32 row of the account
+  split_value_num, split_value_denom   int64 value of the split
+  split_quantity_num,                  int64 quantity of the split
+  split_quantity_denom
+
+The transactions are in date order and their splits follow them, so both
+trn_date and the split rows are sorted by date. A string column is stored
+as an int64 column name.offsets of n + 1 offsets into a uint8 column
+name.data of UTF-8 text.
+
+    gncexport.export(book, 'book.gnccol')
+    cols = gncexport.ColumnFile('book.gnccol')
+    cols['split_value_num']     # a NumPy array over the mapped file
+
+Usage: gncexport.py <gnucash file> <output file>
+"""
+import sys
+import json
+import mmap
+import array
+import struct
+import calendar
+from datetime import date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import gncreports
+
+MAGIC = 'GNCCOL1\n'
+_epoch = date(1970, 1, 1).toordinal()
+
+# The typecodes of the array module with the size of each column type.
+_typecodes = {}
+for _type, _size in [('i1', 1), ('u1', 1), ('i4', 4), ('i8', 8)]:
+    for _code in _type[0] == 'u' and 'B' or 'bhilq':
+        try:
+            if array.array(_code).itemsize == _size:
+                _typecodes[_type] = _code
+                break
+        except ValueError:
+            pass
+
+def _strings(texts):
+    """Returns the offsets and the UTF-8 data of a string column."""
+    offsets = [0]
+    data = []
+    size = 0
+    for text in texts:
+        if text is None:
+            text = ''
+        elif isinstance(text, unicode):
+            text = text.encode('utf-8')
+        data.append(text)
+        size += len(text)
+        offsets.append(size)
+    return offsets, ''.join(data)
+
+def columns(book):
+    """Returns the header and the columns of a book as a dict of the name
+    of each column to its type and values."""
+    actrow = dict((act.id, i) for i, act in enumerate(book.accounts))
+    types = sorted(set([act.type for act in book.accounts]))
+    typeindex = dict((type, i) for i, type in enumerate(types))
+    cols = {}
+
+    def strings(name, texts):
+        offsets, data = _strings(texts)
+        cols[name + '.offsets'] = ('i8', offsets)
+        cols[name + '.data'] = ('u1', data)
+
+    strings('act_id', [act.id for act in book.accounts])
+    strings('act_name', [act.name for act in book.accounts])
+    strings('act_commodity', [act.commodity and act.commodity.id
+                              for act in book.accounts])
+    cols['act_type'] = ('i1', [typeindex[act.type] for act in book.accounts])
+    cols['act_parent'] = ('i4', [actrow.get(act.pid, -1)
+                                 for act in book.accounts])
+
+    dates, trns = book.timeline()
+    strings('trn_id', [trn.id for trn in trns])
+    strings('trn_description', [trn.description for trn in trns])
+    cols['trn_date'] = ('i4', [d.toordinal() - _epoch for d in dates])
+    cols['trn_time'] = ('i8', [calendar.timegm(trn.date_posted.utctimetuple())
+                               for trn in trns])
+
+    rows, acts, nums, denoms, qnums, qdenoms = [], [], [], [], [], []
+    for i, trn in enumerate(trns):
+        for split in trn.splits:
+            rows.append(i)
+            acts.append(actrow[split.accountid])
+            nums.append(split.value_num)
+            denoms.append(split.value_denom)
+            qnums.append(split.quantity_num)
+            qdenoms.append(split.quantity_denom)
+    cols['split_transaction'] = ('i4', rows)
+    cols['split_account'] = ('i4', acts)
+    cols['split_value_num'] = ('i8', nums)
+    cols['split_value_denom'] = ('i8', denoms)
+    cols['split_quantity_num'] = ('i8', qnums)
+    cols['split_quantity_denom'] = ('i8', qdenoms)
+
+    header = {
+        'book': book.id,
+        'commodity': book.commodity and book.commodity.id,
+        'types': types,
+        'accounts': len(book.accounts),
+        'transactions': len(trns),
+        'splits': len(rows),
+    }
+    return header, cols
+
+def export(book, filename):
+    """Writes the columns of a book to a file."""
+    header, cols = columns(book)
+    blobs = []
+    offset = 0
+    header['columns'] = {}
+    for name in sorted(cols):
+        type, values = cols[name]
+        if isinstance(values, str):
+            data = values
+        else:
+            values = array.array(_typecodes[type], values)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            data = values.tostring()
+        header['columns'][name] = {'type': type, 'offset': offset,
+                                   'length': len(data) // int(type[1])}
+        blobs.append(data)
+        offset += len(data)
+        pad = -offset % 8
+        blobs.append('\0' * pad)
+        offset += pad
+
+    text = json.dumps(header, sort_keys=True)
+    text += ' ' * (-(len(MAGIC) + 8 + len(text)) % 8)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(text)))
+        f.write(text)
+        for data in blobs:
+            f.write(data)
+
+class ColumnFile(object):
+    """A columnar file mapped into memory.
+
+    Indexing by the name of a column returns its values as a NumPy array
+    over the mapped file, or as an array.array copy without NumPy. Column
+    offsets in the header are relative to the end of the header.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a columnar book: '%s'" % filename)
+        size, = struct.unpack('<Q', self._map[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8
+        self.header = json.loads(self._map[start:start + size])
+        self._base = start + size
+
+    def __contains__(self, name):
+        return name in self.header['columns']
+
+    def __getitem__(self, name):
+        col = self.header['columns'][name]
+        type = col['type']
+        offset = self._base + col['offset']
+        if numpy is not None:
+            return numpy.frombuffer(self._map, '<' + type, col['length'],
+                                    offset)
+        values = array.array(_typecodes[type])
+        values.fromstring(self._map[offset:offset +
+                                    col['length'] * int(type[1])])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def strings(self, name):
+        """Returns the strings of a string column as a lazy sequence."""
+        return StringColumn(self, name)
+
+    def dates(self, name='trn_date'):
+        """Returns the dates of an integer date column."""
+        return [date.fromordinal(d + _epoch) for d in self[name]]
+
+    def close(self):
+        self._map.close()
+
+class StringColumn(object):
+    """The strings of a string column, decoded as they are read."""
+    def __init__(self, colfile, name):
+        self.offsets = colfile[name + '.offsets']
+        col = colfile.header['columns'][name + '.data']
+        self._map = colfile._map
+        self._base = colfile._base + col['offset']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start = self._base + int(self.offsets[i])
+        end = self._base + int(self.offsets[i + 1])
+        return self._map[start:end].decode('utf-8')
+
+def main():
+    if len(sys.argv) != 3:
+        sys.stderr.write('Usage: %s <gnucash file> <output file>\n' %
+                         sys.argv[0])
+        sys.exit(2)
+    export(gncreports.gncopen(sys.argv[1]), sys.argv[2])
+
+if __name__ == '__main__':
+    main()
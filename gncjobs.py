@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Runs report jobs in the background and keeps their results.
+
+A job runner takes a function and its arguments, returns a job id right
+away and runs the function later. Its status and, once done, its result or
+error are looked up by the id. A job may be given a key, such as the blob
+it reads, and submitting the same key again returns the job already made
+for it, so a repeat view is served from the stored result.
+
+LocalJobRunner runs jobs on worker threads in this process and keeps them
+in memory, which is enough to run and test the whole flow without App
+Engine services. Its jobs are seen only by the process that made them, and
+on App Engine gncqueue.TaskQueueJobRunner keeps them in the Datastore.
+"""
+import time
+import uuid
+import logging
+import threading
+import traceback
+from Queue import Queue
+from collections import OrderedDict
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+class Job(object):
+    """A job and its outcome."""
+    def __init__(self, func, args, kwargs, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self._done = threading.Event()
+
+    def run(self):
+        self.state = RUNNING
+        self.started = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.state = DONE
+        except Exception, e:
+            logging.error('job %s failed\n%s', self.id, traceback.format_exc())
+            self.error = str(e) or e.__class__.__name__
+            self.state = FAILED
+        self.finished = time.time()
+        self.func = self.args = self.kwargs = None
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish and tells whether it did."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def status(self):
+        """Returns the state of the job as a dict of plain values."""
+        status = {'id': self.id, 'state': self.state,
+                  'created': self.created}
+        if self.started is not None:
+            status['started'] = self.started
+        if self.finished is not None:
+            status['seconds'] = self.finished - self.started
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+class LocalJobRunner(object):
+    """Runs jobs on a pool of worker threads in this process.
+
+    Jobs are kept in memory, and the oldest finished ones are dropped once
+    there are more than maxjobs. The workers are started by the first job.
+    """
+    def __init__(self, workers=2, maxjobs=100):
+        self.workers = workers
+        self.maxjobs = maxjobs
+        self._jobs = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._threads = []
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='gncjobs-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) and returns the id of its job.
+
+        With a key keyword argument, a job already made for the same key
+        is returned instead, unless it failed.
+        """
+        key = kwargs.pop('key', None)
+        with self._lock:
+            job = self._jobs.get(self._keys.get(key))
+            if job is not None and job.state != FAILED:
+                return job.id
+            job = Job(func, args, kwargs, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._keys[key] = job.id
+            self._evict()
+            if not self._threads:
+                self._start()
+        self._queue.put(job)
+        return job.id
+
+    def get(self, id):
+        """Returns a job by id, or None."""
+        with self._lock:
+            return self._jobs.get(id)
+
+    def status(self, id):
+        job = self.get(id)
+        return job and job.status()
+
+    def result(self, id):
+        """Returns the result of a finished job, or None."""
+        job = self.get(id)
+        return job and job.result
+
+    def wait(self, id, timeout=None):
+        job = self.get(id)
+        return job is not None and job.wait(timeout)
+
+    def shutdown(self):
+        """Stops the workers after the jobs queued so far."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def _evict(self):
+        finished = [job for job in self._jobs.values()
+                    if job.state in (DONE, FAILED)]
+        while len(self._jobs) > self.maxjobs and finished:
+            job = finished.pop(0)
+            del self._jobs[job.id]
+            if self._keys.get(job.key) == job.id:
+                del self._keys[job.key]
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Timers and counters for the stages of loading books and making reports.
+
+Profiling is off unless a Profiler is started on the current thread. The
+hooks in gncreports look the profiler up once per stage and skip all the
+bookkeeping while it is None, so they cost next to nothing when off.
+
+    profiler = gncprofile.start()
+    book = gncreports.gncopen('book.gnucash')
+    book.monthly_income_stms()
+    gncprofile.stop()
+    print profiler.tojson()
+"""
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+class Profiler(object):
+    """Collects the seconds spent in named stages and named counts."""
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+
+    def add(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - t)
+
+    def todict(self):
+        return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+    def tojson(self):
+        return json.dumps(self.todict(), sort_keys=True)
+
+    def summary(self):
+        """Returns the timers and counters on one line."""
+        buf = ['%s=%.3fs' % item for item in sorted(self.timers.items())]
+        buf.extend(['%s=%d' % item for item in sorted(self.counters.items())])
+        return ' '.join(buf)
+
+    def __str__(self):
+        s = ['%-24s %10.3fs' % item for item in sorted(self.timers.items())]
+        s.extend(['%-24s %10d' % item
+                  for item in sorted(self.counters.items())])
+        return '\n'.join(s)
+
+def current():
+    """Returns the profiler of the current thread, or None."""
+    return getattr(_local, 'profiler', None)
+
+def start(profiler=None):
+    """Starts profiling the current thread and returns the profiler."""
+    if profiler is None:
+        profiler = Profiler()
+    _local.profiler = profiler
+    return profiler
+
+def stop():
+    """Stops profiling the current thread and returns the profiler."""
+    profiler = current()
+    _local.profiler = None
+    return profiler
+
+@contextmanager
+def timer(name):
+    """Times a stage on the profiler of the current thread, if any."""
+    profiler = current()
+    if profiler is None:
+        yield
+    else:
+        with profiler.timer(name):
+            yield
+
+def count(name, n=1):
+    """Adds to a counter on the profiler of the current thread, if any."""
+    profiler = current()
+    if profiler is not None:
+        profiler.count(name, n)
+
+def memory():
+    """Returns the resident memory of the process in MB, or the peak where
+    the current one cannot be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1048576.0
+    except (IOError, OSError):
+        return peak_memory()
+
+def peak_memory():
+    """Returns the peak resident memory of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class TimedReader(object):
+    """A file-like object that times the reads of another one, such as a
+    GzipFile, as a stage of a profiler."""
+    def __init__(self, source, profiler, name):
+        self.source = source
+        self.profiler = profiler
+        self.name = name
+
+    def read(self, size=-1):
+        t = time.time()
+        data = self.source.read(size)
+        self.profiler.add(self.name, time.time() - t)
+        return data
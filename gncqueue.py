@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Runs report jobs on the App Engine Task Queue.
+
+TaskQueueJobRunner has the interface of gncjobs.LocalJobRunner, but a job
+is a Datastore entity and runs in a deferred task, so any instance can
+serve its status and result, and it is not lost when the instance that
+took the upload goes away. The result is pickled, compressed and kept in
+chunks under the job, since an entity holds at most 1 MB.
+
+A job with a key gets an id made from the key, so submitting the same key
+from any instance finds the job already made for it.
+
+The deferred builtin must be on in app.yaml.
+"""
+import time
+import uuid
+import zlib
+import hashlib
+import logging
+import cPickle
+import traceback
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from gncjobs import QUEUED, RUNNING, DONE, FAILED
+
+# The bytes of a result kept in each chunk entity.
+CHUNK_SIZE = 900 * 1024
+
+class JobChunk(db.Model):
+    """A chunk of the result of a job, a child of the job."""
+    data = db.BlobProperty()
+
+class StoredJob(db.Model):
+    """A job and its outcome, keyed by the id of the job."""
+    key_ = db.StringProperty(name='key', indexed=False)
+    state = db.StringProperty(indexed=False)
+    error = db.TextProperty()
+    created = db.FloatProperty(indexed=False)
+    started = db.FloatProperty(indexed=False)
+    finished = db.FloatProperty(indexed=False)
+    chunks = db.IntegerProperty(indexed=False, default=0)
+
+    @property
+    def id(self):
+        return self.key().name()
+
+    @property
+    def result(self):
+        """The result of the job once it is done, or None."""
+        if self.state != DONE:
+            return None
+        keys = [db.Key.from_path('JobChunk', '%06d' % i, parent=self.key())
+                for i in range(self.chunks)]
+        data = ''.join([chunk.data for chunk in db.get(keys)])
+        return cPickle.loads(zlib.decompress(data))
+
+    def status(self):
+        """Returns the state of the job as a dict of plain values."""
+        status = {'id': self.id, 'state': self.state,
+                  'created': self.created}
+        if self.started is not None:
+            status['started'] = self.started
+        if self.finished is not None:
+            status['seconds'] = self.finished - self.started
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+def _run(id, func, args, kwargs):
+    """Runs a job in its task and stores its outcome."""
+    job = StoredJob.get_by_key_name(id)
+    if job is None or job.state in (DONE, FAILED):
+        return
+    job.state = RUNNING
+    job.started = time.time()
+    job.put()
+    try:
+        result = func(*args, **kwargs)
+        data = zlib.compress(cPickle.dumps(result, 2))
+        chunks = [JobChunk(key_name='%06d' % i, parent=job,
+                           data=data[start:start + CHUNK_SIZE])
+                  for i, start in enumerate(range(0, len(data), CHUNK_SIZE))]
+        db.put(chunks)
+        job.chunks = len(chunks)
+        job.state = DONE
+    except Exception, e:
+        # The job fails for good rather than being retried by the queue.
+        logging.error('job %s failed\n%s', id, traceback.format_exc())
+        job.error = str(e) or e.__class__.__name__
+        job.state = FAILED
+    job.finished = time.time()
+    job.put()
+
+class TaskQueueJobRunner(object):
+    """Runs jobs in deferred tasks and keeps them in the Datastore.
+
+    The function of a job and its arguments must be picklable, so it is a
+    module-level function.
+    """
+    def __init__(self, queue='default'):
+        self.queue = queue
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) and returns the id of its job.
+
+        With a key keyword argument, a job already made for the same key
+        is returned instead, unless it failed.
+        """
+        key = kwargs.pop('key', None)
+        if key is None:
+            id = uuid.uuid4().hex
+        else:
+            id = hashlib.md5(str(key)).hexdigest()
+
+        def txn():
+            job = StoredJob.get_by_key_name(id)
+            if job is not None and job.state != FAILED:
+                return
+            job = StoredJob(key_name=id, key_=key and str(key), state=QUEUED,
+                            created=time.time())
+            job.put()
+            deferred.defer(_run, id, func, args, kwargs, _queue=self.queue,
+                           _transactional=True)
+        db.run_in_transaction(txn)
+        return id
+
+    def get(self, id):
+        """Returns a job by id, or None."""
+        return StoredJob.get_by_key_name(id)
+
+    def status(self, id):
+        job = self.get(id)
+        return job and job.status()
+
+    def result(self, id):
+        """Returns the result of a finished job, or None."""
+        job = self.get(id)
+        return job and job.result
+
+    def wait(self, id, timeout=None, interval=1.0):
+        """Polls a job until it is finished and tells whether it is."""
+        deadline = timeout is not None and time.time() + timeout or None
+        while True:
+            job = self.get(id)
+            if job is None:
+                return False
+            if job.state in (DONE, FAILED):
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
+    def shutdown(self):
+        """Does nothing, as the jobs run in the queue."""
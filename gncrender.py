@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Renders financial statements as CSV, HTML or JSON.
+
+A statement describes itself as a sequence of rows from its rows() method,
+each a (kind, label, values, level) tuple:
+
+  ('head', label, column labels, 0)       the labels of the columns
+  ('section', label, None, 0)             the start of a section
+  ('account', name, balances, level)      the balances of an account
+  ('total', label, totals, 0)             a total line
+  ('gap', None, None, 0)                  a break between sections
+
+The level of an account row is how far it is nested under the first level
+of its section, for a statement limited to a depth, where the row of a
+parent holds the subtotal of the rows under it, and 0 otherwise.
+
+A renderer turns the rows into chunks of text one row at a time, so a
+report can be written out while the rest of it is still being made.
+"""
+import csv
+import json
+from cStringIO import StringIO
+
+import gncprofile
+
+class Renderer(object):
+    """The base class of the renderers."""
+    def __init__(self, caption=None):
+        self.caption = caption
+
+    def render(self, stm):
+        """Yields the chunks of text of a statement."""
+        raise NotImplementedError
+
+    def write(self, stm, out):
+        """Writes a statement to a file-like object as UTF-8."""
+        with gncprofile.timer('render'):
+            for chunk in self.render(stm):
+                out.write(_encode(chunk))
+
+    def tostring(self, stm):
+        return ''.join(self.render(stm))
+
+class CSVRenderer(Renderer):
+    """Renders a statement as CSV, with a blank line between sections."""
+    def render(self, stm):
+        buf = StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        for kind, label, values, level in stm.rows():
+            if kind == 'gap':
+                writer.writerow([])
+            elif kind == 'head':
+                writer.writerow([_encode(label)] + [str(v) for v in values])
+            elif kind == 'section':
+                writer.writerow([_encode(label)])
+            else:
+                writer.writerow([_encode('  ' * level + label)] +
+                                ['%.2f' % v for v in values])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+class HTMLRenderer(Renderer):
+    """Renders a statement as an HTML table."""
+    def render(self, stm):
+        yield '<table>\n'
+        if self.caption:
+            yield '  <caption>%s</caption>\n' % self.caption
+        ncols = 1
+        for kind, label, values, level in stm.rows():
+            if kind == 'head':
+                ncols = len(values) + 1
+                buf = ['<th>%s</th>' % v for v in values]
+                yield ('  <thead>\n'
+                       '    <tr><th>%s</th>%s</tr>\n'
+                       '  </thead>\n'
+                       '  <tbody>\n' % (label, ''.join(buf)))
+            elif kind == 'section':
+                yield '    <tr><td colspan="%d">%s</td></tr>\n' % (ncols,
+                                                                   label)
+            elif kind == 'gap':
+                yield '    <tr><td colspan="%d"></td></tr>\n' % ncols
+            elif kind == 'account':
+                buf = ['<td>%.2f</td>' % v for v in values]
+                style = level and ' style="padding-left: %dem"' % level or ''
+                yield '    <tr><td%s>%s</td>%s</tr>\n' % (style, label,
+                                                       ''.join(buf))
+            elif kind == 'total':
+                buf = ['<td>%.2f</td>' % v for v in values]
+                yield '    <tr><td><b>%s</b></td>%s</tr>\n' % (label,
+                                                              ''.join(buf))
+        yield '  </tbody>\n</table>'
+
+class JSONRenderer(Renderer):
+    """Renders a statement as a JSON object with its columns and rows.
+
+    Amounts are written as numbers with two decimals.
+    """
+    def render(self, stm):
+        yield '{'
+        if self.caption:
+            yield '"caption": %s, ' % json.dumps(self.caption)
+        sep = ''
+        for kind, label, values, level in stm.rows():
+            if kind == 'head':
+                yield '"columns": %s, "rows": [' % json.dumps(
+                    [str(v) for v in values])
+            elif kind == 'section':
+                yield '%s\n{"type": "section", "label": %s}' % (
+                    sep, json.dumps(label))
+            elif kind == 'account':
+                yield ('%s\n{"type": "account", "label": %s, "level": %d, '
+                       '"values": [%s]}' % (
+                    sep, json.dumps(label), level,
+                    ', '.join(['%.2f' % v for v in values])))
+            elif kind == 'total':
+                yield '%s\n{"type": "total", "label": %s, "values": [%s]}' % (
+                    sep, json.dumps(label),
+                    ', '.join(['%.2f' % v for v in values]))
+            else:
+                continue
+            if kind != 'head':
+                sep = ','
+        yield '\n]}\n'
+
+renderers = {
+    'csv': CSVRenderer,
+    'html': HTMLRenderer,
+    'json': JSONRenderer,
+}
+
+def render(stm, format='html', caption=None):
+    """Yields the chunks of text of a statement in a format."""
+    return renderers[format](caption).render(stm)
+
+def write(stm, out, format='html', caption=None):
+    """Writes a statement in a format to a file-like object."""
+    renderers[format](caption).write(stm, out)
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
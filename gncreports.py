@@ -6,14 +6,116 @@ except ImportError:
         from xml.etree import cElementTree as etree  # Python 2.5 or later
     except ImportError:
         from xml.etree import ElementTree as etree   # Python 2.5 or later
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+import re
 import gzip
-from datetime import date, datetime
+import time
+import zlib
+import heapq
+from itertools import islice
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta, tzinfo
+from bisect import bisect_left, bisect_right
+from fractions import Fraction, gcd
 import calendar
+from collections import OrderedDict
+
+import gncprofile
+import gncrender
+
+_nstags = {}
 
 def nstag(tag):
-    prefix, name = tag.split(':')
-    return '{http://www.gnucash.org/XML/%s}%s' % (prefix, name)
+    """Returns the qualified name of a tag, or of a path of tags such as
+    'trn:date-posted/ts:date'."""
+    try:
+        return _nstags[tag]
+    except KeyError:
+        names = ['{http://www.gnucash.org/XML/%s}%s' % tuple(name.split(':'))
+                 for name in tag.split('/')]
+        _nstags[tag] = '/'.join(names)
+        return _nstags[tag]
+
+# Qualified names of the tags read while converting transactions.
+_TRN_ID = nstag('trn:id')
+_TRN_CURRENCY = nstag('trn:currency')
+_TRN_DATE_POSTED = nstag('trn:date-posted/ts:date')
+_TRN_DATE_ENTERED = nstag('trn:date-entered/ts:date')
+_TRN_DESCRIPTION = nstag('trn:description')
+_TRN_SPLITS = nstag('trn:splits/trn:split')
+_SPLIT_ID = nstag('split:id')
+_SPLIT_VALUE = nstag('split:value')
+_SPLIT_QUANTITY = nstag('split:quantity')
+_SPLIT_ACCOUNT = nstag('split:account')
+
+class FixedOffset(tzinfo):
+    """A fixed offset in minutes from UTC."""
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.offset = timedelta(minutes=minutes)
+
+    def __getinitargs__(self):
+        return (self.minutes,)
+
+    def __repr__(self):
+        return 'FixedOffset(%d)' % self.minutes
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        sign = self.minutes < 0 and '-' or '+'
+        return '%s%02d%02d' % ((sign,) + divmod(abs(self.minutes), 60))
+
+_tzinfos = {}
+
+def parse_timestamp(text):
+    """Decodes a GnuCash timestamp, 'YYYY-MM-DD HH:MM:SS +HHMM', into a
+    datetime aware of its UTC offset.
+
+    The fields are sliced at their fixed positions, and the tzinfo of each
+    offset is made once. A missing offset is taken as UTC.
+    """
+    offset = text[20:25]
+    try:
+        tz = _tzinfos[offset]
+    except KeyError:
+        minutes = 0
+        if offset:
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            if offset[0] == '-':
+                minutes = -minutes
+        tz = _tzinfos[offset] = FixedOffset(minutes)
+    return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                    int(text[11:13]), int(text[14:16]), int(text[17:19]), 0,
+                    tz)
+
+# Denominators are a handful of powers of ten, so each is parsed once and
+# the int is shared between the splits.
+_denoms = {}
+
+def parse_amount(text):
+    """Returns the integer numerator and denominator of a GnuCash amount."""
+    num, denom = text.split('/')
+    try:
+        return int(num), _denoms[denom]
+    except KeyError:
+        _denoms[denom] = int(denom)
+        return int(num), _denoms[denom]
+
+def common_denom(denoms):
+    """Returns the least common multiple of denominators."""
+    scale = 1
+    for denom in set(denoms):
+        scale = scale * denom // gcd(scale, denom)
+    return scale
 
 def _find(elm, tag):
     return elm.find(nstag(tag))
@@ -22,8 +124,49 @@ def _findall(elm, tag):
 def _findtext(elm, tag):
     return elm.findtext(nstag(tag))
 
+def _compact(text):
+    """Returns text as a byte string, UTF-8 encoded if it is unicode."""
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def _expand(data):
+    """Returns the text of a byte string made by _compact()."""
+    try:
+        data.decode('ascii')
+    except UnicodeDecodeError:
+        return data.decode('utf-8')
+    return data
+
+# The shared packed data and Commodity of each commodity by its packed data.
+_commodities = {}
+
+def _shared(data):
+    try:
+        return _commodities[data]
+    except KeyError:
+        cmdty = Commodity()
+        cmdty.unpack(data)
+        shared = _commodities[data] = (data, cmdty)
+        return shared
+
+def _commodity(data):
+    """Returns the shared Commodity of packed commodity data."""
+    return _shared(data)[1]
+
+def _packed(data):
+    """Returns the shared tuple equal to packed commodity data, so that the
+    transactions in a commodity hold one tuple between them."""
+    return _shared(data)[0]
+
 class ElementWrapper(object):
-    """An element wrapper class."""
+    """An element wrapper class.
+
+    The model classes below use __slots__ and drop their element once it
+    is converted, since a book may hold millions of them.
+    """
+    __slots__ = ('element',)
+
     def __init__(self, element):
         self.element = element
 
@@ -34,25 +177,47 @@ class ElementWrapper(object):
     def _findtext(self, tag):
         return self.element.findtext(nstag(tag))
 
+    def release(self):
+        """Drop the reference to the source element."""
+        self.element = None
+
 class Commodity(ElementWrapper):
     """A commodity class."""
-    def __init__(self, element):
+    __slots__ = ('space', 'id', 'quote_source')
+
+    def __init__(self, element=None):
         ElementWrapper.__init__(self, element)
-        if element is not None: self.convert(element)
+        self.space = self.id = self.quote_source = None
+        if element is not None:
+            self.convert(element)
+            self.release()
 
     def convert(self, element):
         self.space = self._findtext('cmdty:space')
         self.id = self._findtext('cmdty:id')
         self.quote_source = self._findtext('cmdty:quote_source')
 
+    def pack(self):
+        return (self.space, self.id, self.quote_source)
+
+    def unpack(self, data):
+        self.space, self.id, self.quote_source = data
+
 class Account(ElementWrapper):
     """An account class"""
+    __slots__ = ('book', 'children', 'splits', '_index', '_qindex', 'name',
+                 'id', 'type', 'description', 'pid', 'commodity')
+
     def __init__(self, book, element=None):
         ElementWrapper.__init__(self, element)
         self.book = book
         self.children = []
         self.splits = []
-        if element is not None: self.convert(element)
+        self._index = self._qindex = None
+        self.commodity = None
+        if element is not None:
+            self.convert(element)
+            self.release()
 
     def __lt__(self, other):
         return self.name < other.name
@@ -63,6 +228,18 @@ class Account(ElementWrapper):
         self.type = self._findtext('act:type')
         self.description = self._findtext('act:description')
         self.pid = self._findtext('act:parent')
+        cmdty = self._find('act:commodity')
+        if cmdty is not None:
+            self.commodity = _commodity(Commodity(cmdty).pack())
+
+    def pack(self):
+        return (self.id, self.name, self.type, self.description, self.pid,
+                self.commodity and self.commodity.pack())
+
+    def unpack(self, data):
+        (self.id, self.name, self.type, self.description, self.pid,
+         commodity) = data
+        self.commodity = commodity and _commodity(commodity)
 
     def __str__(self):
         return ': '.join([self.id, self.name])
@@ -83,85 +260,305 @@ class Account(ElementWrapper):
         return self._totree()
 
     def insert(self, entity):
+        """Adds a child account, or a split of a transaction of the book,
+        patching the balance indexes of the account in place and dropping
+        what else the split changes, see Book._splitschanged()."""
         if type(entity) is Account:
             self.children.append(entity)
+            self.book.invalidate(accounts=True)
         elif type(entity) is Split:
-            self.splits.append(entity)
+            self._addsplit(entity)
+            self.book._splitschanged([entity])
 
     def remove(self, entity):
         if type(entity) is Account:
             self.children.remove(entity)
+            self.book.invalidate(accounts=True)
         elif type(entity) is Split:
-            self.splits.remove(entity)
+            self._removesplit(entity)
+            self.book._splitschanged([entity])
+
+    def _addsplit(self, split):
+        self.splits.append(split)
+        if self._index is not None:
+            self._insertindex(split)
+
+    def _removesplit(self, split):
+        self.splits.remove(split)
+        if self._index is not None:
+            self._removeindex(split)
+
+    def _insertindex(self, split):
+        """Inserts a split in the balance indexes, adding its value to the
+        running totals after it. An index whose denominator the split does
+        not divide is dropped instead."""
+        dates, totals, scale, splits = self._index
+        if scale % split.value_denom:
+            self._index = self._qindex = None
+            return
+        key = _datekey(split)
+        i = bisect_right(dates, key[0])
+        while i > 0 and _datekey(splits[i - 1]) > key:
+            i -= 1
+        dates.insert(i, key[0])
+        splits.insert(i, split)
+        _inserttotal(totals, i,
+                     split.value_num * (scale // split.value_denom))
+        if self._qindex is not None:
+            qdates, qtotals, qscale = self._qindex
+            if qscale % split.quantity_denom:
+                self._qindex = None
+            else:
+                _inserttotal(qtotals, i, split.quantity_num *
+                             (qscale // split.quantity_denom))
+
+    def _removeindex(self, split):
+        """Removes a split from the balance indexes, taking its value off
+        the running totals after it."""
+        dates, totals, scale, splits = self._index
+        i = bisect_left(dates, split.date())
+        while splits[i] is not split:
+            i += 1
+        del dates[i]
+        del splits[i]
+        _removetotal(totals, i)
+        if self._qindex is not None:
+            _removetotal(self._qindex[1], i)
 
     def descendants(self):
-        """Gets the descendants of an account."""
-        acts = []
-        for act in sorted(self.children):
-            acts.append(act)
-            if act.children:
-                acts.extend(act.descendants())
-        return acts
+        """Gets the descendants of an account, in pre-order with the children
+        of each account sorted by name."""
+        return self.book.accountindex().descendants(self)
+
+    def fullname(self):
+        """Returns the colon-separated names of the account and its
+        ancestors below the root."""
+        return self.book.accountindex().paths.get(self.id)
+
+    def _balance_index(self):
+        """Return the posted dates of the splits in date order, the running
+        totals of their values over a common denominator, the denominator
+        and the splits in date order, built once and kept until the splits
+        change."""
+        if self._index is None:
+            splits = sorted(self.book._accountsplits(self), key=_datekey)
+            scale = common_denom([split.value_denom for split in splits])
+            dates = []
+            totals = [0]
+            total = 0
+            for split in splits:
+                dates.append(split.date())
+                total += split.value_num * (scale // split.value_denom)
+                totals.append(total)
+            self._index = (dates, totals, scale, splits)
+        return self._index
+
+    def timeline(self):
+        """Return the posted dates of the splits in date order and the
+        splits in the same order."""
+        dates, totals, scale, splits = self._balance_index()
+        return dates, splits
 
     def balance(self, start=date.min, end=date.max):
         # In liability, equity and income accounts, credits increase the
         # balance and debits decrease the balance.
-        bln = sum([split.value for split in self.splits
-                   if start <= split.date() and split.date() <= end])
+        dates, totals, scale, splits = self._balance_index()
+        lo = bisect_left(dates, start)
+        hi = bisect_right(dates, end, lo)
+        return self.signed(Fraction(totals[hi] - totals[lo], scale))
+
+    def _quantity_index(self):
+        """Return the posted dates of the splits in date order, the running
+        totals of their quantities over a common denominator and the
+        denominator."""
+        if self._qindex is None:
+            dates, totals, scale, splits = self._balance_index()
+            scale = common_denom([split.quantity_denom for split in splits])
+            totals = [0]
+            total = 0
+            for split in splits:
+                total += split.quantity_num * (scale // split.quantity_denom)
+                totals.append(total)
+            self._qindex = (dates, totals, scale)
+        return self._qindex
+
+    def quantities(self, periods):
+        """Return the sums of the split quantities, in the commodity of the
+        account, over each of the (start, end) periods."""
+        dates, totals, scale = self._quantity_index()
+        sums = []
+        for start, end in periods:
+            lo = bisect_left(dates, start)
+            hi = bisect_right(dates, end, lo)
+            sums.append(Fraction(totals[hi] - totals[lo], scale))
+        return sums
+
+    def balances(self, endings):
+        """Return the balances at the end of each of the dates, read off the
+        running totals of the splits in date order."""
+        dates, totals, scale, splits = self._balance_index()
+        return [self.signed(Fraction(totals[bisect_right(dates, ending)],
+                                     scale))
+                for ending in endings]
+
+    def signed(self, bln):
+        """Return a sum of split values as a balance of this account."""
         if bln != 0 and self.type in set(['LIABILITY', 'EQUITY', 'INCOME']):
             bln *= -1
         return bln
 
 class Split(ElementWrapper):
-    """A split classs"""
+    """A split classs
+
+    The quantity is only stored when it differs from the value.
+    """
+    __slots__ = ('id', 'value_num', 'value_denom', '_quantity', 'accountid',
+                 'account', 'transaction')
+
     def __init__(self, element=None):
         ElementWrapper.__init__(self, element)
         self.account = None
         self.transaction = None
-        if element is not None: self.convert(element)
+        if element is not None:
+            self.convert(element)
+            self.release()
 
     def __lt__(self, other):
         return self.transaction.date_posted < other.transaction.date_posted
 
     def convert(self, element):
-        self.id = self._findtext('split:id')
-        a, b = self._findtext('split:value').split('/')
-        self.value = float(a)/float(b)
-        self.quantity = self._findtext('split:quantity')
-        self.accountid = self._findtext('split:account')
+        findtext = element.findtext
+        self.id = findtext(_SPLIT_ID)
+        self.value_num, self.value_denom = parse_amount(
+            findtext(_SPLIT_VALUE))
+        self._setquantity(parse_amount(findtext(_SPLIT_QUANTITY)))
+        self.accountid = findtext(_SPLIT_ACCOUNT)
+
+    def _setquantity(self, quantity):
+        if quantity == (self.value_num, self.value_denom):
+            quantity = None
+        self._quantity = quantity
+
+    def pack(self):
+        return (self.id, self.value_num, self.value_denom, self.quantity_num,
+                self.quantity_denom, self.accountid)
+
+    def unpack(self, data):
+        (self.id, self.value_num, self.value_denom, quantity_num,
+         quantity_denom, self.accountid) = data
+        self._setquantity((quantity_num, quantity_denom))
+
+    @property
+    def value(self):
+        return Fraction(self.value_num, self.value_denom)
+
+    @property
+    def quantity_num(self):
+        if self._quantity is None:
+            return self.value_num
+        return self._quantity[0]
+
+    @property
+    def quantity_denom(self):
+        if self._quantity is None:
+            return self.value_denom
+        return self._quantity[1]
+
+    @property
+    def quantity(self):
+        return Fraction(self.quantity_num, self.quantity_denom)
 
     def date(self):
         return self.transaction.date_posted.date()
 
+def _inserttotal(totals, i, value):
+    """Inserts value as item i of the running totals."""
+    totals.insert(i + 1, totals[i] + value)
+    for j in xrange(i + 2, len(totals)):
+        totals[j] += value
+
+def _removetotal(totals, i):
+    """Removes item i of the running totals."""
+    value = totals[i + 1] - totals[i]
+    del totals[i + 1]
+    for j in xrange(i + 1, len(totals)):
+        totals[j] -= value
+
+def _datekey(entity):
+    """The sort key of a split or transaction in a timeline: the posted date,
+    then the posting time."""
+    if type(entity) is Split:
+        entity = entity.transaction
+    return entity.date_posted.date(), entity.date_posted
+
 class Transaction(ElementWrapper):
-    """A transaction class"""
-    def __init__(self, element=None):
+    """A transaction class
+
+    The rarely used currency, date_entered and description are kept in a
+    compact form and decoded on access. The fields named in skip, any of
+    'currency', 'date_entered' and 'description', are left as None.
+    """
+    __slots__ = ('id', '_currency', 'date_posted', '_date_entered',
+                 '_description', 'splits')
+
+    def __init__(self, element=None, skip=()):
         ElementWrapper.__init__(self, element)
-        if element is not None: self.convert(element)
+        if element is not None:
+            self.convert(element, skip)
+            self.release()
 
     def __lt__(self, other):
         return self.date_posted < other.date_posted
 
-    def convert(self, element):
-        self.id = self._findtext('trn:id')
-        self.currency = self._find('trn:currency')
-
-        date_format = '%Y-%m-%d %H:%M:%S'
-        date_string = _findtext(self._find('trn:date-posted'), 'ts:date')
-        self.date_posted = datetime.strptime(date_string[:19], date_format)
-        date_string = _findtext(self._find('trn:date-entered'), 'ts:date')
-        self.date_entered = datetime.strptime(date_string[:19], date_format)
-
-        self.description = self._findtext('trn:description')
-        splits_elms = _findall(self._find('trn:splits'), 'trn:split')
-        self.splits = self._mksplits(splits_elms)
+    def convert(self, element, skip=()):
+        findtext = element.findtext
+        self.id = findtext(_TRN_ID)
+        self._currency = self._date_entered = self._description = None
+        if 'currency' not in skip:
+            self.currency = Commodity(element.find(_TRN_CURRENCY))
+        self.date_posted = parse_timestamp(findtext(_TRN_DATE_POSTED))
+        if 'date_entered' not in skip:
+            self._date_entered = findtext(_TRN_DATE_ENTERED)
+        if 'description' not in skip:
+            self.description = findtext(_TRN_DESCRIPTION)
+        self.splits = self._mksplits(element.findall(_TRN_SPLITS))
+
+    @property
+    def currency(self):
+        """The shared Commodity of the currency."""
+        if self._currency is None:
+            return None
+        return _commodity(self._currency)
+
+    @currency.setter
+    def currency(self, cmdty):
+        self._currency = None
+        if cmdty is not None:
+            self._currency = _packed(cmdty.pack())
+
+    @property
+    def date_entered(self):
+        """The date entered, decoded from its timestamp on each access."""
+        if self._date_entered is None:
+            return None
+        return parse_timestamp(self._date_entered)
+
+    @property
+    def description(self):
+        if self._description is None:
+            return None
+        return _expand(self._description)
+
+    @description.setter
+    def description(self, text):
+        self._description = text and _compact(text)
 
     def __str__(self):
         s = ['{0}, {1}'.format(self.date_posted.strftime('%Y-%m-%d'),
                               self.description)]
         for sp in self.splits:
             name = sp.account and sp.account.name or sp.accountid
-            s.append('  {0} {1}'.format(name, sp.value))
+            s.append('  {0} {1}'.format(name, float(sp.value)))
         return '\n'.join(s)
 
     def _mksplits(self, elms):
@@ -171,22 +568,353 @@ class Transaction(ElementWrapper):
             slist.append(split)
         return slist
 
+    def pack(self):
+        return (self.id, self._currency, self.date_posted,
+                self._date_entered, self._description,
+                [split.pack() for split in self.splits])
+
+    def unpack(self, data):
+        (self.id, self._currency, self.date_posted, self._date_entered,
+         self._description, splits) = data
+        if self._currency is not None:
+            self._currency = _packed(self._currency)
+        self.splits = []
+        for item in splits:
+            split = Split()
+            split.unpack(item)
+            self.splits.append(split)
+
+class Price(ElementWrapper):
+    """A price class"""
+    __slots__ = ('commodity', 'currency', 'date', 'value_num', 'value_denom')
+
+    def __init__(self, element=None):
+        ElementWrapper.__init__(self, element)
+        if element is not None:
+            self.convert(element)
+            self.release()
+
+    def convert(self, element):
+        self.commodity = Commodity(self._find('price:commodity')).pack()
+        self.currency = Commodity(self._find('price:currency')).pack()
+        self.date = parse_timestamp(
+            self._findtext('price:time/ts:date')).date()
+        self.value_num, self.value_denom = parse_amount(
+            self._findtext('price:value'))
+
+    @property
+    def value(self):
+        return Fraction(self.value_num, self.value_denom)
+
+    def pack(self):
+        return (self.commodity, self.currency, self.date, self.value_num,
+                self.value_denom)
+
+    def unpack(self, data):
+        (self.commodity, self.currency, self.date, self.value_num,
+         self.value_denom) = data
+
+def _cmdtykey(cmdty):
+    """Returns the (space, id) key of a Commodity, of packed commodity data
+    or of an ISO 4217 currency code."""
+    if isinstance(cmdty, basestring):
+        return ('ISO4217', cmdty)
+    if isinstance(cmdty, Commodity):
+        return (cmdty.space, cmdty.id)
+    return tuple(cmdty[:2])
+
+class PriceDB(object):
+    """The price database of a book.
+
+    The prices are indexed by (commodity, currency) pair, each series sorted
+    by date, so the price nearest a date is found by bisect and the prices
+    at a run of dates in one walk.
+    """
+    def __init__(self):
+        self.pairs = {}
+        self._series = {}
+
+    def __len__(self):
+        return sum([len(prices) for prices in self.pairs.values()])
+
+    def add(self, price):
+        pair = (_cmdtykey(price.commodity), _cmdtykey(price.currency))
+        self.pairs.setdefault(pair, []).append(price)
+        self._series.pop(pair, None)
+
+    def series(self, commodity, currency):
+        """Returns the dates and the values of the prices of a commodity in
+        a currency, sorted by date."""
+        pair = (_cmdtykey(commodity), _cmdtykey(currency))
+        if pair not in self._series:
+            prices = sorted(self.pairs.get(pair, []),
+                            key=lambda price: price.date)
+            self._series[pair] = ([price.date for price in prices],
+                                  [price.value for price in prices])
+        return self._series[pair]
+
+    def prices(self, commodity, currency, dates):
+        """Returns the price of a commodity in a currency nearest each of the
+        dates, or None where there is none.
+
+        A price quoted the other way round, of the currency in the
+        commodity, is inverted, skipping those of zero.
+        """
+        if _cmdtykey(commodity) == _cmdtykey(currency):
+            return [Fraction(1)] * len(dates)
+        pdates, values = self.series(commodity, currency)
+        if not pdates:
+            pdates, values = self.series(currency, commodity)
+            prices = [(d, value) for d, value in zip(pdates, values)
+                      if value != 0]
+            pdates = [d for d, value in prices]
+            values = [1 / value for d, value in prices]
+        if not pdates:
+            return [None] * len(dates)
+        prices = []
+        for d in dates:
+            i = bisect_left(pdates, d)
+            if i == len(pdates) or (i > 0 and
+                                    d - pdates[i - 1] <= pdates[i] - d):
+                i -= 1
+            prices.append(values[i])
+        return prices
+
+    def price(self, commodity, currency, when):
+        """Returns the price of a commodity in a currency nearest a date."""
+        return self.prices(commodity, currency, [when])[0]
+
+    def pack(self):
+        return [price.pack() for prices in self.pairs.values()
+                for price in prices]
+
+    def unpack(self, data):
+        for item in data:
+            price = Price()
+            price.unpack(item)
+            self.add(price)
+
 class Book(ElementWrapper):
     """A book class"""
+    # The number of reports and period sums kept by memoize().
+    memosize = 1024
+
     def __init__(self, element=None):
+        ElementWrapper.__init__(self, None)
+        self.id = None
+        self.commodity = None
+        self.accounts, self.actdic = [], {}
+        self.transactions, self.trndic = [], {}
+        self.prices = PriceDB()
+        self._columns = None
+        self._accountindex = None
+        self._timeline = None
+        self._tokenindex = None
+        self._memo = OrderedDict()
+        self._memostarts = {}
         if type(element) == str:
-            tree = etree.parse(gzip.GzipFile(element))
-            element = _find(tree.getroot(), 'gnc:book')
-        ElementWrapper.__init__(self, element)
-        if element is not None: self.convert(element)
+            loader, source = detect(element)
+            if not isinstance(loader, XMLLoader):
+                raise ValueError('not an XML book: %s' % element)
+            self.load(loader.open(source))
+        elif element is not None:
+            self.element = element
+            self.convert(element)
 
     def convert(self, element):
         self.id = self._findtext('book:id')
         self.commodity = Commodity(self._find('gnc:commodity'))
-        actelms = self._findall('gnc:account')
-        self.accounts, self.actdic = self._mkaccounts(actelms)
-        trnelms = self._findall('gnc:transaction')
-        self.transactions, self.trndic = self._mktransactions(trnelms)
+        pricedb = self._find('gnc:pricedb')
+        if pricedb is not None:
+            self._loadpricedb(pricedb)
+        with gncprofile.timer('mkaccounts'):
+            self._mkaccounts(self._findall('gnc:account'))
+        with gncprofile.timer('mktransactions'):
+            self._mktransactions(self._findall('gnc:transaction'))
+
+    def load(self, source, skip=()):
+        """Load the first book from an XML stream.
+
+        Accounts and transactions are converted as soon as their elements
+        are complete, and the elements are discarded right away, so the
+        whole document tree is never held in memory. The transaction fields
+        in skip are not decoded.
+        """
+        booktag = nstag('gnc:book')
+        acttag = nstag('gnc:account')
+        trntag = nstag('gnc:transaction')
+        handlers = {
+            nstag('book:id'): self._loadid,
+            nstag('gnc:commodity'): self._loadcommodity,
+            nstag('gnc:pricedb'): self._loadpricedb,
+            acttag: self._loadaccount,
+            trntag: lambda elm: self._loadtransaction(elm, skip),
+        }
+        prof = gncprofile.current()
+        if prof is not None:
+            # Time building and linking the model objects apart.
+            build = {acttag: lambda elm: Account(self, elm),
+                     trntag: lambda elm: Transaction(elm, skip)}
+            link = {acttag: self._addaccount, trntag: self._addtransaction}
+            handlers[acttag] = handlers[trntag] = lambda elm: self._loadtimed(
+                prof, build[elm.tag], link[elm.tag], elm)
+            start = time.time()
+            timers = dict(prof.timers)
+        nelements = 0
+        depth = 0
+        bookelm = None
+        for event, elm in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                nelements += 1
+                depth += 1
+                if depth == 2 and bookelm is None and elm.tag == booktag:
+                    bookelm = elm
+                continue
+            depth -= 1
+            if bookelm is None:
+                continue
+            if elm is bookelm:
+                break
+            if depth == 2:
+                # a direct child of the book is complete
+                handler = handlers.get(elm.tag)
+                if handler is not None:
+                    handler(elm)
+                bookelm.clear()
+        if prof is not None:
+            # Parsing is what is left of the load.
+            spent = sum([prof.timers.get(name, 0.0) - timers.get(name, 0.0)
+                         for name in ('decompress', 'build', 'link')])
+            prof.add('parse', time.time() - start - spent)
+            prof.count('elements parsed', nelements)
+
+    def _loadtimed(self, prof, build, link, elm):
+        t = time.time()
+        entity = build(elm)
+        t1 = time.time()
+        link(entity)
+        prof.add('build', t1 - t)
+        prof.add('link', time.time() - t1)
+        if type(entity) is Transaction:
+            prof.count('splits linked', len(entity.splits))
+
+    def _loadid(self, elm):
+        self.id = elm.text
+
+    def _loadcommodity(self, elm):
+        if self.commodity is None:
+            self.commodity = Commodity(elm)
+
+    def _loadpricedb(self, elm):
+        for priceelm in elm.findall('price'):
+            self.prices.add(Price(priceelm))
+        self.invalidate()
+
+    def _loadaccount(self, elm):
+        self._addaccount(Account(self, elm))
+
+    def _loadtransaction(self, elm, skip=()):
+        self._addtransaction(Transaction(elm, skip))
+
+    def pack(self):
+        """Returns the book as nested tuples of plain values."""
+        return (self.id, self.commodity and self.commodity.pack(),
+                [act.pack() for act in self.accounts],
+                [trn.pack() for trn in self.transactions],
+                self.prices.pack())
+
+    def unpack(self, data):
+        """Builds the book from the tuples returned by pack()."""
+        self.id, commodity, accounts, transactions, prices = data
+        if commodity is not None:
+            self.commodity = Commodity()
+            self.commodity.unpack(commodity)
+        self.prices.unpack(prices)
+        for item in accounts:
+            act = Account(self)
+            act.unpack(item)
+            self._addaccount(act)
+        for item in transactions:
+            trn = Transaction()
+            trn.unpack(item)
+            self._addtransaction(trn)
+
+    def update(self, source):
+        """Bring the book up to date with a newer copy of its file.
+
+        The newer book is matched against this one by account and
+        transaction ids, and only what differs is applied: new and changed
+        accounts are updated in place, and new, changed and deleted
+        transactions are linked in or out of their accounts, which patches
+        the balance indexes of the accounts they touch. The
+        columns, timeline and token index are patched as well, and only the
+        memoized sums and statements the transactions change are dropped,
+        see _patch(). The source is a file name, a file object or a Book.
+        Returns the numbers of added, changed and removed transactions.
+        """
+        newer = source
+        if not isinstance(newer, Book):
+            newer = gncopen(source)
+        if newer.commodity is not None:
+            self.commodity = newer.commodity
+        if newer.prices.pack() != self.prices.pack():
+            self.prices = newer.prices
+            self.invalidate()
+
+        for new in newer.accounts:
+            act = self.actdic.get(new.id)
+            if act is None:
+                self._addaccount(_copy(new, Account(self)))
+            elif act.pack() != new.pack():
+                if act.pid != new.pid:
+                    if act.pid is not None:
+                        self.actdic[act.pid].remove(act)
+                    if new.pid is not None:
+                        self.actdic[new.pid].insert(act)
+                act.unpack(new.pack())
+                self.invalidate(accounts=True)
+
+        added, changed, removed = [], {}, set()
+        for new in newer.transactions:
+            trn = self.trndic.get(new.id)
+            if trn is None:
+                added.append(new)
+            elif trn.pack() != new.pack():
+                changed[trn.id] = new
+        for trn in self.transactions:
+            if trn.id not in newer.trndic:
+                removed.add(trn.id)
+
+        # A changed transaction is taken out and a copy of the newer one
+        # added at the end.
+        gone, positions = [], []
+        if changed or removed:
+            transactions = []
+            for i, trn in enumerate(self.transactions):
+                if trn.id in removed or trn.id in changed:
+                    self._unlinktransaction(trn)
+                    gone.append(trn)
+                    positions.append(i)
+                else:
+                    transactions.append(trn)
+            self.transactions = transactions
+        new = [_copy(changed[trn.id], Transaction())
+               for trn in gone if trn.id in changed]
+        new.extend([_copy(trn, Transaction()) for trn in added])
+        for trn in new:
+            self._linktransaction(trn)
+        self.transactions.extend(new)
+        self._patch(new, gone, positions)
+
+        for act in [act for act in self.accounts
+                    if act.id not in newer.actdic]:
+            parent = self.actdic.get(act.pid)
+            if parent is not None:
+                parent.remove(act)
+            self.accounts.remove(act)
+            del self.actdic[act.id]
+            self.invalidate(accounts=True)
+        return len(added), len(changed), len(removed)
 
     def __str__(self):
         return self.summary()
@@ -196,52 +924,241 @@ class Book(ElementWrapper):
             len(self.accounts), len(self.transactions))
 
     def _mkaccounts(self, elms):
-        actlist = []
-        actdic = {}
         for elm in elms:
-            act = Account(self, elm)
-            actlist.append(act)
-            actdic[act.id] = act
-            pid = act.pid
-            if pid is None:
-                pass
-            else:
-                parent = actdic[pid]
-                parent.children.append(act)
-        return actlist, actdic
+            self._addaccount(Account(self, elm))
 
     def _mktransactions(self, elms):
-        trnlist = []
-        trndic = {}
         for elm in elms:
-            trn = Transaction(elm)
-            for split in trn.splits:
-                act = self.actdic[split.accountid]
-                act.insert(split)
-                split.account = act
-                split.transaction = trn
-            trnlist.append(trn)
-            trndic[trn.id] = trn
-        return trnlist, trndic
+            self._addtransaction(Transaction(elm))
+
+    def _addaccount(self, act):
+        self.accounts.append(act)
+        self.actdic[act.id] = act
+        if act.pid is not None:
+            self.actdic[act.pid].children.append(act)
+        self.invalidate(accounts=True)
+
+    def _addtransaction(self, trn):
+        self._linktransaction(trn)
+        self.transactions.append(trn)
+        self._patch([trn])
+
+    def _linktransaction(self, trn):
+        for split in trn.splits:
+            act = self.actdic[split.accountid]
+            split.account = act
+            split.transaction = trn
+            act._addsplit(split)
+        self.trndic[trn.id] = trn
+
+    def _unlinktransaction(self, trn):
+        for split in trn.splits:
+            split.account._removesplit(split)
+        del self.trndic[trn.id]
+
+    def _patch(self, added, removed=(), positions=()):
+        """Brings the stores derived from the splits up to date after the
+        transactions added were linked and appended, and those removed,
+        from the positions in the transactions, unlinked. Only the
+        memoized sums and statements that their splits change are
+        dropped."""
+        if self._columns is not None:
+            if isinstance(self._columns, SplitColumns):
+                self._columns.patch(self, len(added), positions)
+            else:
+                self._columns = None
+        if self._timeline is not None:
+            dates, trns = self._timeline
+            for trn in removed:
+                i = bisect_left(dates, trn.date_posted.date())
+                while trns[i] is not trn:
+                    i += 1
+                del dates[i]
+                del trns[i]
+            for trn in added:
+                key = _datekey(trn)
+                i = bisect_right(dates, key[0])
+                while i > 0 and _datekey(trns[i - 1]) > key:
+                    i -= 1
+                dates.insert(i, key[0])
+                trns.insert(i, trn)
+        if self._tokenindex is not None:
+            for trn in removed:
+                self._tokenindex.remove(trn)
+            for trn in added:
+                self._tokenindex.add(trn)
+        if self._memo:
+            self._forget([split for trns in (added, removed)
+                          for trn in trns for split in trn.splits])
+
+    def _splitschanged(self, splits):
+        """Drops the columns and the memoized sums and statements that splits
+        added to or removed from the accounts of transactions already in
+        the book change."""
+        self._columns = None
+        if self._memo:
+            self._forget(splits)
+
+    def _forget(self, splits):
+        """Drops the memoized period sums of the accounts of splits over
+        periods they are posted in, and the statements over such periods
+        or at endings on or after them."""
+        days = {}
+        for split in splits:
+            days.setdefault(split.accountid, []).append(split.date())
+        alldays = sorted([day for actdays in days.values()
+                          for day in actdays])
+        for actdays in days.values():
+            actdays.sort()
+
+        def within(days, start, end):
+            i = bisect_left(days, start)
+            return i < len(days) and days[i] <= end
+
+        stale = []
+        for key in self._memo:
+            if key[0] == 'sums':
+                kind, actkey, (start, end) = key
+                if [id for id in days
+                    if id in actkey and within(days[id], start, end)]:
+                    stale.append(key)
+            elif key[0] == 'balance_sheet':
+                if alldays and alldays[0] <= max(key[1]):
+                    stale.append(key)
+            elif key[0] == 'income_stm':
+                if [period for period in key[1]
+                    if within(alldays, *period)]:
+                    stale.append(key)
+            else:
+                stale.append(key)
+        for key in stale:
+            del self._memo[key]
+            if key[0] == 'sums':
+                kind, actkey, (start, end) = key
+                self._memostarts[(actkey, start)].discard(end)
+        gncprofile.count('memo entries dropped', len(stale))
+
+    def invalidate(self, accounts=False):
+        """Drops the stores derived from the splits after they change, and
+        the account index as well when accounts changed."""
+        self._columns = None
+        self._timeline = None
+        self._tokenindex = None
+        if self._memo:
+            self._memo.clear()
+            self._memostarts.clear()
+        if accounts:
+            self._accountindex = None
+
+    def accountindex(self):
+        """Returns the index of the accounts, built once after they change."""
+        if self._accountindex is None:
+            self._accountindex = AccountIndex(self)
+        return self._accountindex
+
+    def columns(self):
+        """Returns the splits in a columnar store, or None without NumPy."""
+        if numpy is None:
+            return None
+        if self._columns is None:
+            self._columns = SplitColumns(self)
+        return self._columns
+
+    def memoize(self, key, func, *args):
+        """Returns func(*args), keeping the result under key until the
+        splits change.
+
+        The least recently used results are dropped past memosize.
+        """
+        try:
+            value = self._memo.pop(key)
+            gncprofile.count('memo hits')
+        except KeyError:
+            gncprofile.count('memo misses')
+            value = func(*args)
+        self._memoput(key, value)
+        return value
+
+    def _memoput(self, key, value):
+        self._memo[key] = value
+        if key[0] == 'sums':
+            kind, actkey, (start, end) = key
+            self._memostarts.setdefault((actkey, start), set()).add(end)
+        while len(self._memo) > self.memosize:
+            key, value = self._memo.popitem(last=False)
+            if key[0] == 'sums':
+                kind, actkey, (start, end) = key
+                self._memostarts[(actkey, start)].discard(end)
+
+    def period_balances(self, accounts, periods):
+        """Returns period_balances() of accounts over periods, reusing the
+        sums of the periods asked for before.
+
+        The sums of each period are memoized for the set of accounts. A
+        period that was not asked for before but is covered by earlier
+        consecutive periods, as a year by its months, is added up from
+        them, and only the rest are computed.
+        """
+        gncprofile.count('balance calls', len(accounts))
+        actkey = frozenset([act.id for act in accounts])
+        sums = {}
+        missing = []
+        for period in periods:
+            try:
+                sums[period] = self._memo.pop(('sums', actkey, period))
+            except KeyError:
+                sums[period] = self._compose(actkey, period)
+            if sums[period] is None:
+                missing.append(period)
+            else:
+                self._memoput(('sums', actkey, period), sums[period])
+        gncprofile.count('periods reused', len(periods) - len(missing))
+        if missing:
+            gncprofile.count('periods computed', len(missing))
+            with gncprofile.timer('aggregate'):
+                balances = period_balances(accounts, missing, self.columns())
+            for i, period in enumerate(missing):
+                sums[period] = dict((id, blns[i])
+                                    for id, blns in balances.items())
+                self._memoput(('sums', actkey, period), sums[period])
+        return dict((act.id, [sums[period][act.id] for period in periods])
+                    for act in accounts)
+
+    def _compose(self, actkey, period):
+        """Adds up the memoized sums of consecutive periods that cover a
+        period, or returns None if they do not."""
+        start, end = period
+        total = None
+        while True:
+            ends = [e for e in self._memostarts.get((actkey, start), ())
+                    if e <= end]
+            if not ends:
+                return None
+            last = max(ends)
+            sums = self._memo[('sums', actkey, (start, last))]
+            if total is None:
+                total = dict(sums)
+            else:
+                for id, bln in sums.items():
+                    total[id] += bln
+            if last == end:
+                return total
+            start = last + timedelta(1)
 
     def getrootact(self, type=None):
-        """Gets the root account"""
-        # assume the first element of the account list is a root.
-        rootact = self.accounts[0]
+        """Gets the root account, or the top level account of a type."""
+        index = self.accountindex()
+        rootact = index.root()
         if type is not None:
-            # assume the root account has 5 fundamental type accounts as its
-            # children.
-            for act in rootact.children:
-                if act.type == type:
+            for act in index.bytype.get(type, []):
+                if act.pid == rootact.id:
                     return act
         return rootact
 
     def findact(self, name):
-        """Find an account with the name."""
-        for act in self.accounts:
-            if act.name == name:
-                return act
-        return None
+        """Find an account with the full name, such as 'Expenses:Food', or
+        else the first one with the name."""
+        return self.accountindex().find(name)
 
     def printacttree(self, name=None):
         """Print an account tree."""
@@ -253,54 +1170,203 @@ class Book(ElementWrapper):
             except:
                 pass
 
+    def timeline(self):
+        """Returns the posted dates of the transactions in date order and the
+        transactions in the same order, built once after they change."""
+        if self._timeline is None:
+            trns = sorted(self.transactions, key=_datekey)
+            dates = [trn.date_posted.date() for trn in trns]
+            self._timeline = (dates, trns)
+        return self._timeline
+
     def first_transaction(self):
-        return sorted(self.transactions)[0]
+        return self.timeline()[1][0]
 
     def last_transaction(self):
-        return sorted(self.transactions)[-1]
+        return self.timeline()[1][-1]
+
+    def transactions_between(self, start=date.min, end=date.max):
+        """Returns the transactions posted from start to end in date
+        order."""
+        dates, trns = self.timeline()
+        lo = bisect_left(dates, start)
+        return trns[lo:bisect_right(dates, end, lo)]
 
     def account_ledger(self, name, start=date.min, end=date.max):
         """Returns an account register ledger."""
         act = self.findact(name)
         return act and AccountLedger(act, start, end)
 
-    def balance_sheet(self, view='annual'):
-        """Returns a balance sheet."""
-        # FIXME!
-        endings = [date(2011,12,31), date(2010,12,31), date(2009,12,31)]
-        return BalanceSheet(self, endings)
-
-    def income_stm(self, start=date.min, end=date.max):
+    def tokenindex(self):
+        """Returns the index of the words of the transaction descriptions,
+        built once after the transactions change."""
+        if self._tokenindex is None:
+            self._tokenindex = TokenIndex(self)
+        return self._tokenindex
+
+    def query(self, start=date.min, end=date.max, account=None, **filters):
+        """Returns a lazy Query of the splits posted from start to end, of
+        an account and its subtree if given, that pass the filters."""
+        return Query(self, start, end, account, **filters)
+
+    def period_quantities(self, accounts, periods):
+        """Returns the sums of the split quantities of accounts over periods
+        by account id, see Account.quantities()."""
+        return dict((act.id, act.quantities(periods)) for act in accounts)
+
+    def _accountsplits(self, act):
+        """Returns the splits of an account, which its indexes are built
+        from."""
+        return act.splits
+
+    def _transactions(self, ids):
+        """Returns the transactions of ids."""
+        return [self.trndic[id] for id in ids]
+
+    def ending_balances(self, accounts, endings):
+        """Returns the balances of accounts at the end of each of the dates
+        by account id, see Account.balances()."""
+        gncprofile.count('balance calls', len(accounts))
+        return dict((act.id, act.balances(endings)) for act in accounts)
+
+    def balance_sheet(self, view='annual', depth=None, endings=None,
+                      currency=None):
+        """Returns a balance sheet at the endings, or else at the end of each
+        month, quarter or year of the book by view, the latest first. With
+        currency, the balances are valued in it, see valued_balances()."""
+        if endings is None:
+            endings = period_endings(self.first_transaction().date_posted,
+                                     self.last_transaction().date_posted,
+                                     view)
+        return self.memoize(
+            ('balance_sheet', tuple(endings), depth, currency),
+            BalanceSheet, self, endings, depth, currency)
+
+    def income_stm(self, start=date.min, end=date.max, depth=None,
+                   currency=None):
         """Returns an income statement over a given period."""
-        return IncomeStm(self, [(start, end)])
+        periods = [(start, end)]
+        return self.memoize(
+            ('income_stm', tuple(periods), depth, currency),
+            IncomeStm, self, periods, 'monthly', None, depth, currency)
 
-    def monthly_income_stm(self, year=date.max.year):
+    def monthly_income_stm(self, year=date.max.year, depth=None,
+                           currency=None):
         """Returns a monthly income statement."""
         if year == date.max.year:
             year = self.last_transaction().date_posted.year
-        periods = [(first_date_of_month(year, m), last_date_of_month(year, m))
-                   for m in range(1, 13)]  # for each month of the year
-        return IncomeStm(self, periods)
+        periods = monthly_periods(year)
+        return self.memoize(
+            ('income_stm', tuple(periods), depth, currency),
+            IncomeStm, self, periods, 'monthly', None, depth, currency)
 
-    def monthly_income_stms(self):
-        """Returns a list of monthly income statements on each year."""
+    def years(self):
+        """Returns the years of the transactions, the latest first."""
         first = self.first_transaction().date_posted.year
         last = self.last_transaction().date_posted.year
         years = range(first, last + 1)
         years.reverse()
-        
-        stms = []
+        return years
+
+    def monthly_income_stms(self, depth=None, currency=None):
+        """Returns a list of monthly income statements on each year."""
+        years = self.years()
+
+        # Aggregate the months of all the years in one pass over the splits
+        # and hand each statement its own slice.
+        periods = []
         for year in years:
-            stms.append((year, self.monthly_income_stm(year)))
+            periods.extend(monthly_periods(year))
+        accounts = (self.getrootact('INCOME').descendants() +
+                    self.getrootact('EXPENSE').descendants())
+        if currency is None:
+            balances = self.period_balances(accounts, periods)
+        else:
+            balances = valued_balances(self, accounts, periods, currency)
+
+        stms = []
+        for i, year in enumerate(years):
+            lo, hi = i * 12, (i + 1) * 12
+            yearly = dict((id, blns[lo:hi]) for id, blns in balances.items())
+            stms.append((year, IncomeStm(self, periods[lo:hi],
+                                         balances=yearly, depth=depth,
+                                         currency=currency)))
         return stms
 
+def _copy(src, dst):
+    """Copies the fields of a model object into a new one."""
+    dst.unpack(src.pack())
+    return dst
+
+class AccountIndex(object):
+    """Indexes of the accounts of a book by name, full name and type.
+
+    The accounts are numbered in pre-order with the children of each
+    account sorted by name, so the subtree of an account is the slice of
+    the order from its number up to its end.
+    """
+    def __init__(self, book):
+        self.accounts = book.accounts
+        self.order = []
+        self.number, self.end, self.depth = {}, {}, {}
+        self.paths, self.bypath = {}, {}
+        self.byname, self.bytype = {}, {}
+        for act in book.accounts:
+            self.byname.setdefault(act.name, []).append(act)
+        self.roots = [act for act in book.accounts if act.pid is None]
+        for root in self.roots:
+            self._visit(root, None, 0)
+        for act in self.order:
+            self.bytype.setdefault(act.type, []).append(act)
+
+    def _visit(self, act, path, depth):
+        self.number[act.id] = len(self.order)
+        self.depth[act.id] = depth
+        self.order.append(act)
+        if path is not None:
+            self.paths[act.id] = path
+            self.bypath[path] = act
+        for child in sorted(act.children):
+            if path is None:
+                self._visit(child, child.name, depth + 1)
+            else:
+                self._visit(child, path + ':' + child.name, depth + 1)
+        self.end[act.id] = len(self.order)
+
+    def root(self):
+        """Returns the root account of the book."""
+        for act in self.bytype.get('ROOT', []):
+            if act.pid is None:
+                return act
+        return self.accounts[0]
+
+    def find(self, name):
+        """Returns the account with the full name, or else the first one
+        with the name."""
+        act = self.bypath.get(name)
+        if act is None:
+            acts = self.byname.get(name)
+            act = acts and acts[0] or None
+        return act
+
+    def subtree(self, act):
+        """Returns an account and its descendants."""
+        return self.order[self.number[act.id]:self.end[act.id]]
+
+    def descendants(self, act):
+        return self.order[self.number[act.id] + 1:self.end[act.id]]
+
+    def contains(self, act, other):
+        """Tells whether other is act or one of its descendants."""
+        return self.number[act.id] <= self.number[other.id] < self.end[act.id]
+
 class AccountLedger(object):
     """An account ledger"""
     def __init__(self, account, start=date.min, end=date.max):
         self.account = account
-        self.splits = [split for split in account.splits
-                       if start <= split.date() and split.date() <= end]
-        self.splits.sort()
+        dates, splits = account.timeline()
+        lo = bisect_left(dates, start)
+        self.splits = splits[lo:bisect_right(dates, end, lo)]
 
     def __str__(self):
         s = []
@@ -312,107 +1378,525 @@ class AccountLedger(object):
                 trn.date_posted.date(), trn.description, split.value, balance))
         return '\n'.join(s)
 
-class BalanceSheet(object):
-    """A balance sheet"""
-    def __init__(self, book, endings):
-        self.endings = endings
-        self.assets = [(ac, []) for ac in
-                       book.getrootact('ASSET').descendants()]
-        self.liabilities = [(ac, []) for ac in
-                            book.getrootact('LIABILITY').descendants()]
-        self.equity = [(ac, []) for ac in
-                       book.getrootact('EQUITY').descendants()]
-        self.total = {'assets': [], 'liabilities': [], 'equity': []}
-
-        # Get each balance of the accounts of assets, liabilities and equity.
-        for ending in endings:
-            total = 0
-            for ac, balances in self.assets:
-                bln = ac.balance(end=ending)
-                balances.append(bln)
-                total += bln
-            self.total['assets'].append(total)
+    def rows(self):
+        """Yields the rows of the ledger, each split with its value and the
+        running balance, see gncrender."""
+        yield ('head', self.account.fullname(), ['Amount', 'Balance'], 0)
+        balance = 0
+        for split in self.splits:
+            trn = split.transaction
+            balance += split.value
+            yield ('account', u'%s %s' % (trn.date_posted.date(),
+                                          trn.description or u''),
+                   [split.value, balance], 0)
 
-            total = 0
-            for ac, balances in self.liabilities:
-                bln = ac.balance(end=ending)
-                balances.append(bln)
-                total += bln
-            self.total['liabilities'].append(total)
+    def tocsv(self):
+        return gncrender.CSVRenderer().tostring(self)
 
-            total = 0
-            for ac, balances in self.equity:
-                bln = ac.balance(end=ending)
-                balances.append(bln)
-                total += bln
-            self.total['equity'].append(total)
+    def tohtml(self, caption=None):
+        return gncrender.HTMLRenderer(caption).tostring(self)
+
+def tokenize(text):
+    """Returns the lowercased words of a text."""
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+class TokenIndex(object):
+    """An index of the transactions of a book by the words of their
+    descriptions."""
+    def __init__(self, book):
+        self.index = {}
+        for trn in book.transactions:
+            self.add(trn)
+
+    def add(self, trn):
+        if trn.description:
+            for word in set(tokenize(trn.description)):
+                self.index.setdefault(word, set()).add(trn.id)
+
+    def remove(self, trn):
+        if trn.description:
+            for word in set(tokenize(trn.description)):
+                ids = self.index[word]
+                ids.discard(trn.id)
+                if not ids:
+                    del self.index[word]
+
+    def lookup(self, words):
+        """Returns the ids of the transactions with all the words."""
+        sets = sorted([self.index.get(word, set()) for word in words],
+                      key=len)
+        if not sets:
+            return set()
+        return sets[0].intersection(*sets[1:])
+
+def _keyedsplits(splits, lo, hi, i):
+    """Yields the splits from lo to hi of run i keyed for merging by date."""
+    for j in xrange(lo, hi):
+        yield _datekey(splits[j]), i, j, splits[j]
+
+class Query(object):
+    """A query of the splits of a book, made lazily in date order.
+
+    The splits are posted from start to end, to an account and its
+    descendants, or to the account alone without subtree, if an account or
+    its full name is given. The filters are:
+
+      text      a substring of the description, in any case
+      regex     a regular expression searched for in the description
+      words     words all in the description, looked up in the token index
+      low       the least value of the split
+      high      the greatest value of the split
+
+    Only the splits of the accounts in the date range are visited, found by
+    bisecting their timelines and merged by date, or else the transactions
+    of the range in the book timeline, or those with the words. The results
+    are read by iterating over the query or a page at a time.
+    """
+    def __init__(self, book, start=date.min, end=date.max, account=None,
+                 subtree=True, text=None, regex=None, words=None, low=None,
+                 high=None):
+        self.book = book
+        self.start, self.end = start, end
+        self.accounts = None
+        if account is not None:
+            if isinstance(account, basestring):
+                name, account = account, book.findact(account)
+                if account is None:
+                    raise KeyError(name)
+            if subtree:
+                self.accounts = book.accountindex().subtree(account)
+            else:
+                self.accounts = [account]
+        self.text = text and text.lower()
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        self.regex = regex
+        self.words = words and tokenize(words)
+        self.low, self.high = low, high
+
+    def _splits(self):
+        """Yields the splits of the range and the accounts or the words in
+        date order."""
+        trnids = None
+        if self.words:
+            trnids = self.book.tokenindex().lookup(self.words)
+        if self.accounts is not None:
+            runs = []
+            for i, act in enumerate(self.accounts):
+                dates, splits = act.timeline()
+                lo = bisect_left(dates, self.start)
+                hi = bisect_right(dates, self.end, lo)
+                if lo < hi:
+                    runs.append(_keyedsplits(splits, lo, hi, i))
+            for key, i, j, split in heapq.merge(*runs):
+                if trnids is None or split.transaction.id in trnids:
+                    yield split
+            return
+        if trnids is not None:
+            trns = sorted(self.book._transactions(trnids), key=_datekey)
+            trns = [trn for trn in trns
+                    if self.start <= trn.date_posted.date() <= self.end]
+        else:
+            trns = self.book.transactions_between(self.start, self.end)
+        for trn in trns:
+            for split in trn.splits:
+                yield split
+
+    def __iter__(self):
+        low, high = self.low, self.high
+        for split in self._splits():
+            if low is not None or high is not None:
+                value = split.value
+                if (low is not None and value < low or
+                    high is not None and value > high):
+                    continue
+            if self.text is not None or self.regex is not None:
+                description = split.transaction.description or u''
+                if (self.text is not None and
+                    self.text not in description.lower()):
+                    continue
+                if (self.regex is not None and
+                    not self.regex.search(description)):
+                    continue
+            yield split
+
+    def page(self, number, size=50):
+        """Returns the splits of a page, numbered from 0."""
+        return list(islice(self, number * size, (number + 1) * size))
+
+    def pages(self, size=50):
+        """Yields the splits a page at a time."""
+        splits = iter(self)
+        while True:
+            page = list(islice(splits, size))
+            if not page:
+                return
+            yield page
+
+    def count(self):
+        return sum(1 for split in self)
+
+class BalanceSheet(object):
+    """A balance sheet
+
+    With depth, the accounts down to that level are listed with the
+    subtotals of their subtrees, see subtree_rows(). With currency, the
+    balances are valued in it, see valued_balances().
+    """
+    def __init__(self, book, endings, depth=None, currency=None):
+        self.endings = endings
+        self.depth = depth
+        self.currency = currency
+        tops = [book.getrootact(type)
+                for type in ('ASSET', 'LIABILITY', 'EQUITY')]
+        self.total = {}
+
+        # Get each balance of the accounts of assets, liabilities and equity
+        # from their running totals, so the number of endings hardly
+        # matters.
+        accounts = []
+        for top in tops:
+            accounts.extend(top.descendants())
+        if currency is None:
+            with gncprofile.timer('aggregate'):
+                balances = book.ending_balances(accounts, endings)
+        else:
+            balances = valued_balances(book, accounts, [
+                (date.min, ending) for ending in endings], currency)
+        self.assets, self.total['assets'] = subtree_rows(
+            book, tops[0], balances, len(endings), depth)
+        self.liabilities, self.total['liabilities'] = subtree_rows(
+            book, tops[1], balances, len(endings), depth)
+        self.equity, self.total['equity'] = subtree_rows(
+            book, tops[2], balances, len(endings), depth)
+        self.levels = {}
+        for top, rows in zip(tops, [self.assets, self.liabilities,
+                                    self.equity]):
+            self.levels.update(row_levels(book, top, rows, depth))
 
     def __str__(self):
         return self.tocsv()
 
-    def tocsv(self):
-        s = ['Period Endings, ' + ', '.join([str(d) for d in self.endings])]
-
-        s.append('- Assets:')
-        for act, balances in self.assets:
-            buf = ['%.2f' % b for b in balances]
-            s.append('%s, %s' % (act.name, ', '.join(buf)))
-        buf = ['%.2f' % b for b in self.total['assets']]
-        s.append('Total Assets, ' + ', '.join(buf))
-
-        s.append('- Liabilities:')
-        for act, balances in self.liabilities:
-            buf = ['%.2f' % b for b in balances]
-            s.append('%s, %s' % (act.name, ', '.join(buf)))
-        buf = ['%.2f' % b for b in self.total['liabilities']]
-        s.append('Total Liabilities, ' + ', '.join(buf))
-
-        s.append('- Equity:')
-        for act, balances in self.equity:
-            buf = ['%.2f' % b for b in balances]
-            s.append('%s, %s' % (act.name, ', '.join(buf)))
-        buf = ['%.2f' % b for b in self.total['equity']]
-        s.append('Total Equity, ' + ', '.join(buf))
+    def rows(self):
+        """Yields the rows of the balance sheet, see gncrender."""
+        yield ('head', 'Period Ending', self.endings, 0)
+        sections = [('Assets', self.assets, self.total['assets']),
+                    ('Liabilities', self.liabilities,
+                     self.total['liabilities']),
+                    ('Equity', self.equity, self.total['equity'])]
+        for i, (label, rows, totals) in enumerate(sections):
+            if i > 0:
+                yield ('gap', None, None, 0)
+            yield ('section', label, None, 0)
+            for act, balances in rows:
+                yield ('account', act.name, balances, self.levels[act.id])
+            yield ('total', 'Total ' + label, totals, 0)
 
-        return '\n'.join(s)
+    def tocsv(self):
+        return gncrender.CSVRenderer().tostring(self)
 
     def tohtml(self, caption=None):
-        colspan = len(self.endings) + 1
-        s = ['<table>']
-        if caption:
-            s.append('  <caption>%s</caption>' % caption)
-        s.append('  <thead>')
-        buf = ['<th>%s</th>' % str(d) for d in self.endings]
-        s.append('    <tr><th>Period Ending</th>' + ''.join(buf) + '</tr>')
-        s.append('  </thead>')
-        s.append('  <tbody>')
-
-        s.append('    <tr><td colspan="%d">Assets</td></tr>' % colspan)
-        for act, balances in self.assets:
-            buf = ['<td>%.2f</td>' % b for b in balances]
-            s.append('    <tr><td>%s</td>%s</tr>' % (act.name, ''.join(buf)))
-        buf = ['<td>%.2f</td>' % t for t in self.total['assets']]
-        s.append('    <tr><td><b>Total Assets</b></td>%s</tr>' % ''.join(buf))
-        s.append('    <tr><td colspan="%d"></td></tr>' % colspan)
-
-        s.append('    <tr><td colspan="%d">Liabilities</td></tr>' % colspan)
-        for act, balances in self.liabilities:
-            buf = ['<td>%.2f</td>' % b for b in balances]
-            s.append('    <tr><td>%s</td>%s</tr>' % (act.name, ''.join(buf)))
-        buf = ['<td>%.2f</td>' % t for t in self.total['liabilities']]
-        s.append('    <tr><td><b>Total Liabilities</b></td>%s</tr>' %
-                 ''.join(buf))
-        s.append('    <tr><td colspan="%d"></td></tr>' % colspan)
-
-        s.append('    <tr><td colspan="%d">Equity</td></tr>' % colspan)
-        for act, balances in self.equity:
-            buf = ['<td>%.2f</td>' % b for b in balances]
-            s.append('    <tr><td>%s</td>%s</tr>' % (act.name, ''.join(buf)))
-        buf = ['<td>%.2f</td>' % t for t in self.total['equity']]
-        s.append('    <tr><td><b>Total Equity</b></td>%s</tr>' % ''.join(buf))
-        s.append('  </tbody>')
-        s.append('</table>')
-        return '\n'.join(s)
+        return gncrender.HTMLRenderer(caption).tostring(self)
+
+class SplitColumns(object):
+    """A columnar store of the splits of a book.
+
+    Each split is a row across typed NumPy arrays: the index of its account
+    in book.accounts, the ordinal of its posted date, the numerator and
+    denominator of its value and the index of its transaction in
+    book.transactions. Sums over periods and accounts run as vectorized
+    operations on the whole store.
+    """
+    def __init__(self, book):
+        self.actindex = dict((act.id, i) for i, act
+                             in enumerate(book.accounts))
+        self.naccounts = len(book.accounts)
+        (self.account, self.date, self.num, self.denom,
+         self.transaction) = self._rows(book.transactions, 0)
+        self._values = None
+
+    def _rows(self, transactions, first):
+        """Returns the columns of the splits of transactions numbered from
+        first."""
+        acts, ordinals, nums, denoms, trns = [], [], [], [], []
+        for i, trn in enumerate(transactions):
+            ordinal = trn.date_posted.toordinal()
+            for split in trn.splits:
+                acts.append(self.actindex[split.accountid])
+                ordinals.append(ordinal)
+                nums.append(split.value_num)
+                denoms.append(split.value_denom)
+                trns.append(first + i)
+        return (numpy.array(acts, numpy.int32),
+                numpy.array(ordinals, numpy.int32),
+                numpy.array(nums, numpy.int64),
+                numpy.array(denoms, numpy.int64),
+                numpy.array(trns, numpy.int32))
+
+    def patch(self, book, nadded, positions=()):
+        """Drops the rows of the transactions that were at positions, sorted,
+        renumbering the rest, and appends the rows of the last nadded
+        transactions of the book."""
+        columns = [self.account, self.date, self.num, self.denom,
+                   self.transaction]
+        if len(positions):
+            positions = numpy.array(positions, numpy.int32)
+            keep = ~numpy.in1d(self.transaction, positions)
+            columns = [column[keep] for column in columns]
+            columns[4] -= numpy.searchsorted(positions, columns[4]).astype(
+                numpy.int32)
+        if nadded:
+            first = len(book.transactions) - nadded
+            rows = self._rows(book.transactions[first:], first)
+            columns = [numpy.concatenate((column, new))
+                       for column, new in zip(columns, rows)]
+        (self.account, self.date, self.num, self.denom,
+         self.transaction) = columns
+        self._values = None
+
+    def __len__(self):
+        return len(self.account)
+
+    @property
+    def nbytes(self):
+        return (self.account.nbytes + self.date.nbytes + self.num.nbytes +
+                self.denom.nbytes + self.transaction.nbytes)
+
+    def values(self):
+        """Returns the split values over a common denominator as int64, the
+        denominator and a bound of the sum of their magnitudes, or None for
+        the values where that does not fit in an int64."""
+        if self._values is None:
+            scale = common_denom([int(d) for d in numpy.unique(self.denom)])
+            values = None
+            bound = 0
+            if len(self):
+                bound = (int(numpy.abs(self.num).max()) *
+                         (scale // int(self.denom.min())) * len(self))
+            if bound < 2 ** 63 and scale < 2 ** 63:
+                values = self.num * (scale // self.denom)
+            self._values = (values, scale, bound)
+        return self._values
+
+    def period_sums(self, periods):
+        """Returns an accounts x periods array of the sums of split values
+        over a list of (start, end) periods, as numerators over a common
+        denominator, and the denominator.
+
+        The sums are exact: they are taken in floats while every partial
+        sum is a whole number below 2**53, and else in int64. Where they do
+        not fit in an int64 either, or numpy is older than 1.8 and cannot
+        add them up in int64, the array is None.
+        """
+        values, scale, bound = self.values()
+        if values is None or (bound >= 2 ** 53 and
+                              not hasattr(numpy.add, 'at')):
+            return None, scale
+        if not periods:
+            return numpy.zeros((self.naccounts, 0), numpy.int64), scale
+        bounds, spans = _segments(periods)
+        nsegs = len(bounds) - 1
+        segs = numpy.searchsorted(bounds, self.date, 'right') - 1
+        valid = (segs >= 0) & (segs < nsegs)
+        keys = self.account[valid].astype(numpy.int64) * nsegs + segs[valid]
+        if bound < 2 ** 53:
+            sums = numpy.rint(numpy.bincount(
+                keys, weights=values[valid].astype(float),
+                minlength=self.naccounts * nsegs)).astype(numpy.int64)
+        else:
+            gncprofile.count('int64 sums')
+            sums = numpy.zeros(self.naccounts * nsegs, numpy.int64)
+            numpy.add.at(sums, keys, values[valid])
+        cums = numpy.zeros((self.naccounts, nsegs + 1), numpy.int64)
+        cums[:, 1:] = numpy.cumsum(sums.reshape(self.naccounts, nsegs), axis=1)
+        lo, hi = numpy.array(spans).T
+        return cums[:, hi] - cums[:, lo], scale
+
+    def account_sums(self, start=date.min, end=date.max):
+        """Returns the sum of split values of each account over a period,
+        as numerators over a common denominator, and the denominator, see
+        period_sums()."""
+        sums, scale = self.period_sums([(start, end)])
+        if sums is None:
+            return None, scale
+        return sums[:, 0], scale
+
+def _segments(periods):
+    """Cuts the calendar at the boundaries of (start, end) periods.
+
+    Returns the sorted boundary ordinals, where segment i runs from
+    bounds[i] up to but not including bounds[i + 1], and the (first, last
+    + 1) segments spanned by each period.
+    """
+    bounds = set()
+    for start, end in periods:
+        bounds.add(start.toordinal())
+        bounds.add(end.toordinal() + 1)
+    bounds = sorted(bounds)
+    spans = [(bisect_left(bounds, start.toordinal()),
+              bisect_left(bounds, end.toordinal() + 1))
+             for start, end in periods]
+    return bounds, spans
+
+def period_balances(accounts, periods, columns=None):
+    """Returns the balances of accounts over a list of (start, end) periods.
+
+    The period boundaries cut the calendar into segments. Each split of an
+    account is added to its segment in a single pass, and the balance over
+    a period is the sum of the segments it spans, so periods can be of any
+    length and may overlap. The result maps each account id to a list of
+    balances in the order of the periods. Given a SplitColumns store, the
+    sums are taken on it instead, unless they are too large for it.
+
+    Values are summed as integer numerators over the least common
+    denominator of the splits of an account, and the balances are exact
+    Fractions.
+    """
+    balances = {}
+    sums = None
+    if columns is not None:
+        sums, scale = columns.period_sums(periods)
+    if sums is not None:
+        for act in accounts:
+            row = sums[columns.actindex[act.id]]
+            balances[act.id] = [act.signed(Fraction(int(x), scale))
+                                for x in row]
+        return balances
+
+    bounds, spans = _segments(periods)
+    nsegs = len(bounds) - 1
+    for act in accounts:
+        scale = common_denom([split.value_denom for split in act.splits])
+        sums = [0] * nsegs
+        for split in act.splits:
+            i = bisect_right(bounds, split.date().toordinal()) - 1
+            if 0 <= i < nsegs:
+                sums[i] += split.value_num * (scale // split.value_denom)
+        balances[act.id] = [act.signed(Fraction(sum(sums[lo:hi]), scale))
+                            for lo, hi in spans]
+    return balances
+
+def valued_balances(book, accounts, periods, currency):
+    """Returns the balances of accounts over periods valued in a currency.
+
+    The split quantities of each account are summed in its commodity and
+    converted at the price nearest the end of each period. The prices of a
+    commodity are looked up once for all the periods, not per split or per
+    account. Where a commodity has no price, the account keeps the sum of
+    its split values.
+    """
+    with gncprofile.timer('valuation'):
+        return _valued_balances(book, accounts, periods, currency)
+
+def _valued_balances(book, accounts, periods, currency):
+    ends = [end for start, end in periods]
+    quantities = book.period_quantities(accounts, periods)
+    rates = {}
+    values = None
+    balances = {}
+    for act in accounts:
+        commodity = act.commodity or currency
+        key = _cmdtykey(commodity)
+        if key not in rates:
+            rates[key] = book.prices.prices(commodity, currency, ends)
+        sums = quantities[act.id]
+        blns = []
+        for i, rate in enumerate(rates[key]):
+            if rate is None:
+                if values is None:
+                    values = book.period_balances(accounts, periods)
+                blns.append(values[act.id][i])
+            else:
+                blns.append(act.signed(sums[i] * rate))
+        balances[act.id] = blns
+    return balances
+
+def rollup(accounts, balances):
+    """Returns the balances of the subtrees of accounts.
+
+    balances maps the id of each account to its own balances over some
+    periods, as returned by period_balances(). With the accounts in
+    pre-order, one pass from the last to the first adds the total of each
+    subtree into its parent, so the cost is linear in accounts times
+    periods. The sums are taken before the sign of each account type is
+    applied, and the totals are signed like the account at their top.
+    """
+    raw = {}
+    for act in accounts:
+        raw[act.id] = [act.signed(bln) for bln in balances[act.id]]
+    for act in reversed(accounts):
+        parent = raw.get(act.pid)
+        if parent is not None:
+            for i, bln in enumerate(raw[act.id]):
+                parent[i] += bln
+    totals = {}
+    for act in accounts:
+        totals[act.id] = [act.signed(bln) for bln in raw[act.id]]
+    return totals
+
+def subtree_rows(book, top, balances, ncols, depth=None):
+    """Returns the (account, balances) rows of the descendants of an account
+    and their column totals.
+
+    Without depth, every descendant is listed with its own balances. With
+    depth, only the accounts down to depth levels below top are listed,
+    none with a depth of 0, each with the balances of its whole subtree,
+    so a parent shows the subtotal of the rows nested under it and the
+    totals add up the children of top.
+    """
+    index = book.accountindex()
+    accounts = index.descendants(top)
+    if depth is None:
+        rows = [(act, list(balances[act.id])) for act in accounts]
+        return rows, column_totals(rows, ncols)
+    subtotals = rollup(accounts, balances)
+    base = index.depth[top.id]
+    rows = [(act, subtotals[act.id]) for act in accounts
+            if index.depth[act.id] - base <= depth]
+    return rows, column_totals([(act, subtotals[act.id]) for act in accounts
+                                if act.pid == top.id], ncols)
+
+def row_levels(book, top, rows, depth=None):
+    """Returns the level of the account of each of the rows of a subtree by
+    id, 0 for the children of top and one more for each level below, or 0
+    for all without depth, when the rows are not nested subtotals."""
+    if depth is None:
+        return dict((act.id, 0) for act, balances in rows)
+    index = book.accountindex()
+    base = index.depth[top.id] + 1
+    return dict((act.id, index.depth[act.id] - base) for act, balances in rows)
+
+def column_totals(rows, ncols):
+    """Returns the column sums of (account, balances) rows."""
+    totals = [0] * ncols
+    for act, balances in rows:
+        for i, bln in enumerate(balances):
+            totals[i] += bln
+    return totals
+
+def monthly_periods(year):
+    """Returns the (first date, last date) of each month of a year."""
+    return [(first_date_of_month(year, m), last_date_of_month(year, m))
+            for m in range(1, 13)]
+
+_viewmonths = {'monthly': 1, 'quarterly': 3, 'annual': 12}
+
+def period_endings(start, end, view='annual'):
+    """Returns the last dates of the months, quarters or years from the
+    one of start to the one of end, the latest first."""
+    months = _viewmonths[view]
+    year = start.year
+    month = ((start.month - 1) // months + 1) * months
+    endings = []
+    while True:
+        endings.append(last_date_of_month(year, month))
+        if (year, month) >= (end.year, end.month):
+            break
+        month += months
+        if month > 12:
+            year, month = year + 1, month - 12
+    endings.reverse()
+    return endings
 
 def first_date_of_month(year, month):
     return date(year, month, 1)
@@ -424,30 +1908,34 @@ monthnames = ['January', 'February', 'March', 'April', 'May', 'June',
               'July','August', 'September', 'October', 'November', 'December']
 
 class IncomeStm(object):
-    """An income statement"""
-    def __init__(self, book, periods, view='monthly'):
+    """An income statement
+
+    With depth, the accounts down to that level are listed with the
+    subtotals of their subtrees, see subtree_rows(). With currency, the
+    balances are valued in it, see valued_balances().
+    """
+    def __init__(self, book, periods, view='monthly', balances=None,
+                 depth=None, currency=None):
         self.periods = periods
-        self.incomes = [(ac, []) for ac in
-                        book.getrootact('INCOME').descendants()]
-        self.expenses = [(ac, []) for ac in
-                         book.getrootact('EXPENSE').descendants()]
-        self.total = {'incomes': [], 'expenses': []}
-
-        # Get each balance of the income and expense accounts
-        for beginning, ending in periods:
-            total = 0
-            for ac, balances in self.incomes:
-                bln = ac.balance(beginning, ending)
-                balances.append(bln)
-                total += bln
-            self.total['incomes'].append(total)
-
-            total = 0
-            for ac, balances in self.expenses:
-                bln = ac.balance(beginning, ending)
-                balances.append(bln)
-                total += bln
-            self.total['expenses'].append(total)
+        self.depth = depth
+        self.currency = currency
+        income = book.getrootact('INCOME')
+        expense = book.getrootact('EXPENSE')
+        self.total = {}
+
+        # Get each balance of the income and expense accounts, unless the
+        # balances over the periods were aggregated beforehand.
+        accounts = income.descendants() + expense.descendants()
+        if balances is None and currency is not None:
+            balances = valued_balances(book, accounts, periods, currency)
+        elif balances is None:
+            balances = book.period_balances(accounts, periods)
+        self.incomes, self.total['incomes'] = subtree_rows(
+            book, income, balances, len(periods), depth)
+        self.expenses, self.total['expenses'] = subtree_rows(
+            book, expense, balances, len(periods), depth)
+        self.levels = row_levels(book, income, self.incomes, depth)
+        self.levels.update(row_levels(book, expense, self.expenses, depth))
 
         # Filter out accounts containing only zero balances
         self.incomes = filter(lambda p: sum(p[1]) != 0, self.incomes)
@@ -456,83 +1944,304 @@ class IncomeStm(object):
     def __str__(self):
         return self.tocsv()
 
-    def tocsv(self):
-        s = []
-        s.append('Incomes:')
+    def columns(self):
+        """Returns the names of the months of a monthly statement, or else
+        the last dates of the periods."""
+        if self.periods and self.periods == monthly_periods(
+                self.periods[0][0].year):
+            return monthnames
+        return [end for start, end in self.periods]
+
+    def rows(self):
+        """Yields the rows of the income statement, see gncrender."""
+        yield ('head', 'Period Ending', self.columns(), 0)
+        yield ('section', 'Incomes', None, 0)
         for act, balances in self.incomes:
-            buf = ['%.2f' % b for b in balances]
-            s.append('%s, %s' % (act.name, ', '.join(buf)))
-        buf = ['%.2f' % t for t in self.total['incomes']]
-        s.append('Total Income, ' + ', '.join(buf) + '\n')
-
-        s.append('Expenses:')
+            yield ('account', act.name, balances, self.levels[act.id])
+        yield ('total', 'Total Incomes', self.total['incomes'], 0)
+        yield ('gap', None, None, 0)
+        yield ('section', 'Expenses', None, 0)
         for act, balances in self.expenses:
-            buf = ['%.2f' % b for b in balances]
-            s.append('%s, %s' % (act.name, ', '.join(buf)))
-        buf = ['%.2f' % t for t in self.total['expenses']]
-        s.append('Total Expenses, ' + ', '.join(buf) + '\n')
-
-        buf = ['%.2f' % (i - e) for i, e
-               in zip(self.total['incomes'], self.total['expenses'])]
-        s.append('Net Income, ' + ', '.join(buf))
-        return '\n'.join(s)
+            yield ('account', act.name, balances, self.levels[act.id])
+        yield ('total', 'Total Expenses', self.total['expenses'], 0)
+        yield ('gap', None, None, 0)
+        yield ('total', 'Net Income', [i - e for i, e in
+            zip(self.total['incomes'], self.total['expenses'])], 0)
+
+    def tocsv(self):
+        return gncrender.CSVRenderer().tostring(self)
 
     def tohtml(self, caption=None):
-        ncols = len(self.periods) + 1
-        s = ['<table>']
-        if caption:
-            s.append('  <caption>%s</caption>' % caption)
-        s.append('  <thead>')
-        buf = ['<th>%s</th>' % m for m in monthnames]
-        s.append('    <tr><th>Period Ending</th>%s</tr>' % ''.join(buf))
-        s.append('  </thead>')
-
-        s.append('  <tbody>')
-        s.append('    <tr><td colspan="%d">Incomes</td></tr>' % ncols)
-        for act, balances in self.incomes:
-            buf = ['<td>%.2f</td>' % b for b in balances]
-            s.append('    <tr><td>%s</td>%s</tr>' % (act.name, ''.join(buf)))
-        buf = ['<td>%.2f</td>' % t for t in self.total['incomes']]
-        s.append('    <tr><td><b>Total Incomes</b></td>%s</tr>' % ''.join(buf))
-        s.append('    <tr><td colspan="%d"></td></tr>' % ncols)
+        return gncrender.HTMLRenderer(caption).tostring(self)
+
+class Loader(object):
+    """Loads a book from a file of one format.
+
+    A loader is picked by the first bytes of a file, see detect().
+    """
+    def load(self, source, processes=None, skip=()):
+        """Returns the first book of a file, given by its name or as a file
+        object reading from its start."""
+        raise NotImplementedError
+
+class XMLLoader(Loader):
+    """Loads an uncompressed XML book."""
+    def open(self, source):
+        if type(source) is str:
+            return open(source, 'rb')
+        return source
+
+    def load(self, source, processes=None, skip=()):
+        fileobj = self.open(source)
+        book = Book()
+        prof = gncprofile.current()
+        if processes:
+            with gncprofile.timer('decompress'):
+                data = fileobj.read()
+            parallel_load(book, data, processes, skip=skip)
+        elif prof is not None:
+            book.load(gncprofile.TimedReader(fileobj, prof, 'decompress'),
+                      skip)
+        else:
+            book.load(fileobj, skip)
+        return book
+
+class GzipXMLLoader(XMLLoader):
+    """Loads a gzipped XML book, the default format of GnuCash.
+
+    GzipFile seeks in its file, so a file object that cannot seek is
+    decompressed by a GunzipReader instead.
+    """
+    def open(self, source):
+        if type(source) is str:
+            return gzip.GzipFile(source)
+        if isinstance(source, PrefixReader):
+            return GunzipReader(source)
+        return gzip.GzipFile(fileobj=source)
+
+class SQLiteLoader(Loader):
+    """Loads a SQLite book, see gncsqlite."""
+    def load(self, source, processes=None, skip=()):
+        import gncsqlite
+        return gncsqlite.load(source)
+
+# The loaders by the first bytes of their files.
+loaders = [
+    ('\x1f\x8b', GzipXMLLoader),
+    ('SQLite format 3\x00', SQLiteLoader),
+    ('<', XMLLoader),
+    ('\xef\xbb\xbf<', XMLLoader),
+]
+
+class PrefixReader(object):
+    """A file object that reads some bytes already read from another one
+    and then the rest of it."""
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), ''
+        elif size <= len(self.prefix):
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        else:
+            data = self.prefix + self.fileobj.read(size - len(self.prefix))
+            self.prefix = ''
+        return data
+
+class GunzipReader(object):
+    """A file object that decompresses a gzip stream read from another one
+    a chunk at a time, without seeking in it."""
+    chunksize = 64 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buf = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.fileobj.read(self.chunksize)
+            if not data:
+                self.buf += self.decompressor.flush()
+                self.eof = True
+                break
+            self.buf += self.decompressor.decompress(data)
+            # A gzip file may hold several members one after another.
+            while self.decompressor.unused_data:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.buf += self.decompressor.decompress(data)
+        if size < 0:
+            data, self.buf = self.buf, ''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
 
-        s.append('    <tr><td colspan="%d">Expenses</td></tr>' % ncols)
-        for act, balances in self.expenses:
-            buf = ['<td>%.2f</td>' % b for b in balances]
-            s.append('    <tr><td>%s</td>%s</tr>' % (act.name, ''.join(buf)))
-        buf = ['<td>%.2f</td>' % t for t in self.total['expenses']]
-        s.append('    <tr><td><b>Total Expenses</b></td>%s</tr>' % ''.join(buf))
-        s.append('    <tr><td colspan="%d"></td></tr>' % ncols)
-
-        buf = ['<td>%.2f</td>' % (i - e) for i, e in
-               zip(self.total['incomes'], self.total['expenses'])]
-        s.append('    <tr><td><b>Net Income</b></td>%s</tr>' % ''.join(buf))
-        s.append('  </tbody>')
-        s.append('</table>')
-        return '\n'.join(s)
+def detect(source):
+    """Returns the loader of a file, given by its name or as a file object,
+    and the source to hand it.
 
-def gncopen(source):
-    """Open a GnuCash file, parse it, and return the first book."""
-    gzipfile = None
+    The format is told by the first bytes of the file. A file object is
+    read from where it is and sought back if it can seek, or else handed on
+    as a PrefixReader that reads those bytes again.
+    """
     if type(source) is str:
-        gzipfile = gzip.GzipFile(source)
+        with open(source, 'rb') as f:
+            head = f.read(16)
     else:
-        gzipfile = gzip.GzipFile(fileobj=source)
-    tree = etree.parse(gzipfile)
-    book = _find(tree.getroot(), 'gnc:book')
-    return Book(book)
+        try:
+            pos = source.tell()
+        except (AttributeError, IOError, OSError):
+            pos = None
+        head = source.read(16)
+        if pos is not None:
+            try:
+                source.seek(pos)
+            except (AttributeError, IOError, OSError):
+                pos = None
+        if pos is None:
+            source = PrefixReader(head, source)
+    for magic, loader in loaders:
+        if head.startswith(magic):
+            return loader(), source
+    if head.lstrip().startswith('<'):
+        return XMLLoader(), source
+    raise ValueError('not a GnuCash file')
+
+def gncopen(source, processes=None, skip=(), ceiling=None):
+    """Open a GnuCash file, parse it, and return the first book.
+
+    The file may be gzipped or plain XML or a SQLite database, see
+    detect(). With processes, the transactions of an XML file are parsed in
+    that many worker processes, see parallel_load(). The transaction fields
+    named in skip are not decoded, see Transaction. With a ceiling in MB,
+    the book is spilled to a temporary store once the process grows past
+    it where one can be made, see gncsqlite.spool().
+    """
+    loader, source = detect(source)
+    with gncprofile.timer('load'):
+        if ceiling is not None:
+            # Spilling needs sqlite3, and without it the book is loaded
+            # as usual.
+            try:
+                import gncsqlite
+            except ImportError:
+                gncsqlite = None
+            if gncsqlite is not None:
+                return gncsqlite.spool(loader, source, ceiling, skip)
+        return loader.load(source, processes, skip)
+
+_trnstart = re.compile(r'<gnc:transaction[\s>]')
+_trnend = '</gnc:transaction>'
+
+def parallel_load(book, data, processes, chunks=None, skip=()):
+    """Load a book from an XML document, parsing its transactions in a pool
+    of worker processes.
+
+    The run of gnc:transaction elements of the book is cut into chunks at
+    element boundaries. Each chunk is parsed by a worker into the packed
+    form of its transactions, and the parent links them into the accounts
+    in document order, so the book is the same as a serial load. The rest
+    of the document is loaded in the parent as usual.
+    """
+    import multiprocessing
+
+    # Template transactions of scheduled transactions come after the
+    # transactions of the book and are left to the serial load.
+    limit = data.find('<gnc:template-transactions')
+    if limit < 0:
+        limit = len(data)
+    match = _trnstart.search(data, 0, limit)
+    if match is None:
+        book.load(StringIO(data), skip)
+        return
+    start = match.start()
+    end = data.rfind(_trnend, start, limit) + len(_trnend)
+    book.load(StringIO(data[:start] + data[end:]), skip)
+
+    # The transactions are wrapped in the root element of the document so
+    # that the namespace prefixes resolve.
+    rootstart = data.index('<gnc-v2')
+    header = data[:data.index('>', rootstart) + 1]
+    footer = '</gnc-v2>'
+    if chunks is None:
+        chunks = processes * 4
+    size = max((end - start) // chunks, 1)
+    docs = []
+    while start < end:
+        match = _trnstart.search(data, start + size, end)
+        cut = match and match.start() or end
+        docs.append((header + data[start:cut] + footer, skip))
+        start = cut
+
+    gncprofile.count('chunks', len(docs))
+    pool = multiprocessing.Pool(processes)
+    try:
+        with gncprofile.timer('parallel'):
+            for packs in pool.imap(_packtransactions, docs):
+                for item in packs:
+                    trn = Transaction()
+                    trn.unpack(item)
+                    book._addtransaction(trn)
+    finally:
+        pool.close()
+        pool.join()
+
+def _packtransactions(args):
+    """Returns the packed transactions of an XML document."""
+    doc, skip = args
+    trntag = nstag('gnc:transaction')
+    packs = []
+    for event, elm in etree.iterparse(StringIO(doc)):
+        if elm.tag == trntag:
+            packs.append(Transaction(elm, skip).pack())
+            elm.clear()
+    return packs
 
 def main():
     import sys
     from optparse import OptionParser
 
     parser = OptionParser(usage="Usage: %prog <filename> [year [month]]")
+    parser.add_option("--cache", metavar="DIR",
+                      help="keep snapshots of parsed books in DIR")
+    parser.add_option("--processes", type="int", metavar="N",
+                      help="parse transactions in N worker processes")
+    parser.add_option("--format", default="csv",
+                      choices=sorted(gncrender.renderers.keys()),
+                      help="write the statement as csv, html or json")
+    parser.add_option("--currency", metavar="CODE",
+                      help="value the balances in the currency CODE")
+    parser.add_option("--profile", action="store_true",
+                      help="print the time and counts of each stage to stderr")
+    parser.add_option("--profile-json", metavar="FILE",
+                      help="write the time and counts of each stage to FILE")
+    parser.add_option("--batch", metavar="SPEC",
+                      help="make the reports of the books in SPEC, see gncbatch")
+    parser.add_option("--outdir", default=".", metavar="DIR",
+                      help="write the reports of a batch to DIR")
     options, args = parser.parse_args()
+    if options.batch:
+        import gncbatch
+        sys.exit(not gncbatch.batch(options.batch, options.outdir,
+                                    options.processes, options.cache))
     if len(args) < 1:
         parser.error("no Gnucash file")
+    if options.profile or options.profile_json:
+        gncprofile.start()
 
     try:
-        book = gncopen(args[0])
+        if options.cache:
+            import gnccache
+            cache = gnccache.BookCache(gnccache.DirectoryStore(options.cache))
+            book = cache.open(args[0])
+        else:
+            book = gncopen(args[0], options.processes)
     except:
         sys.stderr.write("cannot open file '{0}'\n".format(args[0]))
         sys.exit(1)
@@ -542,13 +2251,24 @@ def main():
     year = len(args) >= 2 and args[1] or today.year
     month = len(args) >= 3 and args[2] or today.month
     if len(args) == 1:
-        print book.monthly_income_stm(date.today().year)
+        stm = book.monthly_income_stm(date.today().year,
+                                      currency=options.currency)
     elif len(args) == 2:
-        print book.monthly_income_stm(int(args[1]))
+        stm = book.monthly_income_stm(int(args[1]),
+                                      currency=options.currency)
     else:
         year, month = (int(args[1]), int(args[2]))
-        print book.income_stm(first_date_of_month(year, month),
-                              last_date_of_month(year, month))
+        stm = book.income_stm(first_date_of_month(year, month),
+                              last_date_of_month(year, month),
+                              currency=options.currency)
+    gncrender.write(stm, sys.stdout, options.format)
+
+    profiler = gncprofile.stop()
+    if options.profile:
+        sys.stderr.write(str(profiler) + '\n')
+    if options.profile_json:
+        with open(options.profile_json, 'w') as f:
+            f.write(profiler.tojson() + '\n')
 
 if __name__ == "__main__":
     main()
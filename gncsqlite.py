@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+"""Reads GnuCash books saved as SQLite databases.
+
+A SQLiteBook is a Book loaded from the accounts, transactions, splits and
+prices tables of the database, so every report works on it as on an XML
+book. The sums of the splits over periods, which make up the income
+statements, are taken by grouped SQL over the post_date index of the
+transactions table instead of over the splits in memory, see SQLColumns.
+
+GnuCash stores the posted dates in UTC, and the date of a split is the UTC
+date of its transaction. The databases written here add the local posted
+day and UTC offset of each transaction, post_day and post_offset, and the
+dates of their splits are the local dates as in an XML book.
+
+save() writes a Book in the same tables, for making SQLite books to test
+with from XML ones.
+
+A SpoolBook loads an XML book in memory until the process grows past a
+ceiling, and then spills its transactions to a temporary SQLite store and
+reads on without keeping them. The book it leaves is a lazy SQLiteBook,
+which holds only the accounts and prices and takes the balances of the
+statements with SQL, and reads the transactions that ledgers and queries
+ask for.
+"""
+import os
+import shutil
+import logging
+import sqlite3
+import hashlib
+import tempfile
+from datetime import date
+from fractions import Fraction
+
+import gncprofile
+import gncreports
+from gncreports import (Book, Transaction, TokenIndex, FixedOffset,
+                        common_denom, parse_timestamp, _segments)
+
+# GnuCash names the namespace of currencies ISO4217 in XML and CURRENCY in
+# SQL. The books use the XML name, which the price database looks up.
+_namespaces = {'CURRENCY': 'ISO4217'}
+
+_tzinfos = {}
+
+def _posted(text, offset):
+    """Returns the posted datetime of a SQL timestamp in UTC, in its local
+    time if the offset in minutes is known."""
+    when = parse_timestamp(_timestamp(text))
+    if offset:
+        try:
+            tz = _tzinfos[offset]
+        except KeyError:
+            tz = _tzinfos[offset] = FixedOffset(offset)
+        when = when.astimezone(tz)
+    return when
+
+def _timestamp(text):
+    """Returns a 'YYYY-MM-DD HH:MM:SS' timestamp of a SQL one, which older
+    versions of GnuCash write as 'YYYYMMDDHHMMSS'."""
+    if text is None:
+        return None
+    if len(text) == 14:
+        return '%s-%s-%s %s:%s:%s' % (text[0:4], text[4:6], text[6:8],
+                                      text[8:10], text[10:12], text[12:14])
+    return text[:19]
+
+class SQLiteBook(Book):
+    """A book read from a SQLite database.
+
+    With temporary, the file is removed once the book is closed. A lazy
+    book does not keep the transactions and splits: the sums of the
+    statements are taken with SQL, and the splits of an account, as for
+    its balances or ledger, and the transactions of a date range or a
+    query are read when they are asked for.
+    """
+    def __init__(self, filename, temporary=False, lazy=False):
+        Book.__init__(self)
+        self.filename = filename
+        self.temporary = temporary
+        self.lazy = lazy
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        sample = self.db.execute(
+            'SELECT post_date FROM transactions LIMIT 1').fetchone()
+        self._compactdates = bool(sample and sample[0] and
+                                  len(sample[0]) == 14)
+        self._localdays = 'post_day' in [row[1] for row in self.db.execute(
+            'PRAGMA table_info(transactions)')]
+        self._offset = self._localdays and 'post_offset' or 'NULL'
+        self.unpack(self._read())
+
+    def _read(self):
+        """Returns the book in the tuples of Book.pack()."""
+        db = self.db
+        cmdties = {}
+        for guid, space, id, source in db.execute(
+                'SELECT guid, namespace, mnemonic, quote_source '
+                'FROM commodities'):
+            cmdties[guid] = (_namespaces.get(space, space), id, source)
+
+        bookid, rootid = db.execute(
+            'SELECT guid, root_account_guid FROM books').fetchone()
+
+        # Only the accounts under the root of the book are read, not those
+        # of the template transactions, and each after its parent.
+        rows = {}
+        children = {}
+        for row in db.execute(
+                'SELECT guid, name, account_type, description, parent_guid, '
+                'commodity_guid FROM accounts'):
+            rows[row[0]] = row
+            children.setdefault(row[4], []).append(row[0])
+        accounts = []
+        queue = [rootid]
+        while queue:
+            id, name, type, desc, parent, cmdty = rows[queue.pop(0)]
+            accounts.append((id, name, type, desc or None,
+                             accounts and parent or None, cmdties.get(cmdty)))
+            queue.extend(children.get(id, ()))
+        actids = set([act[0] for act in accounts])
+
+        splits = {}
+        transactions = []
+        if not self.lazy:
+            for row in db.execute(
+                    'SELECT tx_guid, guid, value_num, value_denom, '
+                    'quantity_num, quantity_denom, account_guid FROM splits'):
+                splits.setdefault(row[0], []).append(row[1:])
+            for id, currency, posted, offset, entered, desc in db.execute(
+                    'SELECT guid, currency_guid, post_date, %s, enter_date, '
+                    'description FROM transactions ORDER BY post_date' %
+                    self._offset):
+                items = splits.get(id, [])
+                if [item for item in items if item[5] not in actids]:
+                    continue
+                transactions.append((
+                    id, cmdties.get(currency), _posted(posted, offset),
+                    _timestamp(entered), desc and gncreports._compact(desc),
+                    items))
+        self._cmdties = cmdties
+
+        prices = []
+        for cmdty, currency, when, num, denom in db.execute(
+                'SELECT commodity_guid, currency_guid, date, value_num, '
+                'value_denom FROM prices'):
+            prices.append((cmdties[cmdty], cmdties[currency],
+                           parse_timestamp(_timestamp(when)).date(), num,
+                           denom))
+
+        commodity = None
+        for row in db.execute(
+                "SELECT guid FROM commodities WHERE namespace = 'CURRENCY' "
+                'ORDER BY rowid LIMIT 1'):
+            commodity = cmdties[row[0]]
+        return bookid, commodity, accounts, transactions, prices
+
+    def _transaction(self, order):
+        """Returns the first transaction of the book in an order, without
+        its splits."""
+        day = self._localdays and 'post_day %s, ' % order or ''
+        row = self.db.execute(
+            'SELECT guid, currency_guid, post_date, %s, enter_date, '
+            'description FROM transactions ORDER BY %spost_date %s LIMIT 1' %
+            (self._offset, day, order)).fetchone()
+        id, currency, posted, offset, entered, desc = row
+        trn = Transaction()
+        trn.unpack((id, self._cmdties.get(currency), _posted(posted, offset),
+                    _timestamp(entered), desc and gncreports._compact(desc),
+                    []))
+        return trn
+
+    def _select(self, where, params=()):
+        """Reads the transactions of a condition on the transactions table
+        in date order, with their splits, leaving out those of accounts
+        outside the book."""
+        splits = {}
+        for row in self.db.execute(
+                'SELECT tx_guid, guid, value_num, value_denom, quantity_num, '
+                'quantity_denom, account_guid FROM splits WHERE tx_guid IN '
+                '(SELECT guid FROM transactions WHERE %s)' % where, params):
+            splits.setdefault(row[0], []).append(row[1:])
+        day = self._localdays and 'post_day, ' or ''
+        trns = []
+        for id, currency, posted, offset, entered, desc in self.db.execute(
+                'SELECT guid, currency_guid, post_date, %s, enter_date, '
+                'description FROM transactions WHERE %s ORDER BY %spost_date' %
+                (self._offset, where, day), params):
+            items = splits.get(id, [])
+            if [item for item in items if item[5] not in self.actdic]:
+                continue
+            trn = Transaction()
+            trn.unpack((id, self._cmdties.get(currency),
+                        _posted(posted, offset), _timestamp(entered),
+                        desc and gncreports._compact(desc), items))
+            for split in trn.splits:
+                split.transaction = trn
+                split.account = self.actdic[split.accountid]
+            trns.append(trn)
+        gncprofile.count('transactions read', len(trns))
+        return trns
+
+    def _accountsplits(self, act):
+        if not self.lazy:
+            return Book._accountsplits(self, act)
+        return [split for trn in self._select(
+                    'guid IN (SELECT tx_guid FROM splits '
+                    'WHERE account_guid = ?)', (act.id,))
+                for split in trn.splits if split.account is act]
+
+    def _transactions(self, ids):
+        if not self.lazy:
+            return Book._transactions(self, ids)
+        ids = list(ids)
+        trns = []
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            trns.extend(self._select('guid IN (%s)' %
+                                     ', '.join(['?'] * len(batch)), batch))
+        return trns
+
+    def transactions_between(self, start=date.min, end=date.max):
+        if not self.lazy:
+            return Book.transactions_between(self, start, end)
+        columns = self.columns()
+        return self._select('%s >= ? AND %s < ?' % (columns.datecol,
+                                                    columns.datecol),
+                            (columns._bound(start.toordinal()),
+                             columns._bound(end.toordinal() + 1)))
+
+    def timeline(self):
+        if not self.lazy:
+            return Book.timeline(self)
+        if self._timeline is None:
+            trns = self.transactions_between()
+            self._timeline = ([trn.date_posted.date() for trn in trns], trns)
+        return self._timeline
+
+    def tokenindex(self):
+        if not self.lazy:
+            return Book.tokenindex(self)
+        if self._tokenindex is None:
+            index = TokenIndex(self)
+            for id, desc in self.db.execute(
+                    'SELECT guid, description FROM transactions'):
+                trn = Transaction()
+                trn.unpack((id, None, None, None,
+                            desc and gncreports._compact(desc), []))
+                index.add(trn)
+            self._tokenindex = index
+        return self._tokenindex
+
+    def period_quantities(self, accounts, periods):
+        if not self.lazy:
+            return Book.period_quantities(self, accounts, periods)
+        columns = self.columns()
+        sums, scale = columns.period_sums(periods, 'quantity')
+        return dict((act.id, [Fraction(x, scale)
+                              for x in sums[columns.actindex[act.id]]])
+                    for act in accounts)
+
+    def first_transaction(self):
+        if not self.lazy:
+            return Book.first_transaction(self)
+        return self._transaction('ASC')
+
+    def last_transaction(self):
+        if not self.lazy:
+            return Book.last_transaction(self)
+        return self._transaction('DESC')
+
+    def ending_balances(self, accounts, endings):
+        if not self.lazy:
+            return Book.ending_balances(self, accounts, endings)
+        return self.period_balances(accounts, [(date.min, ending)
+                                               for ending in endings])
+
+    def columns(self):
+        """Returns the splits as a SQLColumns store."""
+        if self._columns is None:
+            self._columns = SQLColumns(self)
+        return self._columns
+
+    def close(self):
+        self.db.close()
+        if self.temporary:
+            os.remove(self.filename)
+
+class SQLColumns(object):
+    """Takes the sums of the splits over periods with SQL, in the manner
+    of gncreports.SplitColumns."""
+    def __init__(self, book):
+        self.db = book.db
+        self.compactdates = book._compactdates
+        self.localdays = book._localdays
+        self.datecol = book._localdays and 'post_day' or 'post_date'
+        self.actindex = dict((act.id, i) for i, act
+                             in enumerate(book.accounts))
+        self.naccounts = len(book.accounts)
+        self.scales = {}
+        self.scale = self._scale('value')
+
+    def _scale(self, column):
+        """Returns the common denominator of a value or quantity column."""
+        if column not in self.scales:
+            self.scales[column] = common_denom([
+                row[0] for row in self.db.execute(
+                    'SELECT DISTINCT %s_denom FROM splits' % column)])
+        return self.scales[column]
+
+    def _bound(self, ordinal):
+        """Returns the post_day or post_date text of the start of a day."""
+        if ordinal > date.max.toordinal():
+            return '99999'
+        if self.localdays:
+            return date.fromordinal(ordinal).isoformat()
+        if self.compactdates:
+            return date.fromordinal(ordinal).strftime('%Y%m%d000000')
+        return date.fromordinal(ordinal).isoformat() + ' 00:00:00'
+
+    def period_sums(self, periods, column='value'):
+        """Returns an accounts x periods list of the sums of split values,
+        or quantities by column, over a list of (start, end) periods, as
+        numerators over a common denominator, and the denominator.
+
+        The periods are cut into segments as by period_balances(), and the
+        sums of each segment are one grouped query over a range of the
+        post days, or of the post dates in UTC.
+        """
+        scale = self._scale(column)
+        sums = [[0] * len(periods) for i in range(self.naccounts)]
+        if not periods:
+            return sums, scale
+        bounds, spans = _segments(periods)
+        segsums = []
+        for lo, hi in zip(bounds, bounds[1:]):
+            seg = {}
+            for id, denom, total in self.db.execute(
+                    'SELECT s.account_guid, s.%s_denom, SUM(s.%s_num) '
+                    'FROM splits s JOIN transactions t ON s.tx_guid = t.guid '
+                    'WHERE t.%s >= ? AND t.%s < ? '
+                    'GROUP BY s.account_guid, s.%s_denom' %
+                    (column, column, self.datecol, self.datecol, column),
+                    (self._bound(lo), self._bound(hi))):
+                i = self.actindex.get(id)
+                if i is not None:
+                    seg[i] = seg.get(i, 0) + total * (scale // denom)
+            segsums.append(seg)
+        for j, (lo, hi) in enumerate(spans):
+            for seg in segsums[lo:hi]:
+                for i, total in seg.items():
+                    sums[i][j] += total
+        return sums, scale
+
+def load(source, lazy=False):
+    """Returns the SQLiteBook of a database, given by its file name or as a
+    file object, which is copied to a temporary file."""
+    if type(source) is str:
+        return SQLiteBook(source, lazy=lazy)
+    fd, filename = tempfile.mkstemp(suffix='.gnucash')
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(source, f)
+    return SQLiteBook(filename, temporary=True, lazy=lazy)
+
+_schema = '''
+CREATE TABLE books (guid TEXT PRIMARY KEY, root_account_guid TEXT,
+                    root_template_guid TEXT);
+CREATE TABLE commodities (guid TEXT PRIMARY KEY, namespace TEXT,
+                          mnemonic TEXT, fullname TEXT, cusip TEXT,
+                          fraction INTEGER, quote_flag INTEGER,
+                          quote_source TEXT, quote_tz TEXT);
+CREATE TABLE accounts (guid TEXT PRIMARY KEY, name TEXT, account_type TEXT,
+                       commodity_guid TEXT, commodity_scu INTEGER,
+                       non_std_scu INTEGER, parent_guid TEXT, code TEXT,
+                       description TEXT, hidden INTEGER,
+                       placeholder INTEGER);
+CREATE TABLE transactions (guid TEXT PRIMARY KEY, currency_guid TEXT,
+                           num TEXT, post_date TEXT, enter_date TEXT,
+                           description TEXT, post_day TEXT,
+                           post_offset INTEGER);
+CREATE INDEX tx_post_date_index ON transactions (post_date);
+CREATE INDEX tx_post_day_index ON transactions (post_day);
+CREATE TABLE splits (guid TEXT PRIMARY KEY, tx_guid TEXT,
+                     account_guid TEXT, memo TEXT, action TEXT,
+                     reconcile_state TEXT, reconcile_date TEXT,
+                     value_num BIGINT, value_denom BIGINT,
+                     quantity_num BIGINT, quantity_denom BIGINT,
+                     lot_guid TEXT);
+CREATE INDEX splits_tx_guid_index ON splits (tx_guid);
+CREATE INDEX splits_account_guid_index ON splits (account_guid);
+CREATE TABLE prices (guid TEXT PRIMARY KEY, commodity_guid TEXT,
+                     currency_guid TEXT, date TEXT, source TEXT, type TEXT,
+                     value_num BIGINT, value_denom BIGINT);
+'''
+
+def _utc(when):
+    """Returns the SQL timestamp of an aware datetime."""
+    return (when - when.utcoffset()).strftime('%Y-%m-%d %H:%M:%S')
+
+class SQLiteStore(object):
+    """Writes a book to a new SQLite database in the tables of GnuCash, an
+    object at a time.
+
+    The transactions and splits are inserted in batches of batchsize.
+    """
+    batchsize = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(_schema)
+        self._guids = {}
+        self._trns = []
+        self._splits = []
+
+    def commodity(self, data):
+        """Returns the guid of packed commodity data, adding it once."""
+        if data is None:
+            return None
+        key = tuple(data[:2])
+        if key not in self._guids:
+            self._guids[key] = hashlib.md5(':'.join(key)).hexdigest()
+            space = key[0] == 'ISO4217' and 'CURRENCY' or key[0]
+            self.db.execute(
+                'INSERT INTO commodities (guid, namespace, mnemonic, '
+                'fraction, quote_source) VALUES (?, ?, ?, 100, ?)',
+                (self._guids[key], space, key[1], data[2]))
+        return self._guids[key]
+
+    def addbook(self, book):
+        """Adds the book, its commodity and its accounts."""
+        self.commodity(book.commodity and book.commodity.pack())
+        self.db.execute(
+            'INSERT INTO books (guid, root_account_guid) VALUES (?, ?)',
+            (book.id, book.accounts[0].id))
+        for act in book.accounts:
+            self.addaccount(act)
+
+    def addaccount(self, act):
+        self.db.execute(
+            'INSERT INTO accounts (guid, name, account_type, '
+            'commodity_guid, parent_guid, description) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (act.id, act.name, act.type,
+             self.commodity(act.commodity and act.commodity.pack()), act.pid,
+             act.description))
+
+    def addtransaction(self, trn):
+        entered = trn.date_entered
+        posted = trn.date_posted
+        self._trns.append((trn.id, self.commodity(trn._currency),
+                           _utc(posted), entered and _utc(entered),
+                           trn.description, posted.date().isoformat(),
+                           posted.utcoffset().days * 1440 +
+                           posted.utcoffset().seconds // 60))
+        self._splits.extend([(split.id, trn.id, split.accountid,
+                              split.value_num, split.value_denom,
+                              split.quantity_num, split.quantity_denom)
+                             for split in trn.splits])
+        if len(self._trns) >= self.batchsize:
+            self.flush()
+
+    def addprices(self, prices):
+        for data in prices.pack():
+            cmdty, currency, when, num, denom = data
+            self.db.execute(
+                'INSERT INTO prices (guid, commodity_guid, currency_guid, '
+                'date, value_num, value_denom) VALUES (?, ?, ?, ?, ?, ?)',
+                (hashlib.md5(repr(data)).hexdigest(), self.commodity(cmdty),
+                 self.commodity(currency), when.isoformat() + ' 00:00:00',
+                 num, denom))
+
+    def flush(self):
+        """Inserts the transactions and splits added since the last
+        flush."""
+        self.db.executemany(
+            'INSERT INTO transactions (guid, currency_guid, post_date, '
+            'enter_date, description, post_day, post_offset) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', self._trns)
+        self.db.executemany(
+            'INSERT INTO splits (guid, tx_guid, account_guid, value_num, '
+            'value_denom, quantity_num, quantity_denom) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', self._splits)
+        self._trns = []
+        self._splits = []
+
+    def close(self):
+        self.flush()
+        self.db.commit()
+        self.db.close()
+
+def save(book, filename):
+    """Writes a book to a new SQLite database in the tables of GnuCash."""
+    store = SQLiteStore(filename)
+    store.addbook(book)
+    for trn in book.transactions:
+        store.addtransaction(trn)
+    store.addprices(book.prices)
+    store.close()
+
+class SpoolBook(Book):
+    """A book loaded in memory until the process grows past ceiling MB of
+    resident memory, checked every interval transactions, and then spilled
+    to a temporary SQLiteStore, see spool()."""
+    interval = 1000
+
+    def __init__(self, ceiling):
+        Book.__init__(self)
+        self.ceiling = ceiling
+        self.store = None
+
+    def _addaccount(self, act):
+        Book._addaccount(self, act)
+        if self.store is not None:
+            self.store.addaccount(act)
+
+    def _addtransaction(self, trn):
+        if self.store is not None:
+            self.store.addtransaction(trn)
+            gncprofile.count('spilled transactions')
+            return
+        Book._addtransaction(self, trn)
+        if (self.ceiling is not None and
+            len(self.transactions) % self.interval == 0 and
+            gncprofile.memory() > self.ceiling):
+            self.spill()
+
+    def spill(self):
+        """Moves the transactions read so far to a temporary store, where
+        the rest will go as well.
+
+        Where the store cannot be made, as without a writable disk, the
+        book is loaded on in memory without a ceiling.
+        """
+        filename = None
+        try:
+            fd, filename = tempfile.mkstemp(suffix='.gnucash')
+            os.close(fd)
+            store = SQLiteStore(filename)
+            store.addbook(self)
+            for trn in self.transactions:
+                store.addtransaction(trn)
+            store.flush()
+        except (IOError, OSError, sqlite3.Error), e:
+            logging.warning('cannot spill the book, loading it in memory: %s',
+                            e)
+            gncprofile.count('spills failed')
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+            self.ceiling = None
+            return
+        self.store = store
+        gncprofile.count('spilled transactions', len(self.transactions))
+        self.transactions, self.trndic = [], {}
+        for act in self.accounts:
+            act.splits = []
+            act._index = act._qindex = None
+        self.invalidate()
+
+    def finish(self):
+        """Returns the book loaded: this one, or else a lazy SQLiteBook of
+        the store it spilled to."""
+        if self.store is None:
+            return self
+        self.store.addprices(self.prices)
+        self.store.close()
+        return SQLiteBook(self.store.filename, temporary=True, lazy=True)
+
+def spool(loader, source, ceiling, skip=()):
+    """Loads a book with a loader of gncreports.detect() within a memory
+    ceiling in MB, see SpoolBook. A SQLite book is read lazily."""
+    if isinstance(loader, gncreports.SQLiteLoader):
+        return load(source, lazy=True)
+    book = SpoolBook(ceiling)
+    book.load(loader.open(source), skip)
+    return book.finish()
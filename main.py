@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import os
+import json
 import urllib
+import logging
 
 import webapp2
 import jinja2
@@ -9,7 +11,10 @@ from google.appengine.ext import db
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 
+import gncjobs
+import gncprofile
 import gncreports
+import gncrender
 
 class Gncfile(db.Model):
     """Models a Gnucash file."""
@@ -19,6 +24,75 @@ class Gncfile(db.Model):
 jinja_env = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
 
+# Runs the report jobs of uploads and keeps the pages they make, in the Task
+# Queue and the Datastore on App Engine, so every instance sees them, and in
+# this process on the development server.
+if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+    runner = gncjobs.LocalJobRunner()
+else:
+    import gncqueue
+    runner = gncqueue.TaskQueueJobRunner()
+
+# The resident memory in MB past which a book being loaded is spilled to a
+# temporary store on disk, set by GNC_MEMORY_CEILING in the env_variables of
+# app.yaml. It is unset by default, since spilling needs sqlite3 and a
+# writable disk, and a book is loaded in memory where they are missing.
+memory_ceiling = float(os.environ.get('GNC_MEMORY_CEILING', 0)) or None
+
+# Blobs are read in chunks of this many bytes.
+blob_buffer_size = 1024 * 1024
+
+def open_blob(blob_key):
+    """Loads the book in a blob, streaming it in chunks within the memory
+    ceiling."""
+    reader = blobstore.BlobReader(blob_key, buffer_size=blob_buffer_size)
+    return gncreports.gncopen(reader, ceiling=memory_ceiling)
+
+def close_book(gncbook):
+    """Removes the temporary store of a spilled book and logs the peak
+    memory of the process."""
+    if hasattr(gncbook, 'close'):
+        gncbook.close()
+    logging.info('peak memory %.0f MB', gncprofile.peak_memory())
+
+def report_values(gncbook):
+    """Returns the values of the reports page of a book.
+
+    The statements are made and rendered as the template reaches them, so
+    the page starts going out before the reports are complete.
+    """
+    def balance_sheet():
+        for chunk in gncrender.render(gncbook.balance_sheet()):
+            yield chunk
+
+    def monthly_income_stms():
+        for year, stm in gncbook.monthly_income_stms():
+            yield gncrender.render(stm)
+
+    return {
+        'balance_sheet': balance_sheet(),
+        'years': gncbook.years(),
+        'monthly_income_stms': monthly_income_stms()
+    }
+
+def make_reports(blob_key, profile=False):
+    """Loads the book in a blob, deletes the blob and returns the reports
+    page as UTF-8 HTML."""
+    blob_info = blobstore.BlobInfo.get(blob_key)
+    profiler = profile and gncprofile.start() or None
+    try:
+        gncbook = open_blob(blob_info.key())
+        blob_info.delete()
+        template = jinja_env.get_template('reports.html')
+        try:
+            return template.render(report_values(gncbook)).encode('utf-8')
+        finally:
+            close_book(gncbook)
+    finally:
+        if profiler is not None:
+            gncprofile.stop()
+            logging.info('gncprofile %s', profiler.tojson())
+
 class BaseHandler(webapp2.RequestHandler):
     @webapp2.cached_property
     def jinja2(self):
@@ -46,37 +120,109 @@ class UploadHandler(blobstore_handlers.BlobstoreUploadHandler):
         try:
             upload_files = self.get_uploads('file')
             blob_info = upload_files[0]
-            self.redirect('/serve/%s' % blob_info.key())
         except:
             self.error(404)
+            return
+        # The book is loaded and reported on in the background, and the job
+        # page waits for it.
+        blob_key = str(blob_info.key())
+        id = runner.submit(make_reports, blob_key,
+                           bool(self.request.get('profile')), key=blob_key)
+        self.redirect('/jobs/%s' % id)
+
+class JobHandler(webapp2.RequestHandler):
+    """Shows the reports page made by a job, or a page that polls the
+    status of the job until it is done."""
+    def get(self, id):
+        job = runner.get(id)
+        if job is None:
+            self.error(404)
+            return
+        if job.state == gncjobs.DONE:
+            self.response.write(job.result)
+            return
+        if job.state == gncjobs.FAILED:
+            self.response.set_status(500)
+        template = jinja_env.get_template('job.html')
+        self.response.write(template.render({'job': job.status()}))
+
+class JobStatusHandler(webapp2.RequestHandler):
+    """Returns the status of a job as JSON."""
+    def get(self, id):
+        status = runner.status(id)
+        if status is None:
+            self.error(404)
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status))
 
 class ServeHandler(blobstore_handlers.BlobstoreDownloadHandler):
     def get(self, resource):
         resource = str(urllib.unquote(resource))
         blob_info = blobstore.BlobInfo.get(resource)
-        blob_reader = blobstore.BlobReader(blob_info.key())
-        gncbook = gncreports.gncopen(blob_reader)
 
-        years = []
-        stms = []
-        for year, stm in gncbook.monthly_income_stms():
-            years.append(year)
-            stms.append(stm.tohtml())
-        template_values = {
-            'balance_sheet': gncbook.balance_sheet().tohtml(),
-            'years': years,
-            'monthly_income_stms': stms
-        }
+        # With ?profile=1, the stages of loading the book go out in a header
+        # and all of them in a log line once the page is rendered.
+        profiler = None
+        if self.request.get('profile'):
+            profiler = gncprofile.start()
+        try:
+            gncbook = open_blob(blob_info.key())
+        finally:
+            if profiler is not None:
+                gncprofile.stop()
+        if profiler is not None:
+            self.response.headers['X-Gnc-Profile'] = profiler.summary()
 
-        # Deletes the BlobInfo entity and the corresponding Blobstore value
-        # from the datastore.
-        blob_info.delete()
+        try:
+            template_values = report_values(gncbook)
 
-        template = jinja_env.get_template('reports.html')
-        self.response.write(template.render(template_values))
+            # Deletes the BlobInfo entity and the corresponding Blobstore
+            # value from the datastore.
+            blob_info.delete()
+
+            template = jinja_env.get_template('reports.html')
+        except:
+            close_book(gncbook)
+            raise
+        self.response.app_iter = ReportPage(template, template_values,
+                                            gncbook, profiler)
+
+class ReportPage(object):
+    """The body of a reports page, rendered as the server iterates it.
+
+    The server closes it whether or not it iterated it, and that closes
+    the book. The profiler, if any, runs only while the page is rendered.
+    """
+    def __init__(self, template, values, gncbook, profiler=None):
+        self.template = template
+        self.values = values
+        self.gncbook = gncbook
+        self.profiler = profiler
+
+    def __iter__(self):
+        if self.profiler is not None:
+            gncprofile.start(self.profiler)
+        try:
+            for chunk in self.template.generate(self.values):
+                yield chunk.encode('utf-8')
+        finally:
+            if self.profiler is not None:
+                gncprofile.stop()
+                logging.info('gncprofile %s', self.profiler.tojson())
+
+    def close(self):
+        if (self.profiler is not None and
+                gncprofile.current() is self.profiler):
+            gncprofile.stop()
+        if self.gncbook is not None:
+            close_book(self.gncbook)
+            self.gncbook = None
 
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
     ('/upload', UploadHandler),
     ('/serve/([^/]+?)', ServeHandler),
+    ('/jobs/([0-9a-f]+)', JobHandler),
+    ('/jobs/([0-9a-f]+)/status', JobStatusHandler),
     ], debug=True)
@@ -63,6 +63,20 @@ function uploadCanceled(evt) {
     alert('Canceled by the user or the browser dropped the connection.');
 }
 
+/*
+ * Job status
+ */
+function pollJob(url) {
+    $.getJSON(url, function(job) {
+        if (job.state == 'done' || job.state == 'failed')
+            window.location.reload();
+        else {
+            $('#jobstate').text('Making the reports (' + job.state + ')...');
+            setTimeout(function() { pollJob(url); }, 1000);
+        }
+    });
+}
+
 /*
  * Tabbed pane
  */
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Tests that BookCache serves a book seen before from its snapshot, the
+same as loading it afresh, and that its store drops the least recently
+used snapshots.
+
+Usage: python test_cache.py
+"""
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gnccache
+import gncreports
+from synthbook import write_book, write_sqlite
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'book.xml')
+        write_book(self.filename, 600, 3, 2, commodities=1, compress=False)
+        self.store = gnccache.DirectoryStore(os.path.join(self.dir, 'cache'))
+        self.cache = gnccache.BookCache(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reports(self, book):
+        dates, trns = book.timeline()
+        return ([book.balance_sheet('monthly').tocsv(),
+                 book.balance_sheet(currency=book.commodity).tocsv(),
+                 book.income_stm().tocsv()] +
+                [stm.tocsv() for year, stm in book.monthly_income_stms()] +
+                [sorted([trn.id for trn in trns]),
+                 sorted([split.id for split in book.query(words='transaction')
+                         ])])
+
+    def test_hit(self):
+        serial = self.reports(gncreports.gncopen(self.filename))
+        self.assertEqual(self.reports(self.cache.open(self.filename)), serial)
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 0, 'misses': 1, 'entries': 1})
+        with open(self.filename, 'rb') as f:
+            book = self.cache.open(f)
+        self.assertEqual(self.reports(book), serial)
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 1, 'misses': 1, 'entries': 1})
+
+    def test_snapshot(self):
+        book = gncreports.gncopen(self.filename)
+        self.assertEqual(self.reports(gnccache.loads(gnccache.dumps(book))),
+                         self.reports(book))
+        self.assertTrue(gnccache.loads('GNCSNAP0\n') is None)
+
+    def test_invalidate(self):
+        self.cache.open(self.filename)
+        self.cache.invalidate(self.filename)
+        self.cache.open(self.filename)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+        # A changed file is a new entry, and the old one is left as is.
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        with open(self.filename, 'wb') as f:
+            f.write(data.replace('<split:value>-', '<split:value>-1', 1))
+        book = self.cache.open(self.filename)
+        self.assertEqual(self.reports(book),
+                         self.reports(gncreports.gncopen(self.filename)))
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 0, 'misses': 3, 'entries': 2})
+
+    def test_sqlite(self):
+        filename = os.path.join(self.dir, 'book.sqlite')
+        write_sqlite(filename, 300, 2, 2, compress=False)
+        pattern = os.path.join(tempfile.gettempdir(), '*.gnucash')
+        before = len(glob.glob(pattern))
+        book = self.cache.open(filename)
+        self.assertEqual(len(glob.glob(pattern)), before)
+        self.assertEqual(self.reports(book),
+                         self.reports(self.cache.open(filename)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_eviction(self):
+        path = os.path.join(self.dir, 'lru')
+        store = gnccache.DirectoryStore(path, maxsize=250)
+        for i, key in enumerate(['a', 'b']):
+            store.put(key, key * 100)
+            os.utime(os.path.join(path, key + store.suffix), (i, i))
+        self.assertEqual(store.get('a'), 'a' * 100)
+        store.put('c', 'c' * 100)
+        self.assertEqual(sorted(store.keys()), ['a', 'c'])
+        self.assertTrue(store.get('b') is None)
+        self.assertEqual(store.size(), 200)
+        store.clear()
+        self.assertEqual(store.keys(), [])
+
+if __name__ == '__main__':
+    unittest.main()
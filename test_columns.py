@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Tests that the sums taken on the split columns are exact, as those of
+the splits one by one, however large the amounts.
+
+Usage: python test_columns.py
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncreports
+from synthbook import write_book
+
+class OldNumpy(object):
+    """Stands in for a numpy before 1.8, whose ufuncs have no at()."""
+    def __init__(self, numpy):
+        self.numpy = numpy
+        self.add = lambda *args, **kwargs: numpy.add(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.numpy, name)
+
+class ColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'book.xml')
+        write_book(self.filename, 300, 2, 2, compress=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, amount):
+        """Gives every tenth split value the amount and compares the sums
+        on the columns with those of the splits."""
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        values = iter(range(len(data)))
+        def sub(match):
+            if values.next() % 10:
+                return match.group()
+            return '<split:value>%s/' % amount
+        data = re.sub(r'<split:value>-?\d+/', sub, data)
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+
+        book = gncreports.gncopen(self.filename)
+        columns = book.columns()
+        if columns is None:
+            return
+        periods = [(start, end) for year in book.years()
+                   for start, end in gncreports.monthly_periods(year)]
+        periods.append((gncreports.date.min, gncreports.date.max))
+        accounts = book.accounts
+        self.assertEqual(
+            gncreports.period_balances(accounts, periods, columns),
+            gncreports.period_balances(accounts, periods))
+
+    def test_small(self):
+        self.check(12345)
+
+    def test_past_float(self):
+        self.check(2 ** 53 + 1)
+
+    def test_past_int64(self):
+        self.check(2 ** 62 + 1)
+
+    def test_without_add_at(self):
+        numpy = gncreports.numpy
+        if numpy is None:
+            return
+        gncreports.numpy = OldNumpy(numpy)
+        try:
+            self.check(2 ** 53 + 1)
+        finally:
+            gncreports.numpy = numpy
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Tests that statements limited to a depth list the subtotals of the
+accounts down to it, nested by level, with the same totals as in full.
+
+Usage: python test_depth.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncreports
+from synthbook import write_book
+
+class DepthTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'book.xml')
+        write_book(self.filename, 300, 2, 2, depth=3, compress=False)
+        self.book = gncreports.gncopen(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def totals(self, stm):
+        return [(label, values) for kind, label, values, level in stm.rows()
+                if kind == 'total']
+
+    def levels(self, stm):
+        return [level for kind, label, values, level in stm.rows()
+                if kind == 'account']
+
+    def check(self, make):
+        full = make(None)
+        self.assertEqual(set(self.levels(full)), set([0]))
+        for depth in range(4):
+            stm = make(depth)
+            self.assertEqual(self.totals(stm), self.totals(full))
+            self.assertEqual(set(self.levels(stm)), set(range(depth)))
+            indents = [len(line) - len(line.lstrip(' '))
+                       for line in stm.tocsv().splitlines()]
+            self.assertEqual(set(indents), set(range(0, 2 * depth, 2)) or
+                             set([0]))
+
+    def test_balance_sheet(self):
+        self.check(lambda depth: self.book.balance_sheet(depth=depth))
+
+    def test_income_stm(self):
+        self.check(lambda depth: self.book.income_stm(depth=depth))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Tests that a book exported by gncexport reads back from its columnar
+file with the same accounts, transactions and sums, with and without
+NumPy.
+
+Usage: python test_export.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from fractions import Fraction
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncexport
+import gncreports
+from synthbook import write_book
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        filename = os.path.join(self.dir, 'book.xml')
+        write_book(filename, 600, 3, 2, depth=2, commodities=1,
+                   compress=False)
+        self.book = gncreports.gncopen(filename)
+        self.filename = os.path.join(self.dir, 'book.gnccol')
+        gncexport.export(self.book, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sums(self, pairs):
+        """Returns the exact sums of (key, num, denom) amounts by key."""
+        sums = {}
+        for key, num, denom in pairs:
+            sums[key] = sums.get(key, 0) + Fraction(int(num), int(denom))
+        return sums
+
+    def check(self):
+        book = self.book
+        dates, trns = book.timeline()
+        splits = [split for trn in trns for split in trn.splits]
+        cols = gncexport.ColumnFile(self.filename)
+        try:
+            self.assertEqual(cols.header['splits'], len(splits))
+            self.assertEqual(list(cols.strings('act_id')),
+                             [act.id for act in book.accounts])
+            self.assertEqual(list(cols.strings('act_name')),
+                             [act.name for act in book.accounts])
+            parents = [i >= 0 and book.accounts[i].id or None
+                       for i in cols['act_parent']]
+            self.assertEqual(parents, [act.pid for act in book.accounts])
+            types = [cols.header['types'][i] for i in cols['act_type']]
+            self.assertEqual(types, [act.type for act in book.accounts])
+            self.assertEqual(list(cols.strings('trn_id')),
+                             [trn.id for trn in trns])
+            self.assertEqual(cols.dates(), dates)
+
+            acts = [book.accounts[i].id for i in cols['split_account']]
+            years = [dates[i].year for i in cols['split_transaction']]
+            for kind in ('value', 'quantity'):
+                nums = cols['split_%s_num' % kind]
+                denoms = cols['split_%s_denom' % kind]
+                self.assertEqual(
+                    self.sums(zip(zip(acts, years), nums, denoms)),
+                    self.sums([((split.accountid,
+                                 split.transaction.date_posted.year),
+                                getattr(split, kind + '_num'),
+                                getattr(split, kind + '_denom'))
+                               for split in splits]))
+            self.assertEqual(sum(self.sums(zip(acts, cols['split_value_num'],
+                                               cols['split_value_denom'])
+                                           ).values()), 0)
+        finally:
+            cols.close()
+
+    def test_numpy(self):
+        if gncexport.numpy is None:
+            return
+        self.check()
+
+    def test_arrays(self):
+        numpy = gncexport.numpy
+        gncexport.numpy = None
+        try:
+            self.check()
+        finally:
+            gncexport.numpy = numpy
+
+if __name__ == '__main__':
+    unittest.main()
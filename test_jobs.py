@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Tests that LocalJobRunner runs jobs, finds a keyed job again, reports
+their status and failures, and drops the oldest finished jobs.
+
+Usage: python test_jobs.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncjobs
+import gncreports
+from synthbook import write_book
+
+def fail(message):
+    raise ValueError(message)
+
+def report(filename):
+    return gncreports.gncopen(filename).balance_sheet().tocsv()
+
+class JobsTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = gncjobs.LocalJobRunner(workers=2, maxjobs=3)
+        self.addCleanup(self.runner.shutdown)
+
+    def blocked(self, **kwargs):
+        """Submits a job that runs until the event returned is set, at the
+        latest when the test ends."""
+        event = threading.Event()
+        self.addCleanup(event.set)
+        return self.runner.submit(event.wait, 10, **kwargs), event
+
+    def test_submit(self):
+        dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(dir, 'book.xml')
+            write_book(filename, 300, 2, 2, compress=False)
+            id = self.runner.submit(report, filename)
+            self.assertTrue(self.runner.wait(id, 30))
+            self.assertEqual(self.runner.result(id), report(filename))
+        finally:
+            shutil.rmtree(dir)
+
+    def test_status(self):
+        id, event = self.blocked()
+        self.assertTrue(self.runner.get(id).state in (gncjobs.QUEUED,
+                                                      gncjobs.RUNNING))
+        self.assertFalse(self.runner.wait(id, 0.01))
+        self.assertTrue(self.runner.result(id) is None)
+        self.assertFalse('seconds' in self.runner.status(id))
+        event.set()
+        self.assertTrue(self.runner.wait(id, 10))
+        status = self.runner.status(id)
+        self.assertEqual(status['id'], id)
+        self.assertEqual(status['state'], gncjobs.DONE)
+        self.assertTrue(status['seconds'] >= 0)
+        self.assertFalse('error' in status)
+        self.assertTrue(self.runner.status('nosuchjob') is None)
+        self.assertFalse(self.runner.wait('nosuchjob'))
+
+    def test_key(self):
+        id, event = self.blocked(key='blob')
+        self.assertEqual(self.runner.submit(fail, 'again', key='blob'), id)
+        self.assertNotEqual(self.runner.submit(len, 'other', key='other'),
+                            id)
+        event.set()
+        self.assertTrue(self.runner.wait(id, 10))
+        self.assertEqual(self.runner.submit(fail, 'again', key='blob'), id)
+        self.assertEqual(self.runner.status(id)['state'], gncjobs.DONE)
+
+    def test_failure(self):
+        id = self.runner.submit(fail, 'no book', key='blob')
+        self.assertTrue(self.runner.wait(id, 10))
+        status = self.runner.status(id)
+        self.assertEqual(status['state'], gncjobs.FAILED)
+        self.assertEqual(status['error'], 'no book')
+        self.assertTrue(self.runner.result(id) is None)
+
+        # A failed job is made again for its key.
+        again = self.runner.submit(len, 'book', key='blob')
+        self.assertNotEqual(again, id)
+        self.assertTrue(self.runner.wait(again, 10))
+        self.assertEqual(self.runner.result(again), 4)
+
+    def test_eviction(self):
+        ids = []
+        for i in range(3):
+            ids.append(self.runner.submit(len, 'x' * i, key=i))
+            self.assertTrue(self.runner.wait(ids[-1], 10))
+        id, event = self.blocked(key='blocked')
+        # The oldest finished job makes room, with its key.
+        self.assertTrue(self.runner.get(ids[0]) is None)
+        self.assertEqual(map(self.runner.result, ids[1:]), [1, 2])
+        self.assertNotEqual(self.runner.submit(len, '', key=0), ids[0])
+        self.assertTrue(self.runner.get(ids[1]) is None)
+
+        # Unfinished jobs are kept past maxjobs.
+        more = [self.blocked() for i in range(3)]
+        self.assertTrue(self.runner.get(id) is not None)
+        self.assertTrue(all([self.runner.get(job) is not None
+                             for job, e in more]))
+
+if __name__ == '__main__':
+    unittest.main()
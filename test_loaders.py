@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Tests that gncopen() loads every format of book from file objects, and
+that a book spilled past a memory ceiling gives the same reports.
+
+Usage: python test_loaders.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncreports
+from synthbook import write_book, write_sqlite
+
+class Unseekable(object):
+    """A file object that can only be read, as a pipe or a socket."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+class LoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = {}
+        for format, write, kwargs in [('gzip', write_book, {}),
+                                      ('xml', write_book, {'compress': False}),
+                                      ('sqlite', write_sqlite, {})]:
+            filename = os.path.join(self.dir, 'book.' + format)
+            write(filename, 200, 2, 2, commodities=1, **kwargs)
+            self.files[format] = filename
+        self.expected = self.reports(gncreports.gncopen(self.files['gzip']))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reports(self, book):
+        return ([stm.tocsv() for year, stm in book.monthly_income_stms()] +
+                [book.balance_sheet('monthly').tocsv()])
+
+    def check(self, format, wrap):
+        with open(self.files[format], 'rb') as f:
+            book = gncreports.gncopen(wrap(f))
+            self.assertEqual(self.reports(book), self.expected)
+            if hasattr(book, 'close'):
+                book.close()
+
+    def test_files(self):
+        for format in self.files:
+            self.assertEqual(
+                self.reports(gncreports.gncopen(self.files[format])),
+                self.expected)
+
+    def test_file_objects(self):
+        for format in self.files:
+            self.check(format, lambda f: f)
+
+    def test_string_io(self):
+        for format in self.files:
+            self.check(format, lambda f: StringIO(f.read()))
+
+    def test_unseekable(self):
+        for format in self.files:
+            self.check(format, Unseekable)
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, offset):
+        filename = os.path.join(self.dir, 'book%s.xml' % offset)
+        write_book(filename, 1500, 2, 2, commodities=1, compress=False)
+        with open(filename, 'rb') as f:
+            data = f.read().replace(' -0500<', ' %s<' % offset)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+        book = gncreports.gncopen(filename)
+        spilled = gncreports.gncopen(filename, ceiling=0)
+        self.assertTrue(spilled.lazy)
+        self.assertEqual(spilled.years(), book.years())
+        self.assertEqual(
+            [stm.tocsv() for year, stm in spilled.monthly_income_stms()],
+            [stm.tocsv() for year, stm in book.monthly_income_stms()])
+        self.assertEqual(spilled.balance_sheet('monthly').tocsv(),
+                         book.balance_sheet('monthly').tocsv())
+        self.assertEqual(self.details(spilled), self.details(book))
+        spilled.close()
+
+    def details(self, book):
+        """Returns the balances, valued balance sheet, ledgers and queries
+        of a book, which a lazy book reads apart from the statements."""
+        year = book.years()[-1]
+        start, end = date(year, 3, 1), date(year, 8, 31)
+        details = [book.balance_sheet(currency=book.commodity).tocsv()]
+        # Transactions posted at the same time may come in either order.
+        for act in sorted(book.accounts, key=lambda act: act.fullname()):
+            name = act.fullname()
+            details.append((name, act.balance(), act.balance(start, end)))
+            if act.pid is not None:
+                rows = list(book.account_ledger(name, start, end).rows())
+                details.append((sorted([(row[1], row[2][0])
+                                        for row in rows[1:]]),
+                                rows[-1][2][-1]))
+        for query in [book.query(start, end),
+                      book.query(words='transaction 7'),
+                      book.query(account=book.accounts[1], low=0),
+                      book.query(text='transaction 1', high=100)]:
+            splits = list(query)
+            self.assertTrue(splits)
+            details.append(([split.transaction.date_posted
+                             for split in splits],
+                            sorted([split.id for split in splits])))
+        return details
+
+    def test_no_disk(self):
+        filename = os.path.join(self.dir, 'book.gnucash')
+        write_book(filename, 1500, 2, 2)
+        mkstemp = tempfile.mkstemp
+        def fail(*args, **kwargs):
+            raise OSError('read-only file system')
+        tempfile.mkstemp = fail
+        try:
+            book = gncreports.gncopen(filename, ceiling=0)
+        finally:
+            tempfile.mkstemp = mkstemp
+        self.assertFalse(getattr(book, 'lazy', False))
+        self.assertEqual(len(book.transactions), 1500)
+        self.assertEqual(book.balance_sheet().tocsv(),
+                         gncreports.gncopen(filename).balance_sheet().tocsv())
+
+    def test_west(self):
+        self.check('-0500')
+
+    def test_east(self):
+        self.check('+0900')
+
+if __name__ == '__main__':
+    unittest.main()
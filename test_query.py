@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Tests that queries find the same splits as filtering every split of the
+book one by one, in date order, on an XML and a SQLite book.
+
+Usage: python test_query.py
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncreports
+from synthbook import write_book, write_sqlite
+
+ARGS = (800, 2, 2)
+KWARGS = {'depth': 2, 'commodities': 1, 'compress': False}
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        filename = os.path.join(self.dir, 'book.xml')
+        write_book(filename, *ARGS, **KWARGS)
+        self.xml = gncreports.gncopen(filename)
+        self.book = self.open()
+
+    def tearDown(self):
+        if hasattr(self.book, 'close'):
+            self.book.close()
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return self.xml
+
+    def brute(self, start=date.min, end=date.max, account=None,
+              subtree=True, text=None, regex=None, words=None, low=None,
+              high=None):
+        """Returns the ids of the splits of the XML book that pass the
+        filters of a query, tried on each split."""
+        ids = []
+        for trn in self.xml.transactions:
+            description = trn.description or u''
+            if not start <= trn.date_posted.date() <= end:
+                continue
+            if text is not None and text.lower() not in description.lower():
+                continue
+            if regex is not None and not re.search(regex, description):
+                continue
+            if words is not None and not set(
+                    gncreports.tokenize(words)).issubset(
+                    gncreports.tokenize(description)):
+                continue
+            for split in trn.splits:
+                if low is not None and split.value < low:
+                    continue
+                if high is not None and split.value > high:
+                    continue
+                if account is not None:
+                    act = split.account
+                    while subtree and act is not None and act.id != account:
+                        act = self.xml.actdic.get(act.pid)
+                    if act is None or act.id != account:
+                        continue
+                ids.append(split.id)
+        return sorted(ids)
+
+    def check(self, **filters):
+        expected = self.brute(**filters)
+        if 'account' in filters:
+            filters['account'] = self.book.actdic[filters['account']]
+        query = self.book.query(**filters)
+        splits = list(query)
+        dates = [split.transaction.date_posted for split in splits]
+        self.assertEqual(dates, sorted(dates))
+        self.assertEqual(sorted([split.id for split in splits]), expected)
+        self.assertEqual(query.count(), len(expected))
+        self.assertEqual([split.id for page in query.pages(7)
+                          for split in page],
+                         [split.id for split in splits])
+        return expected
+
+    def test_range(self):
+        year = self.xml.years()[0]
+        self.assertTrue(self.check())
+        self.assertTrue(self.check(start=date(year, 2, 1),
+                                   end=date(year, 6, 30)))
+        self.assertFalse(self.check(start=date(year + 1, 1, 1)))
+
+    def test_account(self):
+        year = self.xml.years()[-1]
+        found = 0
+        for act in self.xml.accounts:
+            if act.pid is None:
+                continue
+            found += len(self.check(account=act.id, end=date(year, 9, 30)))
+            self.check(account=act.id, subtree=False, low=0)
+        self.assertTrue(found)
+        self.assertRaises(KeyError, self.book.query, account='No:Such')
+
+    def test_filters(self):
+        year = self.xml.years()[0]
+        self.assertTrue(self.check(text='transaction 1'))
+        self.assertTrue(self.check(regex=r'7$', end=date(year, 3, 31)))
+        self.assertTrue(self.check(words='transaction 42'))
+        self.assertTrue(self.check(words='Transaction', low=0, high=100))
+        self.assertFalse(self.check(words='no such words'))
+        self.assertTrue(self.check(words='transaction', text='5',
+                                   start=date(year, 1, 1)))
+        self.assertTrue(self.check(high=0, regex=r'\d\d\d'))
+
+    def test_words_and_account(self):
+        for act in self.xml.accounts:
+            if act.pid is not None:
+                self.check(account=act.id, words='transaction 13')
+
+class SQLiteQueryTest(QueryTest):
+    def open(self):
+        filename = os.path.join(self.dir, 'book.sqlite')
+        write_sqlite(filename, *ARGS, **KWARGS)
+        return gncreports.gncopen(filename)
+
+if __name__ == '__main__':
+    unittest.main()
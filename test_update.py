@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Tests that Book.update() brings a book with its indexes and memoized
+reports to the same state as loading the newer file afresh.
+
+Usage: python test_update.py
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncreports
+from synthbook import write_book
+
+_transaction = re.compile(r'<gnc:transaction .*?</gnc:transaction>\n', re.S)
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'book.xml')
+        write_book(self.filename, 600, 3, 3, commodities=1, compress=False)
+        with open(self.filename, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def newer(self, data):
+        filename = os.path.join(self.dir, 'newer.xml')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def reports(self, book):
+        return ([stm.tocsv() for year, stm in book.monthly_income_stms()] +
+                [book.balance_sheet('monthly').tocsv(),
+                 book.balance_sheet('annual', currency=book.commodity).tocsv(),
+                 book.income_stm().tocsv()])
+
+    def state(self, book):
+        dates, trns = book.timeline()
+        found = [sorted([split.id for split in book.query(words=words)])
+                 for words in ('transaction', 'transaction 0',
+                               'transaction 300', 'transaction 599')]
+        self.assertTrue(found[0])
+        return (self.reports(book), [trn.date_posted for trn in trns],
+                sorted([trn.id for trn in trns]), found,
+                [(act.id, act.balance(), act.balances([dates[-100]]))
+                 for act in book.accounts])
+
+    def check(self, data):
+        book = gncreports.gncopen(self.filename)
+        self.state(book)
+        filename = self.newer(data)
+        counts = book.update(filename)
+        self.assertEqual(self.state(book),
+                         self.state(gncreports.gncopen(filename)))
+        return book, counts
+
+    def test_unchanged(self):
+        self.assertEqual(self.check(self.data)[1], (0, 0, 0))
+
+    def test_changes(self):
+        trns = list(_transaction.finditer(self.data))
+        first, middle, last = trns[0], trns[len(trns) // 2], trns[-1]
+        added = first.group().replace('<trn:id type="guid">',
+                                      '<trn:id type="guid">f')
+        changed = last.group().replace('<split:value>-', '<split:value>-1', 1)
+        data = (self.data[:first.start()] + added +
+                self.data[first.start():middle.start()] +
+                self.data[middle.end():last.start()] + changed +
+                self.data[last.end():])
+        self.assertEqual(self.check(data)[1], (1, 1, 1))
+
+    def test_insert_split(self):
+        book = gncreports.gncopen(self.filename)
+        before = self.state(book)
+        trn = list(_transaction.finditer(self.data))[-3]
+        split = re.search(r'    <trn:split>.*?</trn:split>\n', trn.group(),
+                          re.S).group()
+        added = split.replace('<split:id type="guid">',
+                              '<split:id type="guid">f')
+        added = re.sub(r'<split:value>-?\d+', '<split:value>100000',
+                       added)
+        start = trn.start() + trn.group().index(split)
+        newer = gncreports.gncopen(self.newer(
+            self.data[:start] + added + self.data[start:]))
+        new = [split for split in newer.trndic[trn.group().split(
+            '<trn:id type="guid">')[1][:32]].splits
+            if split.id.startswith('f')][0]
+
+        split = gncreports.Split()
+        split.unpack(new.pack())
+        split.transaction = book.trndic[new.transaction.id]
+        split.account = book.actdic[split.accountid]
+        split.transaction.splits.append(split)
+        split.account.insert(split)
+        self.assertEqual(self.state(book), self.state(newer))
+
+        split.transaction.splits.remove(split)
+        split.account.remove(split)
+        self.assertEqual(self.state(book), before)
+
+    def test_memo_kept(self):
+        book = gncreports.gncopen(self.filename)
+        stms = book.monthly_income_stms()
+        first = book.income_stm(*stms[-1][1].periods[0])
+        last = stms[0][0]
+        trns = list(_transaction.finditer(self.data))
+        trn = [m for m in trns if '<ts:date>%d-' % last in m.group()][-1]
+        changed = trn.group().replace('<split:value>-', '<split:value>-1', 1)
+        book.update(self.newer(self.data[:trn.start()] + changed +
+                               self.data[trn.end():]))
+        self.assertTrue(book.income_stm(*stms[-1][1].periods[0]) is first)
+        self.assertEqual(book.monthly_income_stms()[0][1].tocsv(),
+                         gncreports.gncopen(self.newer(
+                             self.data[:trn.start()] + changed +
+                             self.data[trn.end():])).monthly_income_stms()
+                         [0][1].tocsv())
+
+if __name__ == '__main__':
+    unittest.main()
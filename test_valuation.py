@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Tests that valued balance sheets convert the balance of each account at
+the price nearest each ending, as worked out split by split.
+
+Usage: python test_valuation.py
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+from fractions import Fraction
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+import gncreports
+from synthbook import write_book
+
+class ValuationTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'book.xml')
+        write_book(self.filename, 600, 2, 3, commodities=2, compress=False)
+        self.book = gncreports.gncopen(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def price(self, commodity, currency, ending):
+        """Returns the price nearest an ending, the earlier of two as near,
+        looked up in every price of the book, or None."""
+        key = gncreports._cmdtykey(commodity)
+        other = gncreports._cmdtykey(currency)
+        if key == other:
+            return Fraction(1)
+        prices = [(price.date, price.value)
+                  for price in self.book.prices.pairs.get((key, other), [])]
+        if not prices:
+            prices = [(price.date, 1 / price.value) for price in
+                      self.book.prices.pairs.get((other, key), [])
+                      if price.value != 0]
+        if not prices:
+            return None
+        return min(prices, key=lambda (when, value): (
+            abs((when - ending).days), when))[1]
+
+    def balance(self, act, ending, currency):
+        quantity = value = 0
+        for split in act.splits:
+            if split.transaction.date_posted.date() <= ending:
+                quantity += Fraction(split.quantity_num, split.quantity_denom)
+                value += Fraction(split.value_num, split.value_denom)
+        price = self.price(act.commodity or currency, currency, ending)
+        if price is None:
+            return act.signed(value)
+        return act.signed(quantity * price)
+
+    def check(self, currency):
+        stm = self.book.balance_sheet('quarterly', currency=currency)
+        rows = stm.assets + stm.liabilities + stm.equity
+        self.assertTrue(rows)
+        for act, balances in rows:
+            self.assertEqual(balances, [self.balance(act, ending, currency)
+                                        for ending in stm.endings])
+        self.assertEqual(stm.total['assets'],
+                         [sum(blns) for blns in zip(*[
+                             balances for act, balances in stm.assets])])
+
+    def test_book_currency(self):
+        self.check(self.book.commodity)
+
+    def test_foreign_currency(self):
+        commodities = set([gncreports._cmdtykey(act.commodity)
+                           for act in self.book.accounts if act.commodity])
+        commodities.remove(gncreports._cmdtykey(self.book.commodity))
+        self.assertTrue(commodities)
+        for space, id in commodities:
+            self.check(id)
+
+    def test_zero_price(self):
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        data = re.sub(r'<price:value>\d+/', '<price:value>0/', data, 3)
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+        self.book = gncreports.gncopen(self.filename)
+        self.test_book_currency()
+        self.test_foreign_currency()
+
+if __name__ == '__main__':
+    unittest.main()